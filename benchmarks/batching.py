@@ -0,0 +1,44 @@
+# run with: python -m benchmarks.batching [max_concurrency]
+import sys
+import time
+
+import torch
+from transformers import GPTBigCodeConfig, GPTBigCodeForCausalLM
+
+from datadm.batching import BatchScheduler, GenerationRequest
+
+
+def tiny_model():
+    # a random model with starchat's architecture, small enough for cpu
+    torch.manual_seed(0)
+    config = GPTBigCodeConfig(vocab_size=512, n_positions=2048, n_embd=128, n_layer=4, n_head=4, multi_query=True,
+                              eos_token_id=None)
+    return GPTBigCodeForCausalLM(config).eval()
+
+
+def tokens_per_second(model, concurrency, max_batch, n_tokens=64):
+    # `concurrency` sessions asking at the same time, with prompts of different lengths
+    scheduler = BatchScheduler(model, max_batch=max_batch)
+    requests = [GenerationRequest([1 + j % 500 for j in range(100 + 37 * i)], n_tokens) for i in range(concurrency)]
+    start = time.perf_counter()
+    for request in requests:
+        scheduler.submit(request)
+    for request in requests:
+        request.result()
+    return sum(len(r.tokens) for r in requests) / (time.perf_counter() - start)
+
+
+def bench(max_concurrency=8):
+    model = tiny_model()
+    tokens_per_second(model, 2, 2)  # warm up
+    print("aggregate tokens/sec:")
+    concurrency = 1
+    while concurrency <= max_concurrency:
+        serial = tokens_per_second(model, concurrency, 1)
+        batched = tokens_per_second(model, concurrency, max_concurrency)
+        print(f"  {concurrency:3d} sessions: {serial:8.0f} one at a time, {batched:8.0f} batched")
+        concurrency *= 2
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 8)
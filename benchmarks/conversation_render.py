@@ -0,0 +1,57 @@
+# run with: python -m benchmarks.conversation_render [n_turns]
+import base64
+import io
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from datadm.conversation import ConversationRenderer
+
+
+def png():
+    fig = plt.figure(figsize=(4, 3))
+    plt.plot(range(100))
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    plt.close(fig)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def conversation(n_turns):
+    image = png()
+    convo = []
+    for i in range(n_turns):
+        convo.append({'role': 'user', 'content': f"question {i}"})
+        convo.append({'role': 'assistant', 'content': f"Here is the plan for {i}\n```python\nprint(df.head())\n```"})
+        data = [{'text/html': '<table>' + '<tr><td>1</td></tr>' * 50 + '</table>'}]
+        if i % 5 == 0:
+            data.append({'image/png': image})
+        convo.append({'role': 'assistant', 'content': {'stdout': 'x' * 500, 'tracebacks': '', 'data': data}})
+    return convo
+
+
+def per_token_ms(renderer, convo, n_tokens=50):
+    # what `Agent.bot` does while a response streams in: the same past conversation plus a growing last message
+    renderer.render(convo)  # the past conversation was already shown before this response
+    response = ""
+    start = time.perf_counter()
+    for i in range(n_tokens):
+        response += f" token{i}"
+        renderer.render(convo + [{'role': 'user', 'content': 'next'}, {'role': 'assistant', 'content': response}])
+    return (time.perf_counter() - start) / n_tokens * 1000
+
+
+def bench(n_turns=200):
+    print(f"render cost per streamed token:")
+    for turns in sorted({10, 50, n_turns // 2, n_turns}):
+        convo = conversation(turns)
+        uncached = per_token_ms(ConversationRenderer(max_entries=0, max_streams=0), convo)
+        cached = per_token_ms(ConversationRenderer(), convo)
+        print(f"  {turns:4d} turns: {uncached:8.2f}ms uncached, {cached:6.3f}ms memoized")
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
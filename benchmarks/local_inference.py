@@ -0,0 +1,53 @@
+# run with: python -m benchmarks.local_inference [model_path]
+# without a model path a random model with starchat's architecture (smaller) is used
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import GPTBigCodeConfig, GPTBigCodeForCausalLM
+
+from datadm.backend import QuantizedStarChat, StarChat
+from datadm.batching import BatchScheduler, GenerationRequest
+
+
+def random_model(path):
+    torch.manual_seed(0)
+    config = GPTBigCodeConfig(vocab_size=49152, n_positions=2048, n_embd=1024, n_layer=12, n_head=16, multi_query=True,
+                              eos_token_id=None)
+    GPTBigCodeForCausalLM(config).to(torch.bfloat16).save_pretrained(path)
+
+
+def tokens_per_second(model, n_tokens=64):
+    scheduler = BatchScheduler(model, max_batch=1)
+    scheduler.submit(GenerationRequest(list(range(1, 201)), 4)).result()  # warm up
+    request = scheduler.submit(GenerationRequest(list(range(1, 201)), n_tokens))
+    start = time.perf_counter()
+    request.result()
+    seconds = time.perf_counter() - start
+    scheduler.close()
+    return len(request.tokens) / seconds
+
+
+def memory_bytes(model):
+    params = sum(t.nelement() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    packed = sum(m.weight().nelement() * m.weight().element_size() for m in model.modules()
+                 if isinstance(m, torch.ao.nn.quantized.dynamic.Linear))
+    return params + packed
+
+
+def bench(model_path):
+    print(f"{torch.get_num_threads()} threads")
+    for name, load in [('bf16', StarChat.load_model), ('int8', QuantizedStarChat.load_model)]:
+        model = load(model_path).eval()
+        print(f"  {name}: {tokens_per_second(model):6.1f} tokens/s, {memory_bytes(model) / 1024 ** 2:7.0f}MB")
+        del model
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        bench(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as path:
+            random_model(path)
+            bench(path)
@@ -0,0 +1,26 @@
+# run with: python -m benchmarks.repl_latency [n_runs]
+import statistics
+import sys
+import time
+
+from datadm.repl import REPL
+
+
+def bench(n=200):
+    repl = REPL()
+    repl.exec("pass")  # warm up
+    timings = []
+    for i in range(n):
+        start = time.perf_counter()
+        out = repl.exec(f"print({i})")
+        timings.append(time.perf_counter() - start)
+        assert out['stdout'].strip() == str(i), out
+    timings.sort()
+    print(f"trivial cell round-trip over {n} runs:")
+    print(f"  mean {statistics.mean(timings) * 1000:.2f}ms")
+    print(f"  p50  {timings[len(timings) // 2] * 1000:.2f}ms")
+    print(f"  p95  {timings[int(len(timings) * 0.95)] * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
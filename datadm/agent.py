@@ -1,9 +1,20 @@
+import asyncio
+import functools
 import re
 import os
+import time
 import tenacity
 
 from datadm.backend import llm_manager, local_available
+from datadm.llm_cache import arecording
 from datadm.conversation import conversation_list_to_history
+from datadm.loaders import load_code
+from datadm.programs import program_cache
+from datadm.repl import AwaitableREPL
+
+# loads slower than this keep a pickle of the frame, so a kernel rebuilt from history doesn't parse the file again
+CACHE_LOADS_SECONDS = float(os.environ.get("DATADM_CACHE_LOADS_SECONDS", "5"))
+TURN_ATTEMPTS = 3
 
 
 class Agent:
@@ -12,39 +23,114 @@ class Agent:
     def __init__(self):
         pass
 
-    @tenacity.retry(wait=tenacity.wait_fixed(1), stop=tenacity.stop_after_attempt(3))
     def bot(self, repl, conversation, model_selection):
-        llm = llm_manager.llms.get(model_selection, {}).get('llm')
-        if llm is None:
-            yield conversation_list_to_history(conversation + [{'role': 'assistant', 'content': 'Please select and load a model'}]), conversation
-            return
+        # the same turn as `abot`, run on a private event loop with the blocking REPL behind an awaitable facade
+        loop = asyncio.new_event_loop()
+        turn = self.abot(AwaitableREPL(repl), conversation, model_selection)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(turn.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(turn.aclose())
+            # eg. generations a turn stopped, they end at their next token
+            pending = asyncio.all_tasks(loop)
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
 
-        for conversation in self._bot(repl, conversation, llm):
-            yield conversation_list_to_history(conversation), conversation
+    async def abot(self, repl, conversation, model_selection):
+        with llm_manager.use(model_selection) as llm:
+            if llm is None:
+                yield conversation_list_to_history(conversation + [{'role': 'assistant', 'content': 'Please select and load a model'}]), conversation
+                return
 
+            # a failed llm call starts the turn over, unless code was already sent to the kernel (it would run twice).
+            # counted when sent, a cell can fail before any of its output arrives
+            executions, turn = repl.executions, conversation
+            retrying = tenacity.AsyncRetrying(wait=tenacity.wait_fixed(1), stop=tenacity.stop_after_attempt(TURN_ATTEMPTS),
+                                              retry=tenacity.retry_if_exception(lambda e: isinstance(e, Exception) and repl.executions == executions),
+                                              reraise=True)
+            async for attempt in retrying:
+                with attempt:
+                    cache_keys = []
+                    async for turn in arecording(cache_keys, self._abot(repl, list(conversation), llm)):
+                        yield conversation_list_to_history(turn), turn
+        self._record_cache_keys(turn, cache_keys)
+        self._record_snapshot(turn, await repl.snapshot())
+
+    async def _abot(self, repl, conversation, llm):
+        # yields the conversation as it grows, `repl` is an AsyncREPL (or an `AwaitableREPL` on the sync path)
+        raise NotImplementedError(f"Please Implement _abot method on {self.__class__.__name__}")
+        yield
+
+    def _record_cache_keys(self, conversation, cache_keys):
+        # the llm responses behind this turn, retry drops them from the cache so they are generated again
+        if conversation:
+            conversation[-1]['cache_keys'] = cache_keys
+
+    def _record_snapshot(self, conversation, snapshot_id):
+        # undo / retry restore the kernel to the snapshot of the last execution left in the conversation
+        for message in reversed(conversation):
+            if isinstance(message['content'], dict):
+                message['content']['snapshot'] = snapshot_id
+                return
+
+    def program(self, template, llm, async_mode=False):
+        # compiled once per template and llm, see `datadm.programs`
+        return program_cache.get(template, llm, async_mode=async_mode)
 
-    def _bot(self, repl, conversation, llm):
-        raise NotImplementedError(f"Please Implement _bot method on {self.__class__.__name__}")
-    
     def user(self, message, history, conversation):
         return "", history + [[message, None]], conversation + [{'role': 'user', 'content': message}]
 
-    def add_data(self, file, repl, conversation):
+    def _data_source(self, file):
+        # returns (local file to upload or None, basename as seen from the kernel, variable name)
         def clean(varStr): return re.sub('\W|^(?=\d)','_', varStr)
         if isinstance(file, str):
-            basename = file
-            varname = clean(basename.split('/')[-1].split('.')[0])
-        else:
-            repl.upload_file(file.name)
-            basename = file.name.split('/')[-1]
-            varname = clean(basename.split('.')[0])
-        code_to_execute = f"{varname} = pd.read_csv('{basename}')\nprint({varname}.head())"
-        result = repl.exec(code_to_execute)
+            return None, file, clean(file.split('/')[-1].split('.')[0])
+        basename = file.name.split('/')[-1]
+        return file.name, basename, clean(basename.split('.')[0])
+
+    def _record_data(self, conversation, basename, code_to_execute, result, strategy, seconds, upload=None):
+        details = f"{strategy}, {seconds:.2f}s"
+        if upload is not None and upload['mb_per_s']:
+            details += f", uploaded {upload['bytes'] / 1e6:.1f}MB at {upload['mb_per_s']:.0f}MB/s"
         conversation.append({'role': 'user', 'content': f"Added {basename}"})
-        conversation.append({'role': 'assistant', 'content': f"Loading the data...\n```python\n{code_to_execute}\n```"})
+        conversation.append({'role': 'assistant', 'content': f"Loading the data ({details})...\n```python\n{code_to_execute}\n```"})
         conversation.append({'role': 'assistant', 'content': result})
         return conversation_list_to_history(conversation), conversation
 
+    def add_data(self, file, repl, conversation):
+        upload, basename, varname = self._data_source(file)
+        if upload is not None:
+            repl.upload_file(upload)
+        code_to_execute, strategy = load_code(basename, varname, local_path=os.path.join(repl.work_dir, basename))
+        start = time.time()
+        result = repl.exec(code_to_execute)
+        seconds = time.time() - start
+        if seconds > CACHE_LOADS_SECONDS and not result['tracebacks']:
+            repl.cache_artifact(varname)
+        result['snapshot'] = repl.snapshot()
+        return self._record_data(conversation, basename, code_to_execute, result, strategy, seconds, upload=upload and repl.last_upload)
+
+    async def aadd_data(self, file, repl, conversation):
+        upload, basename, varname = self._data_source(file)
+        if upload is not None:
+            await repl.upload_file(upload)
+        # sniffing and sampling read the file, off the event loop every session shares
+        code_to_execute, strategy = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(load_code, basename, varname, local_path=os.path.join(repl.work_dir, basename)))
+        start = time.time()
+        result = await repl.exec(code_to_execute)
+        seconds = time.time() - start
+        if seconds > CACHE_LOADS_SECONDS and not result['tracebacks']:
+            await repl.cache_artifact(varname)
+        result['snapshot'] = await repl.snapshot()
+        return self._record_data(conversation, basename, code_to_execute, result, strategy, seconds, upload=upload and repl.last_upload)
+
     @property
     def valid_models(self):
         if self.is_local:
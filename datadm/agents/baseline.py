@@ -1,4 +1,3 @@
-import guidance
 import re
 
 from datadm.agent import Agent
@@ -47,18 +46,20 @@ def extract_all_code_blocks(text):
 
 
 class Baseline(Agent):
-    def _bot(self, repl, conversation, llm):
+    async def _abot(self, repl, conversation, llm):
         starting_convo = conversation
 
         tries = 0
         while tries < 2:
-            precode = guidance(base_prompt + gensponse, llm=llm)
+            precode = self.program(base_prompt + gensponse, llm, async_mode=True)
 
-            for result in precode(conversation=clean_conversation_list(starting_convo), silent=True, stream=True):
-                yield starting_convo + [{'role': 'assistant', 'content': result.get('response') or ''}]
-            starting_convo += [{'role': 'assistant', 'content': result.get('response')}]
+            prompt_convo, context = clean_conversation_list(starting_convo, llm, profiles=await repl.profile_dataframes())
+            async for result in precode(conversation=prompt_convo, silent=True, stream=True):
+                yield starting_convo + [{'role': 'assistant', 'content': result.get('response') or '', 'context': context}]
+            starting_convo += [{'role': 'assistant', 'content': result.get('response'), 'context': context}]
 
-            exec_result = repl.exec(extract_all_code_blocks(result['response']))
+            async for exec_result in repl.exec_stream(extract_all_code_blocks(result['response']), timeout=None):
+                yield starting_convo + [{'role': 'assistant', 'content': exec_result}]
             starting_convo += [{'role': 'assistant', 'content': exec_result}]
             yield starting_convo
 
@@ -1,4 +1,3 @@
-import guidance
 
 from datadm.agent import Agent
 from datadm.conversation import clean_conversation_list
@@ -45,21 +44,23 @@ Looking at the executed results above, we can see {{gen "summary" temperature=0.
 class CoTMultiStep(Agent):
     is_local = True
 
-    def _bot(self, repl, conversation, llm):
+    async def _abot(self, repl, conversation, llm):
         starting_convo = conversation
 
         tries = 0
         while tries < 2:
-            precode = guidance(base_prompt + precode_prompt, llm=llm)
+            precode = self.program(base_prompt + precode_prompt, llm, async_mode=True)
 
-            for result in precode(conversation=clean_conversation_list(starting_convo), silent=True, stream=True):
+            prompt_convo, context = clean_conversation_list(starting_convo, llm, profiles=await repl.profile_dataframes())
+            async for result in precode(conversation=prompt_convo, silent=True, stream=True):
                 resolved_content = result.get('thoughts') or ''
                 resolved_content += '\n```python\n'+(result.get('code') or '')+'\n```'
-                resolved_convo = starting_convo + [{'role': 'assistant', 'content': resolved_content}]
+                resolved_convo = starting_convo + [{'role': 'assistant', 'content': resolved_content, 'context': context}]
                 yield resolved_convo
-            starting_convo += [{'role': 'assistant', 'content': resolved_content}]
+            starting_convo += [{'role': 'assistant', 'content': resolved_content, 'context': context}]
 
-            exec_result = repl.exec(result['code'])
+            async for exec_result in repl.exec_stream(result['code'], timeout=None):
+                yield starting_convo + [{'role': 'assistant', 'content': exec_result}]
             starting_convo += [{'role': 'assistant', 'content': exec_result}]
             yield starting_convo
 
@@ -67,8 +68,9 @@ class CoTMultiStep(Agent):
                 tries += 1
                 continue
             break
-            
-        postcode = guidance(base_prompt + postcode_prompt, llm=llm)
 
-        for result in postcode(conversation=clean_conversation_list(starting_convo), silent=True, stream=True):
-            yield starting_convo + [{'role': 'assistant', 'content': f'Looking at the executed results above, we can see {result.get("summary") or ""}'}]
+        postcode = self.program(base_prompt + postcode_prompt, llm, async_mode=True)
+
+        prompt_convo, context = clean_conversation_list(starting_convo, llm, profiles=await repl.profile_dataframes())
+        async for result in postcode(conversation=prompt_convo, silent=True, stream=True):
+            yield starting_convo + [{'role': 'assistant', 'content': f'Looking at the executed results above, we can see {result.get("summary") or ""}', 'context': context}]
@@ -0,0 +1,160 @@
+import asyncio
+import os
+
+from datadm.agent import Agent
+from datadm.agents.baseline import base_prompt, extract_all_code_blocks, gensponse
+from datadm.conversation import clean_conversation_list
+
+CANDIDATES = int(os.environ.get("DATADM_SPECULATIVE_CANDIDATES", "3"))
+POLL_SECONDS = 0.2
+
+
+def _code(response):
+    try:
+        return extract_all_code_blocks(response)
+    except IndexError:  # an unclosed code block
+        return None
+
+
+class _Candidates:
+    # responses generated at the same time, taken in the order they finish. the first with code runs in the kernel
+    # itself, behind a snapshot that undoes it if it fails. only then are the others tried in forks of the kernel, the
+    # first that runs without a traceback is chosen. one left with nothing to race it runs in the kernel itself too,
+    # and a response without code is an answer of its own
+    def __init__(self, n):
+        self.n = n
+        self.responses = [''] * n
+        self.code = {}  # finished candidate -> its code, '' for a response without any, None for an unclosed block
+        self.finished = []  # candidates whose response is complete, in that order
+        self.errors = []
+        self.trials = {}  # trial id -> candidate
+        self.results = {}  # candidate -> {'ok', ...} of its trial or run
+        self.ran = {}  # candidate -> exec result, of the ones run in the kernel itself
+        self.winner = None
+        self.stopped = False  # the generations still running stop
+
+    def finish(self, i, code, error=None):
+        self.finished.append(i)
+        self.code[i] = code
+        if error is not None:
+            self.errors.append(error)
+        if error is not None or code is None:
+            self.record_result(i, {'ok': False})
+        elif not code.strip():
+            self.record_result(i, {'ok': True})
+
+    def untried(self):
+        return [i for i in self.finished if i not in self.results and i not in self.trials.values()]
+
+    def next_direct(self, generating):
+        # the first response with code, or one nothing else is left to race
+        untried = self.untried()
+        if self.winner is not None or not untried:
+            return None
+        if not self.ran or (len(untried) == 1 and not generating and not self.trials):
+            return untried[0]
+        return None
+
+    def try_in(self, i, trial):
+        self.trials[trial['id']] = i
+
+    def ran_in_kernel(self, i, result):
+        self.ran[i] = result
+        self.record_result(i, {'ok': not result['tracebacks']})
+
+    def record_result(self, i, result):
+        self.results[i] = result
+        if result['ok'] and self.winner is None:
+            self.winner = i
+
+    def record(self, results):
+        for trial_id, result in results.items():
+            self.record_result(self.trials.pop(trial_id), result)
+
+    def chosen(self):
+        # the winner, or once every candidate failed the one run in the kernel (its traceback is what the user sees)
+        if self.winner is not None:
+            return self.winner
+        if len(self.results) == self.n:
+            if len(self.errors) == self.n:
+                raise self.errors[0]
+            return next(iter(self.ran), self.finished[0])
+        return None
+
+
+class Speculative(Agent):
+    # Baseline without serial retries: `CANDIDATES` responses are generated at once (a local model batches them). the
+    # first to finish runs in the kernel as Baseline would, the others keep generating meanwhile. if its code fails the
+    # kernel goes back to its snapshot and the others are tried in forks of the kernel at once, instead of one after
+    # the other. a fork's namespace can't be brought back into the kernel, so a winning trial's code runs twice (taking
+    # about twice as long, with side effects outside the namespace, like files written, happening twice).
+    # DATADM_SPECULATIVE_CANDIDATES=1 runs every response once, like Baseline
+    async def _abot(self, repl, conversation, llm):
+        starting_convo = conversation
+        program = self.program(base_prompt + gensponse, llm, async_mode=True)
+        prompt_convo, context = clean_conversation_list(starting_convo, llm, profiles=await repl.profile_dataframes())
+        candidates = _Candidates(CANDIDATES)
+
+        async def generate(i):
+            # stopped by closing the stream, guidance then ends the program at its next token
+            stream = program(conversation=prompt_convo, silent=True, stream=True).__aiter__()
+            try:
+                async for result in stream:
+                    candidates.responses[i] = result.get('response') or ''
+                    if candidates.stopped:
+                        break
+            finally:
+                try:
+                    await stream.aclose()
+                except AttributeError:
+                    pass  # guidance's program finished between the last result and closing, its executor is gone
+
+        tasks = {asyncio.ensure_future(generate(i)): i for i in range(CANDIDATES)}
+        shown = [{'role': 'assistant', 'content': '', 'context': context}]
+        try:
+            while candidates.chosen() is None:
+                # kernel calls stay on this task, one at a time
+                for task in [t for t in tasks if t.done()]:
+                    i = tasks.pop(task)
+                    error = task.exception()
+                    candidates.finish(i, _code(candidates.responses[i]) if error is None else None, error)
+                i = candidates.next_direct(generating=bool(tasks))
+                if i is not None:
+                    snapshot_id = await repl.snapshot()
+                    shown = [{'role': 'assistant', 'content': candidates.responses[i], 'context': context}]
+                    yield starting_convo + shown
+                    async for exec_result in repl.exec_stream(candidates.code[i], timeout=None):
+                        yield starting_convo + shown + [{'role': 'assistant', 'content': exec_result}]
+                    shown.append({'role': 'assistant', 'content': exec_result})
+                    candidates.ran_in_kernel(i, exec_result)
+                    if candidates.winner is None:
+                        await repl.restore(snapshot_id)
+                    continue
+                if candidates.ran:
+                    for i in candidates.untried():
+                        candidates.try_in(i, await repl.start_trial(candidates.code[i]))
+                if candidates.trials:
+                    candidates.record(await repl.trial_results(wait=POLL_SECONDS))
+                elif tasks:
+                    await asyncio.wait(tasks, timeout=POLL_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                if not candidates.ran:
+                    shown = [{'role': 'assistant', 'content': candidates.responses[0], 'context': context}]
+                yield starting_convo + shown
+        finally:
+            candidates.stopped = True
+            if candidates.trials:
+                await repl.cancel_trials()
+
+        i = candidates.chosen()
+        starting_convo += [{'role': 'assistant', 'content': candidates.responses[i], 'context': context}]
+        if i in candidates.ran:
+            exec_result = candidates.ran[i]
+        elif candidates.code[i] and candidates.code[i].strip():
+            yield starting_convo
+            async for exec_result in repl.exec_stream(candidates.code[i], timeout=None):
+                yield starting_convo + [{'role': 'assistant', 'content': exec_result}]
+        else:
+            yield starting_convo  # an answer without code
+            return
+        starting_convo += [{'role': 'assistant', 'content': exec_result}]
+        yield starting_convo
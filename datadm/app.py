@@ -2,70 +2,185 @@ import dotenv
 import gradio as gr
 import requests
 
+import asyncio
+import functools
 import os
 import requests
 import dotenv
 
-from datadm.repl import REPL
+from datadm.repl import AsyncREPL, KernelPool, EXPORT_FORMATS
 from datadm.backend import llm_manager
+from datadm.llm_cache import response_cache
 from datadm.agent import agent_manager
-from datadm.conversation import conversation_list_to_history
+from datadm import resources
+from datadm.session import session_manager
+from datadm.conversation import conversation_list_to_history, format_bytes, format_memory_report
+from datadm.images import image_store
 
 dotenv.load_dotenv()
 
 
-def get_downloads(repl):
-    frames = repl.dataframes_as_csvs()
+async def get_downloads(repl):
+    # only lists the frames, each one is written out when its export button is clicked (see `export_download`)
+    frames = (await repl.list_dataframes())[:10]
     if len(frames) == 0:
         result = [gr.Text.update(visible=True)]
     else:
         result = [gr.Text.update(visible=False)]
+    buttons = []
     for frame in frames:
-        result.append(
-            gr.File.update(
-                value = frame['csv'],
-                label = f"{frame['name']} ({frame['rows']} rows, {len(frame['columns'])} cols)",
+        result.append(gr.File.update(visible=False))
+        buttons.append(
+            gr.Button.update(
+                value = f"Export {frame['name']} ({frame['rows']} rows, {len(frame['columns'])} cols)",
                 visible=True,
             )
         )
     while len(result) < 11:
         result.append(gr.File.update(visible=False))
-    return result
-
-
-def remove_to_last_talker(conversation, model_selection):
-    # assume you want to clear cache as well
-    llm_manager.llms.get(model_selection, {}).get('llm').cache.clear()
+    while len(buttons) < 10:
+        buttons.append(gr.Button.update(visible=False))
+    return result + buttons + [[frame['name'] for frame in frames]]
+
+
+async def export_download(index, repl, download_names, export_format):
+    # the kernel writes in a background thread, poll so other cells can run in the meantime
+    name = download_names[index]
+    frame = await repl.export_dataframe(name, format=export_format, wait=False)
+    while frame is not None and frame['status'] in ['pending', 'stale']:
+        if frame['status'] == 'stale':  # a cell changed the frame while it was written
+            frame = await repl.export_dataframe(name, format=export_format, wait=False)
+            continue
+        await asyncio.sleep(0.5)
+        frame = await repl.export_status(name, format=export_format)
+    if frame is None:  # deleted meanwhile, or the kernel was rebuilt and lost the export
+        raise gr.Error(f"Could not export {name} as {export_format}: it is no longer in memory, refresh the list and try again")
+    if frame['status'] == 'error':
+        raise gr.Error(f"Could not export {frame['name']} as {export_format}: {frame['error']}")
+    return gr.File.update(
+        value = frame['path'],
+        label = f"{frame['name']} ({frame['rows']} rows, {len(frame['columns'])} cols)",
+        visible=True,
+    )
+
+
+INITIAL_SNAPSHOT = 'initial'  # taken once the kernel is prepared, undo falls back to it
+IMAGE_EVICTED = '*(image no longer available, run the cell again to see it)*'
+
+
+class Chatbot(gr.Chatbot):
+    # gradio copies each image into its own temp dir: the copy is handed to `image_store`, which counts it and
+    # deletes it with the image. an image evicted between rendering and this copy is shown as a placeholder
+    def _postprocess_chat_messages(self, chat_message):
+        if not isinstance(chat_message, (tuple, list)):
+            return super()._postprocess_chat_messages(chat_message)
+        try:
+            message = super()._postprocess_chat_messages(chat_message)
+        except FileNotFoundError:
+            return IMAGE_EVICTED
+        image_store.add_copy(str(chat_message[0]), message['name'])
+        return message
+
+
+async def remove_to_last_talker(repl, conversation, model_selection):
     if len(conversation) == 0:
         return conversation_list_to_history(conversation), conversation
     last_talker = conversation[-1]['role']
     while len(conversation) > 0 and conversation[-1]['role'] == last_talker:
-        conversation.pop()
+        # the responses being removed are generated again on retry instead of coming from the cache
+        response_cache.discard(conversation.pop().get('cache_keys', []))
+    # roll the kernel back too, to right after the last execution still in the conversation
+    snapshot_id = next((m['content']['snapshot'] for m in reversed(conversation)
+                        if isinstance(m['content'], dict) and m['content'].get('snapshot')), INITIAL_SNAPSHOT)
+    if await repl.restore(snapshot_id) is None:
+        print(f"Failed to restore kernel snapshot {snapshot_id}")
     return conversation_list_to_history(conversation), conversation
 
 
-def bot(agent_selection, repl, conversation, model_selection):
+async def bot(agent_selection, repl, conversation, model_selection):
     agent = agent_manager.get(agent_selection)
-    yield from agent.bot(repl, conversation, model_selection)
+    async for update in agent.abot(repl, conversation, model_selection):
+        yield update
 
 def user(agent_selection, message, history, conversation):
     agent = agent_manager.get(agent_selection)
     return agent.user(message, history, conversation)
 
-def add_data(agent_selection, file, repl, conversation):
+async def add_data(agent_selection, file, repl, conversation):
     agent = agent_manager.get(agent_selection)
-    return agent.add_data(file, repl, conversation)
+    history, conversation = await agent.aadd_data(file, repl, conversation)
+    # opt-in: narrower dtypes hold the same values, but later arithmetic can overflow them and categoricals refuse
+    # new values, which the user's (or the model's) next cells don't expect
+    if os.environ.get("DATADM_OPTIMIZE_MEMORY", "0") == "1":
+        history, conversation = await optimize_memory(repl, conversation)
+    return history, conversation
+
+async def optimize_memory(repl, conversation, report_unchanged=False):
+    reports = await repl.optimize_memory()
+    if reports:
+        conversation.append({'role': 'assistant', 'content': f"Reduced the memory used by the data (numbers now use narrower types and repetitive text is categorical):\n```\n{format_memory_report(reports)}\n```"})
+    elif report_unchanged:
+        conversation.append({'role': 'assistant', 'content': f"Memory used by the data:\n```\n{format_memory_report(await repl.memory_usage())}\n```"})
+    return conversation_list_to_history(conversation), conversation
+
+async def prepare_repl(repl):
+    await repl.exec('import pandas as pd')
+    await repl.exec('import numpy as np')
+    await repl.exec('import matplotlib.pyplot as plt')
+    await repl.exec("pd.set_option('display.max_columns', 500)")
+    await repl.exec("pd.set_option('display.width', 1000)")
+    await repl.snapshot(INITIAL_SNAPSHOT)
+    return repl
+
+
+repl_pool = KernelPool(
+    size=int(os.environ.get("DATADM_KERNEL_POOL_SIZE", "2")),
+    setup=prepare_repl,
+    repl_class=AsyncREPL,
+    limits=resources.limits_from_env(),
+)
+
 
 def setup_repl():
-    repl = REPL()
-    repl.exec('import pandas as pd')
-    repl.exec('import numpy as np')
-    repl.exec('import matplotlib.pyplot as plt')
-    repl.exec("pd.set_option('display.max_columns', 500)")
-    repl.exec("pd.set_option('display.width', 1000)")
+    # sync on purpose: gradio runs it in a worker thread, where a pool miss can spawn and prepare a kernel
+    repl = repl_pool.get()
+    resources.monitor.register(repl)
+    session_manager.track(repl)
     return repl
 
 
+def get_kernel_usage(repl):
+    if repl is not None and repl.evicted:
+        return "idle, restored on the next run"
+    usage = resources.monitor.latest(repl) if repl is not None else None
+    if usage is None:
+        return "starting..."
+    cpu = f", {usage['cpu_percent']:.0f}% cpu" if usage['cpu_percent'] is not None else ""
+    history = repl.history_size()
+    return (f"{format_bytes(usage['rss_bytes'])} memory{cpu}, history of {history['cells']} cells "
+            f"({format_bytes(history['memory_bytes'])} in memory, {format_bytes(history['disk_bytes'])} on disk)")
+
+
+def show_load_model(llm_name):
+    # hidden while the model loads in the background
+    return gr.Button.update(visible=llm_manager.llms[llm_name]['state'] in ['unloaded', 'error'])
+
+
+def get_context_usage(conversation, model_selection):
+    # recorded by the agents on each response, from `clean_conversation_list` building its prompt
+    context = next((m['context'] for m in reversed(conversation) if 'context' in m), None)
+    if context is None:
+        return ""
+    dropped = f", {context['dropped']} oldest messages left out" if context['dropped'] else ""
+    prefix_cache = getattr(llm_manager.llms.get(model_selection, {}).get('llm'), 'prefix_cache', None)
+    reused = ""
+    if prefix_cache is not None and prefix_cache.last is not None:
+        reused = f", {prefix_cache.last['reused_tokens']:,} reused from the KV cache"
+    stats = response_cache.stats()
+    cached = f", llm cache {stats['hit_rate']:.0%} hits ({stats['bytes'] / 1024 ** 2:.1f}MB)" if stats['hits'] + stats['misses'] else ""
+    return f"{context['tokens']:,} of {context['window']:,} tokens{dropped}{reused}{cached}"
+
+
 css = """
 footer {display: none !important;}
 .gradio-container {min-height: 0px !important;}
@@ -239,13 +354,15 @@ with gr.Blocks(
 ) as demo:
     repl = gr.State(None)
     files = []
+    download_buttons = []
+    download_names = gr.State([])
     conversation = gr.State([])
     gr.Markdown("# Welcome to DataDM!")
     with gr.Tabs() as tabs:
         with gr.Tab("Chat", id=0):
             with gr.Row():
                 with gr.Column(scale=5, elem_id="fullheight"):
-                    chatbot = gr.Chatbot(elem_id="chatbox", show_label=False)
+                    chatbot = Chatbot(elem_id="chatbox", show_label=False)
                     with gr.Row():
                         with gr.Column():
                             msg = gr.Textbox(
@@ -274,7 +391,7 @@ with gr.Blocks(
                     with gr.Row():
                         model_selection = gr.Dropdown(
                             choices=list(llm_manager.llms.keys()),
-                            value=list(llm_manager.llms.keys())[0],
+                            value=llm_manager.default_model,
                             label="model",
                             multiselect=False,
                             show_label=True,
@@ -284,13 +401,27 @@ with gr.Blocks(
                         model_state = gr.HighlightedText(label=False, container=False)
                     load_model = gr.Button("Load Model", visible=False, elem_id="load_model_button")
                     files.append(gr.Text("No Data Files", label="Data Files"))
+                    export_format = gr.Dropdown(
+                        choices=EXPORT_FORMATS,
+                        value=EXPORT_FORMATS[0],
+                        label="export format",
+                        multiselect=False,
+                        show_label=True,
+                        interactive=True,
+                        container=False)
                     for _ in range(10):
+                        b = gr.Button(visible=False, size="sm")
+                        download_buttons.append(b)
                         f = gr.File(__file__, visible=False)
                         files.append(f)
                     upload = gr.UploadButton(label="Upload CSV", elem_id="upload_button")
+                    optimize = gr.Button("Optimize Memory", size="sm")
+                    kernel_usage = gr.Text("starting...", label="Kernel", interactive=False)
+                    context_usage = gr.Text("", label="Last prompt", interactive=False)
+                    downloads = files + download_buttons + [download_names]
         upload_magic_thens = lambda filepath_object: [
             (add_data, [agent_selection, filepath_object, repl, conversation], [chatbot, conversation]),
-            (get_downloads, repl, files),
+            (get_downloads, repl, downloads),
             (lambda: gr.Tabs.update(selected=0), None, tabs)
         ]
 
@@ -313,6 +444,10 @@ with gr.Blocks(
     if os.environ.get("ANALYTICS_TRACKING", "0") == "1":
         demo.load(None, None, None, _js=posthog_default_off_analytics_script)
 
+    # Download Blocks
+    for i, b in enumerate(download_buttons):
+        b.click(functools.partial(export_download, i), [repl, download_names, export_format], files[i + 1])
+
     # Search Blocks
     query.submit(searchupdate, [query, container], results)
     search.click(searchupdate, [query, container], results)
@@ -320,12 +455,14 @@ with gr.Blocks(
     # Setup Blocks
     demo.load(lambda: gr.Button.update(visible=False), None, load_model
         ).then(llm_manager.model_status, model_selection, model_state
-        ).then(lambda llm_name: gr.Button.update(visible=(llm_manager.llms[llm_name]['state'] != 'ready')), model_selection, load_model)
+        ).then(show_load_model, model_selection, load_model)
     demo.load(setup_repl, None, repl)
+    demo.load(lambda llm_name: (llm_manager.model_status(llm_name), show_load_model(llm_name)), model_selection, [model_state, load_model], every=2)
+    demo.load(get_kernel_usage, repl, kernel_usage, every=5)
 
     # Configuration Blocks
     model_selection.change(lambda x: (x, llm_manager.model_status(x)), model_selection, [model_selection, model_state]
-        ).then(lambda llm_name: gr.Button.update(visible=(llm_manager.llms[llm_name]['state'] != 'ready')), model_selection, load_model)
+        ).then(show_load_model, model_selection, load_model)
     agent_selection.change(
         lambda x: gr.Dropdown.update(
             choices=agent_manager.get(x).valid_models & set(llm_manager.llms.keys()),
@@ -333,14 +470,16 @@ with gr.Blocks(
         ), 
         agent_selection,
         [model_selection]
-    ).then(lambda llm_name: gr.Button.update(visible=(llm_manager.llms[llm_name]['state'] != 'ready')), model_selection, load_model)
+    ).then(show_load_model, model_selection, load_model)
 
     load_model.click(llm_manager.load, model_selection, model_state
-        ).then(lambda llm_name: gr.Button.update(visible=(llm_manager.llms[llm_name]['state'] != 'ready')), model_selection, load_model)
+        ).then(show_load_model, model_selection, load_model)
 
     # Agent Blocks
     upload_event = upload.upload(add_data, [agent_selection, upload, repl, conversation],[chatbot, conversation]
-        ).then(get_downloads, repl, files)
+        ).then(get_downloads, repl, downloads)
+
+    optimize.click(functools.partial(optimize_memory, report_unchanged=True), [repl, conversation], [chatbot, conversation])
 
     buttonset = [submit, cancel, undo, retry]
     running_buttons = [gr.Button.update(**k) for k in [{'visible': False}, {'visible': True}, {'interactive': False}, {'interactive': False}]]
@@ -349,26 +488,33 @@ with gr.Blocks(
     msg_enter_event = msg.submit(user, [agent_selection, msg, chatbot, conversation], [msg, chatbot, conversation], queue=False
         ).then(lambda: running_buttons, None, buttonset, queue=False
         ).then(bot, [agent_selection, repl, conversation, model_selection], [chatbot, conversation], queue=True)
-    msg_enter_finalize = msg_enter_event.then(get_downloads, repl, files
+    msg_enter_finalize = msg_enter_event.then(get_downloads, repl, downloads
+        ).then(get_context_usage, [conversation, model_selection], context_usage, queue=False
         ).then(lambda: idle_buttons, None, buttonset, queue=False)
 
     submit_click_event = submit.click(user, [agent_selection, msg, chatbot, conversation], [msg, chatbot, conversation], queue=False
         ).then(lambda: running_buttons, None, buttonset, queue=False
         ).then(bot, [agent_selection, repl, conversation, model_selection], [chatbot, conversation], queue=True)
-    submit_click_finalize = submit_click_event.then(get_downloads, repl, files
+    submit_click_finalize = submit_click_event.then(get_downloads, repl, downloads
+        ).then(get_context_usage, [conversation, model_selection], context_usage, queue=False
         ).then(lambda: idle_buttons, None, buttonset, queue=False)
 
     # Control Blocks
-    undo.click(remove_to_last_talker, [conversation, model_selection], outputs=[chatbot, conversation], queue=False)
+    undo.click(remove_to_last_talker, [repl, conversation, model_selection], outputs=[chatbot, conversation], queue=False)
     cancel.click(None, cancels=[msg_enter_event, submit_click_event], queue=False
         ).then(lambda: idle_buttons, None, buttonset, queue=False)
-    retry.click(remove_to_last_talker, [conversation, model_selection], outputs=[chatbot, conversation], queue=False
+    retry.click(remove_to_last_talker, [repl, conversation, model_selection], outputs=[chatbot, conversation], queue=False
         ).then(bot, [agent_selection, repl, conversation, model_selection], [chatbot, conversation], queue=True
-        ).then(get_downloads, repl, files)
+        ).then(get_downloads, repl, downloads
+        ).then(get_context_usage, [conversation, model_selection], context_usage, queue=False)
 
-demo.queue(max_size=128, concurrency_count=1)
+# handlers await their own session's kernel, so several sessions can be served at once
+demo.queue(max_size=128, concurrency_count=int(os.environ.get("DATADM_CONCURRENCY", "8")))
 
 def main(share=False):
+    llm_manager.preload()
+    repl_pool.start()
+    session_manager.start()
     demo.launch(share=share, server_name="0.0.0.0")
 
 if __name__ == "__main__":
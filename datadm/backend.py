@@ -1,23 +1,256 @@
 import guidance
+from guidance.llms._llm import SyncSession
+from guidance.llms._transformers import TokenHealingLogitsProcessor, TransformersSession
 from transformers import AutoModelForCausalLM, AutoTokenizer
+import asyncio
+import contextlib
+import gc
 import os
+import queue
+import regex
+import threading
+import time
+from collections import OrderedDict
+
+from datadm.batching import MAX_BATCH, BatchScheduler, GenerationRequest
+from datadm.llm_cache import response_cache
+from datadm.programs import program_cache
 
 
 # TODO: fix this to check devices and packages to dynamically adjust available LLMs and models
 try:
     import accelerate
-    local_available = True
+    cuda_available = True
+except ImportError:
+    cuda_available = False
+try:
+    import torch
+    cpu_available = bool(torch.backends.quantized.supported_engines)
 except ImportError:
-    local_available = False
+    cpu_available = False
+local_available = cuda_available or cpu_available
+
+KV_CACHE_BYTES = int(float(os.environ.get("DATADM_KV_CACHE_MB", "2048")) * 1024 * 1024)
+# token healing re-generates the last prompt token(s), so that end of the prompt is never taken from the cache
+HEALING_MARGIN = 8
+# memory for loaded local models, the least recently used ones are unloaded to fit a new one. gpu (cuda) and cpu models
+# are budgeted apart, unset is the total gpu memory and the machine's physical memory
+MODEL_MEMORY_BUDGET_MB = os.environ.get("DATADM_MODEL_MEMORY_BUDGET_MB")
+CPU_MODEL_MEMORY_BUDGET_MB = os.environ.get("DATADM_CPU_MODEL_MEMORY_BUDGET_MB")
+# loaded in the background at startup and selected by default
+PRELOAD_MODEL = os.environ.get("DATADM_PRELOAD_MODEL")
+# starchat's bf16 weights, until a loaded model has been measured
+STARCHAT_BYTES = 32 * 1024 ** 3
+# int8 linear layers and fp32 embeddings
+STARCHAT_INT8_BYTES = 18 * 1024 ** 3
+# threads for cpu inference, 0 leaves torch's default (one per core)
+CPU_THREADS = int(os.environ.get("DATADM_CPU_THREADS", "0"))
+
+
+def _token_ids(tokens):
+    return tokens.tolist() if hasattr(tokens, 'tolist') else list(tokens)
+
+
+def _shared_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _kv_tensors(past):
+    for layer in past:
+        yield from (layer if isinstance(layer, (tuple, list)) else [layer])
+
+
+def _trim_kv(past, n):
+    # the sequence is the second to last dimension in both layouts: (key, value) pairs of [batch, heads, seq, dim]
+    # and gpt_bigcode's (starcoder) fused [batch, seq, 2 * dim]. guidance's own trimming only knows the first one
+    return tuple(tuple(t[..., :n, :] for t in layer) if isinstance(layer, (tuple, list)) else layer[..., :n, :] for layer in past)
+
+
+class PrefixKVCache:
+    # past key/values of recent generations, shared by all sessions of a model. a new generation starts from the
+    # entry sharing the longest token prefix with its prompt (the system prompt for a new chat, the whole previous
+    # prompt + answer for the next turn of the same chat), the least recently used entries go above `max_bytes`
+    def __init__(self, max_bytes=KV_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (token ids, past key values, bytes)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.next_key = 0
+        self.last = None  # {'prompt_tokens', 'reused_tokens'} of the last generation
+        self.stats = {'requests': 0, 'reused_tokens': 0, 'prompt_tokens': 0}
+
+    def lookup(self, tokens):
+        # returns (token ids, past key values) of the longest cached prefix of `tokens`, or ([], None)
+        with self.lock:
+            best, best_len = None, 0
+            for key, (cached, _, _) in self.entries.items():
+                n = _shared_prefix(cached, tokens)
+                if n > best_len:
+                    best, best_len = key, n
+            if best is None:
+                return [], None
+            self.entries.move_to_end(best)
+            cached, past, _ = self.entries[best]
+        return cached[:best_len], _trim_kv(past, best_len)
+
+    def store(self, tokens, past):
+        if hasattr(past, 'to_legacy_cache'):
+            past = past.to_legacy_cache()
+        size = sum(t.nelement() * t.element_size() for t in _kv_tensors(past))
+        with self.lock:
+            # entries the new one extends are covered by it
+            for key in [k for k, (cached, _, _) in self.entries.items() if _shared_prefix(cached, tokens) == len(cached)]:
+                self.total_bytes -= self.entries.pop(key)[2]
+            self.entries[self.next_key] = (tokens, past, size)
+            self.next_key += 1
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self.entries:
+                self.total_bytes -= self.entries.popitem(last=False)[1][2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def record(self, prompt_tokens, reused_tokens):
+        self.last = {'prompt_tokens': prompt_tokens, 'reused_tokens': reused_tokens}
+        self.stats['requests'] += 1
+        self.stats['prompt_tokens'] += prompt_tokens
+        self.stats['reused_tokens'] += reused_tokens
+
+
+class PrefixCachedSession(TransformersSession):
+    # a guidance session (one per program run) that starts from, and adds to, its llm's `PrefixKVCache`
+    async def __call__(self, prompt, *args, **kwargs):
+        if self.llm.acceleration:
+            tokens = self.llm.encode(prompt)
+            usable = tokens[:len(tokens) - HEALING_MARGIN]
+            own = _token_ids(self._prefix_cache)
+            own_len = _shared_prefix(own, usable) if self._past_key_values is not None else 0
+            cached, past = self.llm.prefix_cache.lookup(usable)
+            if len(cached) > own_len:
+                self._prefix_cache, self._past_key_values = cached, past
+            elif own_len:
+                self._prefix_cache, self._past_key_values = own[:own_len], _trim_kv(self._past_key_values, own_len)
+            else:
+                self._prefix_cache, self._past_key_values = [], None
+            self.llm.prefix_cache.record(len(tokens), len(self._prefix_cache))
+        return await super().__call__(prompt, *args, **kwargs)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self._past_key_values is not None and len(self._prefix_cache):
+            self.llm.prefix_cache.store(_token_ids(self._prefix_cache), self._past_key_values)
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+class BatchedSession(PrefixCachedSession):
+    # generations go through the llm's `BatchScheduler` so concurrent sessions share forward passes. what the scheduler
+    # doesn't do (patterns, logprobs, logit biases, n > 1) is left to guidance
+    async def __call__(self, prompt, stop=None, stop_regex=None, temperature=None, n=1, max_tokens=1000, logprobs=None,
+                       top_p=1.0, echo=False, logit_bias=None, token_healing=None, pattern=None, stream=False,
+                       cache_seed=0, caching=None, **generate_kwargs):
+        if pattern is not None or logprobs is not None or logit_bias is not None or n != 1 \
+                or generate_kwargs.get("function_call", "none") != "none":
+            return await super().__call__(prompt, stop=stop, stop_regex=stop_regex, temperature=temperature, n=n,
+                                          max_tokens=max_tokens, logprobs=logprobs, top_p=top_p, echo=echo,
+                                          logit_bias=logit_bias, token_healing=token_healing, pattern=pattern,
+                                          stream=stream, cache_seed=cache_seed, caching=caching, **generate_kwargs)
+        # the same defaults and key as guidance's own generation, so both share the llm cache
+        if temperature is None:
+            temperature = self.llm.temperature
+        if token_healing is None:
+            token_healing = self.llm.token_healing
+        cache_params = self._cache_params({k: v for k, v in locals().items() if k != '__class__'})
+        key = self.llm.cache.create_key(self.llm.llm_name, **cache_params)
+        caching = caching is True or (caching is not False and self.llm.caching)
+        if caching and key in self.llm.cache:
+            return self.llm.cache[key]
+
+        if isinstance(stop, str):
+            stop = [stop]
+        if isinstance(stop_regex, str):
+            stop_regex = [stop_regex]
+        input_ids, processor, healed = self.llm.encode(prompt), None, ''
+        if token_healing:
+            healer = TokenHealingLogitsProcessor(self.llm, self.llm.model_obj.config.vocab_size, input_ids)
+            if healer.healed_token_ids:
+                # the healer only looks at the last token of the sequence, from the second generated token on
+                processor = lambda tokens, logits: healer([tokens], logits)
+                healed = self.llm.decode(healer.healed_token_ids)
+                input_ids = input_ids[:-len(healer.healed_token_ids)]
+                max_tokens += len(healer.healed_token_ids)
+        request = GenerationRequest(input_ids, max_tokens, temperature, stop or [],
+                                    (stop_regex or []) + [regex.escape(self.llm.tokenizer.eos_token)],
+                                    loop=asyncio.get_running_loop(), top_p=top_p, processor=processor, healed=healed)
+        self.llm.scheduler.submit(request)
+        chunks = self._chunks(request, key if caching else None)
+        if stream:
+            return chunks
+        text, finish_reason, stop_text = '', None, None
+        async for chunk in chunks:
+            text += chunk["choices"][0]["text"]
+            finish_reason, stop_text = chunk["choices"][0]["finish_reason"], chunk["choices"][0]["stop_text"]
+        return {"choices": [{"text": text, "finish_reason": finish_reason, "stop_text": stop_text}]}
+
+    async def _chunks(self, request, key):
+        # an async generator so waiting for tokens doesn't block the event loop, closing it cancels the request
+        out = []
+        try:
+            while True:
+                text, finish_reason, stop_text = await request.chunks.get()
+                if request.error is not None:
+                    raise request.error
+                chunk = {"choices": [{"text": text, "finish_reason": finish_reason, "stop_text": stop_text}]}
+                out.append(chunk)
+                yield chunk
+                if finish_reason is not None:
+                    break
+            if key is not None:
+                self.llm.cache[key] = out
+        finally:
+            request.cancel()
+
 
 class StarChat(guidance.llms.Transformers):
     def __init__(self, model_path=None, revision=None, **kwargs):
-        import torch
         tokenizer = AutoTokenizer.from_pretrained(model_path, device_map='auto', revision=revision)
-        model = AutoModelForCausalLM.from_pretrained(model_path, device_map='auto', torch_dtype=torch.bfloat16, revision=revision)
+        model = self.load_model(model_path, revision)
         model.eval()
         super().__init__(model, tokenizer=tokenizer, device_map='auto', **kwargs)
-    
+        # guidance names a model object after its class, this is part of the llm cache key
+        self.model_name = f"{model_path}@{revision}" if revision else model_path
+        self.prefix_cache = PrefixKVCache()
+        self.scheduler = BatchScheduler(model, tokenizer, MAX_BATCH, self.prefix_cache) if MAX_BATCH else None
+
+    def session(self, asynchronous=False):
+        session = BatchedSession(self) if self.scheduler is not None else PrefixCachedSession(self)
+        if asynchronous:
+            return session
+        return SyncSession(session)
+
+    @staticmethod
+    def load_model(model_path, revision=None):
+        import torch
+        return AutoModelForCausalLM.from_pretrained(model_path, device_map='auto', torch_dtype=torch.bfloat16, revision=revision)
+
+    def tokens_per_second(self):
+        return self.scheduler.tokens_per_second() if self.scheduler is not None else None
+
+    def footprint(self):
+        # bytes of weights and cached past key values
+        return self.model_obj.get_memory_footprint() + self.prefix_cache.total_bytes
+
+    def close(self):
+        # drops what keeps the model alive besides the llm itself: the scheduler thread and cached past key values
+        if self.scheduler is not None:
+            self.scheduler.close()
+        self.prefix_cache.clear()
+
     @staticmethod
     def role_start(role):
         return f"<|{role}|>"
@@ -27,41 +260,218 @@ class StarChat(guidance.llms.Transformers):
         return '<|end|>'
 
 
+class QuantizedStarChat(StarChat):
+    # starchat on cpu only: the linear layers get int8 weights and run as torch's dynamically quantized linears
+    # (multithreaded fbgemm / qnnpack int8 matmuls), the rest is fp32 since cpus lack fast bf16
+    @staticmethod
+    def load_model(model_path, revision=None):
+        import torch
+        if CPU_THREADS:
+            torch.set_num_threads(CPU_THREADS)
+        # loaded as bf16 and quantized one layer at a time, a whole fp32 copy would need twice the memory
+        model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True, revision=revision)
+        _quantize_linears(model)
+        return model.float()
+
+    def footprint(self):
+        # the int8 weights are packed outside of the parameters and buffers `get_memory_footprint` counts
+        return super().footprint() + _packed_bytes(self.model_obj)
+
+
+def _quantize_linears(module):
+    import torch
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear):
+            child.qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+            setattr(module, name, torch.ao.nn.quantized.dynamic.Linear.from_float(child.float()))
+        else:
+            _quantize_linears(child)
+
+
+def _packed_bytes(module):
+    import torch
+    total = 0
+    for child in module.modules():
+        if isinstance(child, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = child._packed_params._weight_bias()
+            tensors = [weight, bias]
+            if weight.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+                tensors += [weight.q_per_channel_scales(), weight.q_per_channel_zero_points()]
+            total += sum(t.nelement() * t.element_size() for t in tensors if t is not None)
+    return total
+
+
+CONTEXT_WINDOWS = {'gpt-3.5-turbo': 4096, 'gpt-4': 8192, 'gpt-3.5-turbo-16k': 16384, 'gpt-4-32k': 32768}
+
+
+def context_window(llm):
+    # tokens the model can attend to, prompt and generation together
+    if getattr(llm, 'model_name', None) in CONTEXT_WINDOWS:
+        return CONTEXT_WINDOWS[llm.model_name]
+    config = getattr(getattr(llm, 'model_obj', None), 'config', None)
+    for attr in ["max_sequence_length", "max_seq_len", "n_positions", "max_position_embeddings"]:
+        if getattr(config, attr, None):
+            return getattr(config, attr)
+    return 4096
+
+
+def _default_budgets():
+    # mode -> bytes its local models may take, None is unlimited
+    import torch
+    budgets = {'cuda': None, 'cpu': None}
+    if MODEL_MEMORY_BUDGET_MB:
+        budgets['cuda'] = int(float(MODEL_MEMORY_BUDGET_MB) * 1024 * 1024)
+    elif torch.cuda.is_available():
+        budgets['cuda'] = sum(torch.cuda.get_device_properties(i).total_memory for i in range(torch.cuda.device_count()))
+    if CPU_MODEL_MEMORY_BUDGET_MB:
+        budgets['cpu'] = int(float(CPU_MODEL_MEMORY_BUDGET_MB) * 1024 * 1024)
+    elif hasattr(os, 'sysconf'):
+        budgets['cpu'] = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    return budgets
+
+
 class BackendLLMManager():
+    # loads models on a background thread (`model_status` shows how it is going) and keeps the loaded local ones
+    # of each mode (cuda, cpu) under its budget by unloading the least recently used ones that are not generating.
+    # `budget_bytes` is {mode: bytes}, or the same bytes for every mode
     OPENAI_MODELS = ['gpt-3.5-turbo', 'gpt-4', 'gpt-3.5-turbo-16k', 'gpt-4-32k']
 
-    def __init__(self):
+    def __init__(self, budget_bytes=None):
         self.llms = {}
-        if local_available:
-            self.llms['starchat-alpha-cuda'] = {'state': 'unloaded', 'llm': None, 'mode': 'cuda', 'model_path': 'HuggingFaceH4/starchat-alpha', 'revision': '5058bd8557100137ade3c459bfc8100e90f71ec7'}
-            self.llms['starchat-beta-cuda'] = {'state': 'unloaded', 'llm': None, 'mode': 'cuda', 'model_path': 'HuggingFaceH4/starchat-beta', 'revision': 'b1bcda690655777373f57ea6614eb095ec2c886f'}
-        
+        if cuda_available:
+            self.llms['starchat-alpha-cuda'] = {'state': 'unloaded', 'llm': None, 'mode': 'cuda', 'model_path': 'HuggingFaceH4/starchat-alpha', 'revision': '5058bd8557100137ade3c459bfc8100e90f71ec7', 'footprint_bytes': STARCHAT_BYTES}
+            self.llms['starchat-beta-cuda'] = {'state': 'unloaded', 'llm': None, 'mode': 'cuda', 'model_path': 'HuggingFaceH4/starchat-beta', 'revision': 'b1bcda690655777373f57ea6614eb095ec2c886f', 'footprint_bytes': STARCHAT_BYTES}
+        if cpu_available:
+            self.llms['starchat-alpha-cpu'] = {'state': 'unloaded', 'llm': None, 'mode': 'cpu', 'model_path': 'HuggingFaceH4/starchat-alpha', 'revision': '5058bd8557100137ade3c459bfc8100e90f71ec7', 'footprint_bytes': STARCHAT_INT8_BYTES}
+            self.llms['starchat-beta-cpu'] = {'state': 'unloaded', 'llm': None, 'mode': 'cpu', 'model_path': 'HuggingFaceH4/starchat-beta', 'revision': 'b1bcda690655777373f57ea6614eb095ec2c886f', 'footprint_bytes': STARCHAT_INT8_BYTES}
+
         for model_name in self.OPENAI_MODELS:
-            self.llms[model_name] = {'state': 'unloaded', 'llm': None, 'mode': 'api'}
+            self.llms[model_name] = {'state': 'unloaded', 'llm': None, 'mode': 'api', 'footprint_bytes': 0}
+
+        for entry in self.llms.values():
+            entry.update(users=0, last_used=0, started=None, error=None)
+        if budget_bytes is None:
+            budget_bytes = _default_budgets()
+        elif not isinstance(budget_bytes, dict):
+            budget_bytes = {'cuda': budget_bytes, 'cpu': budget_bytes}
+        self.budget_bytes = budget_bytes
+        self.default_model = PRELOAD_MODEL if PRELOAD_MODEL in self.llms else list(self.llms.keys())[0]
+        self.lock = threading.RLock()
+        self.queue = queue.Queue()
+        self.thread = None
 
     def load(self, llm_name):
-        if self.llms[llm_name]['state'] == 'unloaded':
-            self.llms[llm_name]['state'] = 'loading'
-            if llm_name in ['starchat-alpha-cuda', 'starchat-beta-cuda']:
-                self.llms[llm_name]['llm'] = StarChat(**self.llms[llm_name])
-            elif llm_name in self.OPENAI_MODELS:
-                if 'OPENAI_API_KEY' not in os.environ:
-                    self.llms[llm_name]['state'] = 'error'
-                    raise RuntimeError("OPENAI_API_KEY not found in environment")
-                self.llms[llm_name]['llm'] = guidance.llms.OpenAI(llm_name)
-            else:
-                self.llms[llm_name]['state'] = 'error'
-                raise RuntimeError(f"LLM {llm_name} not supported")
-            self.llms[llm_name]['state'] = 'ready'
+        with self.lock:
+            if self.llms[llm_name]['state'] in ['unloaded', 'error']:
+                self.llms[llm_name].update(state='queued', error=None)
+                self.queue.put(llm_name)
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, daemon=True)
+                    self.thread.start()
         return self.model_status(llm_name)
-    
+
+    def preload(self):
+        if PRELOAD_MODEL and PRELOAD_MODEL not in self.llms:
+            print(f"DATADM_PRELOAD_MODEL {PRELOAD_MODEL} is not one of {list(self.llms.keys())}")
+        elif PRELOAD_MODEL:
+            self.load(PRELOAD_MODEL)
+
+    def _run(self):
+        while True:
+            self._load(self.queue.get())
+
+    def _load(self, llm_name):
+        entry = self.llms[llm_name]
+        entry.update(state='loading', started=time.time())
+        try:
+            self._make_room(llm_name)
+            llm = self._create(llm_name)
+            llm.cache = response_cache
+        except Exception as e:
+            print(f"Failed to load {llm_name}: {e}")
+            entry.update(state='error', error=str(e))
+            return
+        with self.lock:
+            entry.update(state='ready', llm=llm, last_used=time.time())
+            if hasattr(llm, 'footprint'):
+                entry['footprint_bytes'] = llm.footprint()
+        self._make_room(llm_name)
+
+    def _create(self, llm_name):
+        entry = self.llms[llm_name]
+        if entry['mode'] == 'cuda':
+            return StarChat(entry['model_path'], revision=entry['revision'])
+        elif entry['mode'] == 'cpu':
+            return QuantizedStarChat(entry['model_path'], revision=entry['revision'])
+        elif entry['mode'] == 'api':
+            if 'OPENAI_API_KEY' not in os.environ:
+                raise RuntimeError("OPENAI_API_KEY not found in environment")
+            return guidance.llms.OpenAI(llm_name)
+        raise RuntimeError(f"LLM {llm_name} not supported")
+
+    def _make_room(self, llm_name):
+        # unloads the least recently used idle local models of the same mode until `llm_name` fits in that mode's budget
+        mode = self.llms[llm_name]['mode']
+        budget = self.budget_bytes.get(mode)
+        if budget is None:
+            return
+        with self.lock:
+            resident = [name for name, entry in self.llms.items() if name != llm_name and entry['mode'] == mode and entry['state'] == 'ready']
+            total = self.llms[llm_name]['footprint_bytes'] + sum(self.llms[name]['footprint_bytes'] for name in resident)
+            for name in sorted(resident, key=lambda name: self.llms[name]['last_used']):
+                if total <= budget:
+                    break
+                if not self.llms[name]['users']:
+                    total -= self.llms[name]['footprint_bytes']
+                    self.unload(name)
+        if total > budget:
+            print(f"{mode} models in use take {total / 1024 ** 3:.1f}GB with {llm_name}, over the {budget / 1024 ** 3:.1f}GB budget")
+
+    @contextlib.contextmanager
+    def use(self, llm_name):
+        # the loaded llm, or None. it isn't unloaded to make room for another model until the block ends
+        with self.lock:
+            entry = self.llms.get(llm_name, {})
+            llm = entry.get('llm')
+            if llm is not None:
+                entry['users'] += 1
+                entry['last_used'] = time.time()
+        try:
+            yield llm
+        finally:
+            if llm is not None:
+                with self.lock:
+                    entry['users'] -= 1
+                    entry['last_used'] = time.time()
+
     def unload(self, llm_name):
         if llm_name in self.llms:
-            self.llms[llm_name]['state'] = 'unloaded'
-            self.llms[llm_name]['llm'] = None
+            with self.lock:
+                llm = self.llms[llm_name]['llm']
+                self.llms[llm_name]['state'] = 'unloaded'
+                self.llms[llm_name]['llm'] = None
+            if llm is None:
+                return
+            if hasattr(llm, 'close'):
+                llm.close()
+            program_cache.discard(llm)
+            del llm
+            gc.collect()
+            if self.llms[llm_name]['mode'] == 'cuda':
+                import torch
+                torch.cuda.empty_cache()
 
     def model_status(self, llm_name):
-        state = self.llms[llm_name]['state']
+        entry = self.llms[llm_name]
+        state = entry['state']
+        if state == 'loading':
+            return [(f"{llm_name} ({time.time() - entry['started']:.0f}s)", state)]
+        if state == 'error':
+            return [(f"{llm_name}: {entry['error']}", state)]
+        if state == 'ready' and entry['mode'] != 'api':
+            tokens_per_second = entry['llm'].tokens_per_second() if hasattr(entry['llm'], 'tokens_per_second') else None
+            speed = f", {tokens_per_second:.1f} tokens/s" if tokens_per_second else ""
+            return [(f"{llm_name} ({entry['footprint_bytes'] / 1024 ** 3:.1f}GB{speed})", state)]
         return [(llm_name, state)]
 
 
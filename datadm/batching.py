@@ -0,0 +1,256 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+import regex
+import torch
+
+# concurrent generations decoded together by a local model, 0 runs each one on its own through guidance
+MAX_BATCH = int(os.environ.get("DATADM_MAX_BATCH", "8"))
+
+
+def _legacy(past):
+    return past.to_legacy_cache() if hasattr(past, 'to_legacy_cache') else past
+
+
+def _map_kv(past, fn):
+    # (key, value) pairs of [batch, heads, seq, dim] or gpt_bigcode's (starcoder) fused [batch, seq, 2 * dim] per layer
+    return tuple(tuple(fn(t) for t in layer) if isinstance(layer, (tuple, list)) else fn(layer) for layer in past)
+
+
+def _cat_kv(pasts):
+    layers = []
+    for layer in zip(*pasts):
+        if isinstance(layer[0], (tuple, list)):
+            layers.append(tuple(torch.cat(ts) for ts in zip(*layer)))
+        else:
+            layers.append(torch.cat(layer))
+    return tuple(layers)
+
+
+class GenerationRequest:
+    # one generation run by a `BatchScheduler`. tokens are decoded and checked against the stops on the scheduler
+    # thread, text is handed to `chunks` on the event loop that submitted the request as (text, finish_reason, stop_text)
+    # `processor(tokens, logits)` adjusts the logits of each step given the tokens generated so far (eg. guidance's
+    # token healing, which regenerates the end of the prompt: `healed` is that text, it is not part of the output)
+    def __init__(self, input_ids, max_tokens, temperature=0.0, stop=(), stop_regex=(), loop=None, top_p=1.0,
+                 processor=None, healed=''):
+        self.input_ids = list(input_ids)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.processor = processor
+        self.healed = healed
+        self.stop_regex = [regex.compile(r) for r in list(stop_regex) + [regex.escape(s) for s in stop if s]]
+        self.loop = loop
+        self.chunks = asyncio.Queue() if loop is not None else None
+        self.done = threading.Event()
+        self.tokens = []
+        self.text = ''
+        self.sent = 0  # characters of `text` handed out
+        self.length = 0  # tokens in the past key values
+        self.past = None  # past key values from the prompt, until the request joins the batch
+        self.next_token = None
+        self.finish_reason = None
+        self.stop_text = None
+        self.error = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _emit(self, item):
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.chunks.put_nowait, item)
+            except RuntimeError:  # the loop is gone, so is whoever was reading
+                self.cancelled = True
+
+    def feed(self, token, tokenizer=None, eos_token_id=None):
+        self.tokens.append(token)
+        self.next_token = token
+        if tokenizer is not None:
+            self.text = tokenizer.decode(self.tokens)[len(self.healed):]
+        # hold back an incomplete utf-8 character and anything that could still turn into a stop
+        safe = len(self.text) - 1 if self.text.endswith('�') else len(self.text)
+        stop = None
+        for pattern in self.stop_regex:
+            m = pattern.search(self.text, self.sent, partial=True)
+            if m is None:
+                continue
+            if m.partial:
+                safe = min(safe, m.start())
+            elif stop is None or m.start() < stop.start():
+                stop = m
+        if stop is not None:
+            self.text, self.stop_text = self.text[:stop.start()], stop.group()
+            self.finish('stop')
+        elif token == eos_token_id:
+            self.finish('stop')
+        elif len(self.tokens) >= self.max_tokens:
+            self.finish('length')
+        elif safe > self.sent:
+            self._emit((self.text[self.sent:safe], None, None))
+            self.sent = safe
+
+    def finish(self, reason, error=None):
+        if self.done.is_set():
+            return
+        self.finish_reason, self.error = reason, error
+        self._emit((self.text[self.sent:], reason, self.stop_text))
+        self.sent = len(self.text)
+        self.done.set()
+
+    def result(self, timeout=None):
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+
+class BatchScheduler:
+    # continuous batching for a local model shared by all sessions: every forward pass decodes one token for each
+    # running request. a request joins the batch as soon as its prompt has been processed and leaves when it stops, so
+    # a long generation doesn't hold back the others. prompts start from `prefix_cache` and finished generations are
+    # added to it
+    def __init__(self, model, tokenizer=None, max_batch=MAX_BATCH, prefix_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.prefix_cache = prefix_cache
+        self.eos_token_id = tokenizer.eos_token_id if tokenizer is not None else model.config.eos_token_id
+        self.waiting = deque()
+        self.active = []
+        self.batch = None  # (requests, padded past key values, attention mask) of the last forward pass
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.stats = {'requests': 0, 'tokens': 0, 'steps': 0, 'seconds': 0.0}  # seconds spent in forward passes
+
+    def submit(self, request):
+        with self.cond:
+            if self.closed:
+                request.finish('error', RuntimeError("The model was unloaded"))
+                return request
+            self.waiting.append(request)
+            self.stats['requests'] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return request
+
+    def tokens_per_second(self):
+        # generated tokens of all requests over the time spent in forward passes, prompts included
+        return self.stats['tokens'] / self.stats['seconds'] if self.stats['seconds'] else None
+
+    def close(self):
+        # cancels everything and stops the thread, so the model can be freed
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.waiting and not self.active and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    for request in list(self.waiting) + self.active:
+                        request.finish('error', RuntimeError("The model was unloaded"))
+                    self.waiting.clear()
+                    self.active, self.batch, self.model = [], None, None
+                    return
+                admitted = []
+                while self.waiting and len(self.active) + len(admitted) < self.max_batch:
+                    admitted.append(self.waiting.popleft())
+            start = time.perf_counter()
+            with torch.no_grad():
+                for request in admitted:
+                    try:
+                        self._prefill(request)
+                    except Exception as e:
+                        request.finish('error', e)
+                self._retire()
+                if self.active:
+                    try:
+                        self._step()
+                    except Exception as e:
+                        for request in self.active:
+                            request.finish('error', e)
+                        self.batch = None
+                    self._retire()
+            self.stats['seconds'] += time.perf_counter() - start
+
+    def _sample(self, request, logits):
+        if request.processor is not None:
+            logits = request.processor(request.tokens, logits)
+        if not request.temperature:
+            return int(logits.argmax())
+        probs = torch.softmax(logits.float() / request.temperature, dim=-1)
+        if request.top_p < 1.0:
+            # nucleus sampling: the most likely tokens that together make up `top_p`, the first one always included
+            probs, order = probs.sort(descending=True)
+            probs[probs.cumsum(-1) - probs > request.top_p] = 0
+            return int(order[torch.multinomial(probs, 1)])
+        return int(torch.multinomial(probs, 1))
+
+    def _prefill(self, request):
+        if request.cancelled:
+            request.finish('cancelled')
+            return
+        ids = request.input_ids
+        cached, past = self.prefix_cache.lookup(ids[:-1]) if self.prefix_cache is not None else ([], None)
+        n = len(cached)
+        if self.prefix_cache is not None:
+            self.prefix_cache.record(len(ids), n)
+        out = self.model(input_ids=torch.tensor([ids[n:]], device=self.model.device), past_key_values=past,
+                         position_ids=torch.arange(n, len(ids), device=self.model.device)[None], use_cache=True)
+        request.past, request.length = _legacy(out.past_key_values), len(ids)
+        self.stats['tokens'] += 1
+        request.feed(self._sample(request, out.logits[0, -1]), self.tokenizer, self.eos_token_id)
+        self.active.append(request)
+
+    def _own_kv(self, request):
+        # the request's past key values without the batch's left padding
+        if request.past is not None:
+            return request.past
+        requests, past, mask = self.batch
+        i = requests.index(request)
+        pad = mask.shape[1] - request.length
+        return _map_kv(past, lambda t: t[i:i + 1, ..., pad:, :])
+
+    def _build(self, requests):
+        # left pads every request's past key values to the longest one, padding is masked out of the attention
+        longest = max(r.length for r in requests)
+        pasts = [_map_kv(self._own_kv(r), lambda t, r=r: torch.nn.functional.pad(t, (0, 0, longest - r.length, 0))) for r in requests]
+        mask = torch.tensor([[0] * (longest - r.length) + [1] * r.length for r in requests], device=self.model.device)
+        self.batch = (list(requests), _cat_kv(pasts), mask)
+        for r in requests:
+            r.past = None
+
+    def _step(self):
+        requests = list(self.active)
+        if self.batch is None or self.batch[0] != requests:
+            self._build(requests)
+        _, past, mask = self.batch
+        mask = torch.cat([mask, mask.new_ones((len(requests), 1))], dim=1)
+        out = self.model(input_ids=torch.tensor([[r.next_token] for r in requests], device=self.model.device),
+                         past_key_values=past, attention_mask=mask,
+                         position_ids=torch.tensor([[r.length] for r in requests], device=self.model.device), use_cache=True)
+        self.batch = (requests, _legacy(out.past_key_values), mask)
+        self.stats['steps'] += 1
+        self.stats['tokens'] += len(requests)
+        for i, r in enumerate(requests):
+            r.length += 1
+            r.feed(self._sample(r, out.logits[i, -1]), self.tokenizer, self.eos_token_id)
+
+    def _retire(self):
+        for r in [r for r in self.active if r.cancelled or r.done.is_set()]:
+            if r.error is None and self.prefix_cache is not None:
+                tokens = (r.input_ids + r.tokens)[:r.length]
+                self.prefix_cache.store(tokens, _map_kv(self._own_kv(r), lambda t: t.clone()))
+            r.finish('cancelled')
+            self.active.remove(r)
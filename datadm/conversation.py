@@ -1,13 +1,11 @@
-import atexit
-import tempfile
-import base64
-import hashlib
 import os
 import re
+import threading
+import weakref
+from collections import OrderedDict
 
-temp_image_dir = tempfile.TemporaryDirectory()
-atexit.register(temp_image_dir.cleanup)
-
+from datadm.backend import context_window
+from datadm.images import image_store
 
 # TODO: Replace the entire concept of conversation with the actual REPL kernel object
 #   the conversation can be stored as messages to the kernel (eg. markdown messages)
@@ -19,80 +17,259 @@ def strip_ansi(text):
     return ansi_escape.sub('', text)
 
 
-def conversation_list_to_history(convo_list):
-    # assuming this is a conversation between user and assistant, return a list of list of [user, assistant] messages
-    # if someone speaks out of turn, put [None, text] for assistant or [text, None] for user
-    # [{'role': 'user', 'content': 'hello'}, {'role': 'assistant', 'content': 'hi'}] -> [['hello', 'hi']]
-    # [{'role': 'user', 'content': 'hi'}, {'role': 'user', 'content': ' HEY! '}, {'role': 'assisstant', 'content': ' what do yo'}] -> [['hi', None], [' HEY! ', ' what do yo']]
-    history = []
-    for item in convo_list:
-        if item['role'] == 'user':
-            # this always causes a new entry
-            history.append([item['content'], None])
-        elif item['role'] == 'assistant':
-            # this either appends to the last entry, or creates a new entry
-            if len(history) == 0 or history[-1][1] is not None:
-                history.append([None, item['content']])
-            else:
-                history[-1][1] = item['content']
-    # for all history, check if any are not strings, and conver them to valid history objects
-    new_history = []
-    for i, c in enumerate(history):
-        images_to_append = []
-        new_row = []
-        for j, val in enumerate(c):
-            new_text = val
-            new_html_text = ""
-            if not isinstance(val, str) and val is not None:
-                new_text = ""
-                if val['stdout']:
-                    new_text += val['stdout']
-                if val['tracebacks']:
-                    new_text += strip_ansi(val['tracebacks'])
-                if val['data']:
-                    for dataentry in val['data']:
-                        for k, v in dataentry.items():
-                            if 'text' in k:
-                                if 'html' in k:
-                                    new_html_text += v
-                                else:
-                                    new_text += v
-                            else:
-                                # assume this is a file, written in base64... convert to bytes, save to determinstiic temporary file path, and replace with that path
-                                filename = hashlib.sha256(v.encode('utf-8')).hexdigest()+'.png'
-                                file_path = os.path.join(temp_image_dir.name, filename)
-                                with open(file_path, 'wb') as f:
-                                    f.write(base64.b64decode(v))
-                                images_to_append += [file_path]
-                if new_text:
-                    new_text = f'```bash\n{new_text}\n```'
-                new_text += new_html_text
-            if new_text:
-                new_row.append(new_text)
-            else:
-                new_row.append(None)
-        new_history.append(new_row)
-        if images_to_append:
+def _render_output(val):
+    # exec output -> (markdown text or None, [image paths])
+    new_text = ""
+    new_html_text = ""
+    images = []
+    if val['stdout']:
+        new_text += val['stdout']
+    if val['tracebacks']:
+        new_text += strip_ansi(val['tracebacks'])
+    if val['data']:
+        for dataentry in val['data']:
+            for k, v in dataentry.items():
+                if 'text' in k:
+                    if 'html' in k:
+                        new_html_text += v
+                    else:
+                        new_text += v
+                else:
+                    # assume this is a file, written in base64, stored once per content and replaced with its path
+                    images.append(image_store.path(v))
+    if new_text:
+        new_text = f'```bash\n{new_text}\n```'
+    new_text += new_html_text
+    return new_text or None, images
+
+
+def _images_exist(images):
+    return all(os.path.exists(path) for path in images)
+
+
+class ConversationRenderer:
+    # remembers rendered exec outputs, so re-rendering a streamed conversation only formats the entries that changed
+    def __init__(self, max_entries=1024, max_streams=256):
+        self.max_entries = max_entries
+        self.max_streams = max_streams
+        self.cache = OrderedDict()  # id(output) -> (output, signature, rendered)
+        self.streams = OrderedDict()  # id(first message) -> ([(role, content)], rows, [(user message, row)]) of its last render
+        self.lock = threading.Lock()  # shared by every session's handler thread
+
+    def render_output(self, val):
+        # the outputs a conversation holds are not changed once rendered, the signature catches it if they are.
+        # images the store evicted since are written again by rendering anew
+        signature = (len(val['stdout']), len(val['tracebacks']), len(val['data']))
+        evictions = image_store.stats['evictions']
+        with self.lock:
+            cached = self.cache.get(id(val))
+            if (cached is not None and cached[0] is val and cached[1] == signature
+                    and (cached[3] == evictions or _images_exist(cached[2][1]))):
+                self.cache.move_to_end(id(val))
+                return cached[2]
+        rendered = _render_output(val)
+        with self.lock:
+            self.cache[id(val)] = (val, signature, rendered, evictions)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return rendered
+
+    def _render(self, convo_list):
+        # returns the rendered rows, and the row each user message starts
+        # assuming this is a conversation between user and assistant, return a list of list of [user, assistant] messages
+        # if someone speaks out of turn, put [None, text] for assistant or [text, None] for user
+        # [{'role': 'user', 'content': 'hello'}, {'role': 'assistant', 'content': 'hi'}] -> [['hello', 'hi']]
+        # [{'role': 'user', 'content': 'hi'}, {'role': 'user', 'content': ' HEY! '}, {'role': 'assisstant', 'content': ' what do yo'}] -> [['hi', None], [' HEY! ', ' what do yo']]
+        history = []
+        user_rows = {}  # entry index -> index in history
+        for i, item in enumerate(convo_list):
+            if item['role'] == 'user':
+                # this always causes a new entry
+                user_rows[i] = len(history)
+                history.append([item['content'], None])
+            elif item['role'] == 'assistant':
+                # this either appends to the last entry, or creates a new entry
+                if len(history) == 0 or history[-1][1] is not None:
+                    history.append([None, item['content']])
+                else:
+                    history[-1][1] = item['content']
+        # for all history, check if any are not strings, and conver them to valid history objects
+        new_history = []
+        rendered_rows = {}  # index in history -> index in new_history
+        for i, c in enumerate(history):
+            rendered_rows[i] = len(new_history)
+            images_to_append = []
+            new_row = []
+            for val in c:
+                if not isinstance(val, str) and val is not None:
+                    val, images = self.render_output(val)
+                    images_to_append += images
+                new_row.append(val or None)
+            new_history.append(new_row)
             for image_file in images_to_append:
                 new_history.append([None, (image_file,)])
-    return new_history
+        return new_history, [(i, rendered_rows[row]) for i, row in user_rows.items()]
+
+    def render(self, convo_list):
+        # while a response streams in, the conversation only grows (or changes) at the end. the rows before the last
+        # user message it shares with the previous render can't change, so they are reused and only the rest is rendered
+        if not convo_list:
+            return []
+        key = id(convo_list[0])
+        evictions = image_store.stats['evictions']
+        with self.lock:
+            previous = self.streams.get(key)
+        if previous is not None and previous[3] != evictions:
+            if not _images_exist(row[1][0] for row in previous[1] if isinstance(row[1], tuple)):
+                previous = None
+        # (role, content) pairs rather than the messages, so a message edited in place doesn't compare equal to itself
+        entries = [(item['role'], item['content']) for item in convo_list]
+        start, rows, user_rows = 0, [], []
+        if previous is not None:
+            previous_entries, previous_rows, previous_user_rows, _ = previous
+            # list equality checks identity first, so comparing a shared prefix runs at C speed
+            for j in reversed(range(len(previous_user_rows))):
+                entry, row = previous_user_rows[j]
+                if entry < len(entries) and previous_entries[:entry + 1] == entries[:entry + 1]:
+                    start, rows, user_rows = entry, previous_rows[:row], previous_user_rows[:j]
+                    break
+        tail, tail_user_rows = self._render(convo_list[start:])
+        rows = rows + tail
+        user_rows = user_rows + [(start + i, len(rows) - len(tail) + row) for i, row in tail_user_rows]
+        with self.lock:
+            self.streams[key] = (entries, rows, user_rows, evictions)
+            self.streams.move_to_end(key)
+            while len(self.streams) > self.max_streams:
+                self.streams.popitem(last=False)
+        return list(rows)  # the rows themselves are shared with later renders, they must not be changed in place
+
+
+renderer = ConversationRenderer()
+
+
+def conversation_list_to_history(convo_list):
+    return renderer.render(convo_list)
+
+# prompt budget: the model's context window minus what the prompt template and the generated answer need
+RESERVED_TOKENS = int(os.environ.get("DATADM_RESERVED_PROMPT_TOKENS", "1500"))
+MAX_OUTPUT_CHARS = 2000  # per exec output, tables included
+OLD_OUTPUT_CHARS = 200  # exec outputs before the last `RECENT_TURNS` user turns
+RECENT_TURNS = 2
+PROFILE_COLUMNS = 40  # per frame, wider frames list their first columns
+
 
-def clean_conversation_list(convo_list):
+def _truncate(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    half = max_chars // 2
+    return f"{text[:half]}\n... ({len(text) - 2 * half} characters elided) ...\n{text[-half:]}"
+
+
+def _clean_output(content, max_chars=None):
+    # without `max_chars` (prompts not fitted to a model) the output is kept whole, html tables included
+    new_html_text = ""
+    new_text = ""
+    if content['stdout']:
+        new_text += content['stdout']
+    if content['tracebacks']:
+        new_text += content['tracebacks'][:400]
+    if content['data']:
+        new_text += "\n".join([v for dataentry in content['data'] for k, v in dataentry.items() if 'text' in k and 'html' not in k])
+        # an html table says the same as its text/plain version, in many more tokens
+        new_html_text += "\n".join([v for dataentry in content['data'] for k, v in dataentry.items()
+                                    if 'html' in k and (max_chars is None or 'text/plain' not in dataentry)])
+    if max_chars is not None:
+        new_text, new_html_text = _truncate(new_text, max_chars), _truncate(new_html_text, max_chars)
+    return 'EXECUTION OF LAST CODE BLOCK RESULT: ' + (f'```\n{new_text}\n```' if new_text else '' )+new_html_text
+
+
+# llm -> {text: token count} of the most recently counted texts. weakly keyed, so an unloaded llm isn't kept alive
+_token_counts = weakref.WeakKeyDictionary()
+_token_counts_lock = threading.Lock()
+TOKEN_COUNTS_PER_LLM = 8192
+
+
+def count_tokens(llm, text):
+    if llm is None or not hasattr(llm, 'encode'):
+        return len(text) // 4  # rough, for models without a tokenizer
+    with _token_counts_lock:
+        counts = _token_counts.setdefault(llm, OrderedDict())
+        if text in counts:
+            counts.move_to_end(text)
+            return counts[text]
+    n = len(llm.encode(text))
+    with _token_counts_lock:
+        counts[text] = n
+        while len(counts) > TOKEN_COUNTS_PER_LLM:
+            counts.popitem(last=False)
+    return n
+
+
+def format_profiles(profiles):
+    # frames from `REPL.profile_dataframes`, as a compact schema the model can write code against
+    lines = ['DATAFRAMES IN MEMORY (column: dtype, nulls, unique values):']
+    for frame in profiles:
+        sampled = ' (unique values counted on a sample)' if frame['sampled'] else ''
+        lines.append(f"{frame['name']}: {frame['type']}, {frame['rows']} rows x {len(frame['columns'])} columns{sampled}")
+        for column in frame['columns'][:PROFILE_COLUMNS]:
+            unique = '?' if column['unique'] is None else column['unique']
+            lines.append(f"  {column['name']}: {column['dtype']}, {column['nulls']}, {unique}")
+        if len(frame['columns']) > PROFILE_COLUMNS:
+            lines.append(f"  ... ({len(frame['columns']) - PROFILE_COLUMNS} more columns)")
+    return _truncate('\n'.join(lines), MAX_OUTPUT_CHARS)
+
+
+def clean_conversation_list(convo_list, llm=None, window=None, profiles=None):
     # for any "content" that is not a string, convert / replace it with something simple
     # assume that they are the output from `exec`, so they should have 3 keys, `stdout`, `tracebacks`, and `data`
+    # with an llm, the result fits its context window: the last turns are kept, older exec outputs are shortened and
+    # if that is not enough the oldest messages are dropped. returns the messages and their token counts (None without
+    # an llm), which the agents record on the response the prompt was built for
+    # `profiles` (see `REPL.profile_dataframes`) are added as the last message, so the model knows the current frames
+    # without printing them first. being last, they don't change the prompt prefix earlier turns share
+    user_turns = [i for i, convo in enumerate(convo_list) if convo['role'] == 'user']
+    recent = user_turns[-RECENT_TURNS] if len(user_turns) >= RECENT_TURNS else 0
     cleaned = []
-    for convo in convo_list:
+    for i, convo in enumerate(convo_list):
         if isinstance(convo['content'], str) or convo['content'] is None:
-            cleaned.append(convo)
+            cleaned.append({'role': convo['role'], 'content': convo['content']})
             continue
-        new_html_text = ""
-        new_text = ""
-        if convo['content']['stdout']:
-            new_text += convo['content']['stdout']
-        if convo['content']['tracebacks']:
-            new_text += convo['content']['tracebacks'][:400]
-        if convo['content']['data']:
-            new_text += "\n".join([v for dataentry in convo['content']['data'] for k, v in dataentry.items() if 'text' in k and 'html' not in k])
-            new_html_text += "\n".join([v for dataentry in convo['content']['data'] for k, v in dataentry.items() if 'html' in k])
-        cleaned.append({'role': convo['role'], 'content': 'EXECUTION OF LAST CODE BLOCK RESULT: ' + (f'```\n{new_text}\n```' if new_text else '' )+new_html_text})
-    return cleaned
+        max_chars = None if llm is None else MAX_OUTPUT_CHARS if i >= recent else OLD_OUTPUT_CHARS
+        cleaned.append({'role': convo['role'], 'content': _clean_output(convo['content'], max_chars)})
+    if profiles:
+        cleaned.append({'role': 'user', 'content': format_profiles(profiles)})
+    if llm is None:
+        return cleaned, None
+
+    window = window or context_window(llm)
+    budget = window - RESERVED_TOKENS
+    tokens = [count_tokens(llm, convo['content'] or '') for convo in cleaned]
+    dropped = 0
+    keep = 2 if profiles else 1
+    while sum(tokens) > budget and len(cleaned) > keep:
+        cleaned.pop(0)
+        tokens.pop(0)
+        dropped += 1
+    return cleaned, {'tokens': sum(tokens), 'window': window, 'messages': len(cleaned), 'dropped': dropped}
+
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            return f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TB"
+
+
+def format_memory_report(frames):
+    # whos-style table, frames come from `REPL.memory_usage` or `REPL.optimize_memory` (which also has before/after)
+    rows = [['Variable', 'Type', 'Rows', 'Cols', 'Memory']]
+    for frame in frames:
+        memory = format_bytes(frame['after']) if 'after' in frame else format_bytes(frame['bytes'])
+        if 'before' in frame:
+            memory = f"{format_bytes(frame['before'])} -> {memory}"
+        rows.append([frame['name'], frame['type'], str(frame['rows']), str(len(frame['columns'])), memory])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ['   '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+    lines.insert(1, '-' * len(lines[0]))
+    return '\n'.join(lines)
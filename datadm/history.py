@@ -0,0 +1,144 @@
+import hashlib
+import os
+from collections import OrderedDict
+from collections.abc import MutableSequence
+
+# outputs larger than this (plots, html tables, long prints) are stored once per content hash on disk
+BLOB_MIN_BYTES = 1024
+MEMORY_BYTES = int(float(os.environ.get("DATADM_HISTORY_MEMORY_MB", "16")) * 1024 * 1024)
+# keeps the raw iopub messages of every cell, only useful for debugging
+KEEP_RAW = os.environ.get("DATADM_HISTORY_RAW", "0") == "1"
+
+
+class BlobStore:
+    # content addressed strings on disk, with an LRU of recently used ones in memory
+    def __init__(self, path, memory_bytes=MEMORY_BYTES):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.disk_bytes = 0
+        self.stored = 0
+        self.deduplicated = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def _cache(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        self.cached_bytes += len(value)
+        while self.cached_bytes > self.memory_bytes and len(self.cache) > 1:
+            self.cached_bytes -= len(self.cache.popitem(last=False)[1])
+
+    def put(self, value):
+        data = value.encode('utf-8')
+        key = hashlib.sha256(data).hexdigest()
+        if os.path.exists(self._file(key)):
+            self.deduplicated += 1
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file(key) + '.partial', 'wb') as f:
+                f.write(data)
+            os.replace(self._file(key) + '.partial', self._file(key))
+            self.disk_bytes += len(data)
+            self.stored += 1
+        return key
+
+    def get(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        try:
+            with open(self._file(key), 'rb') as f:
+                value = f.read().decode('utf-8')
+        except OSError:
+            return None  # the session's work dir is gone
+        self._cache(key, value)
+        return value
+
+
+class Blob:
+    # stands in for a big output value in `History`, a type of its own so no output value can be mistaken for one
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return isinstance(other, Blob) and other.key == self.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"Blob({self.key!r})"
+
+
+class History(MutableSequence):
+    # REPL.history: one {'code', 'output'} dict per executed cell, with big output values replaced by a `Blob`.
+    # every way of adding cells (append, insert, extend, +=, item and slice assignment) goes through `_compact_cell`
+    def __init__(self, path, keep_raw=KEEP_RAW):
+        self.cells = []
+        self.blobs = BlobStore(path)
+        self.keep_raw = keep_raw
+
+    def _compact(self, value):
+        if isinstance(value, str) and len(value) >= BLOB_MIN_BYTES:
+            return Blob(self.blobs.put(value))
+        return value
+
+    def _expand(self, value):
+        return self.blobs.get(value.key) if isinstance(value, Blob) else value
+
+    def _compact_cell(self, cell):
+        output = cell['output']
+        compact = {
+            **cell,
+            'output': {
+                'stdout': self._compact(output['stdout']),
+                'tracebacks': self._compact(output['tracebacks']),
+                'data': [{k: self._compact(v) for k, v in entry.items()} for entry in output['data']],
+            },
+        }
+        if not self.keep_raw:
+            compact.pop('results', None)
+        return compact
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __getitem__(self, i):
+        return self.cells[i]
+
+    def __setitem__(self, i, cell):
+        self.cells[i] = [self._compact_cell(c) for c in cell] if isinstance(i, slice) else self._compact_cell(cell)
+
+    def __delitem__(self, i):
+        del self.cells[i]
+
+    def insert(self, i, cell):
+        self.cells.insert(i, self._compact_cell(cell))
+
+    def output(self, i):
+        # the full output of cell `i`, as `REPL.exec` returned it
+        output = self[i]['output']
+        return {
+            'stdout': self._expand(output['stdout']),
+            'tracebacks': self._expand(output['tracebacks']),
+            'data': [{k: self._expand(v) for k, v in entry.items()} for entry in output['data']],
+        }
+
+    def size(self):
+        inline = 0
+        for cell in self:
+            output = cell['output']
+            values = [cell['code'], output['stdout'], output['tracebacks']] + [v for entry in output['data'] for v in entry.values()]
+            inline += sum(len(v) for v in values if isinstance(v, str))
+        return {
+            'cells': len(self),
+            'memory_bytes': inline + self.blobs.cached_bytes,
+            'disk_bytes': self.blobs.disk_bytes,
+            'blobs': self.blobs.stored,
+            'deduplicated': self.blobs.deduplicated,
+        }
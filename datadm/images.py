@@ -0,0 +1,98 @@
+import atexit
+import base64
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:  # images are stored as they come
+    Image = None
+
+MAX_BYTES = int(float(os.environ.get("DATADM_IMAGE_STORE_MB", "256")) * 1024 * 1024)
+# wider plots are scaled down for display, 0 keeps them as they are
+MAX_WIDTH = int(os.environ.get("DATADM_IMAGE_MAX_WIDTH", "1600"))
+
+
+class ImageStore:
+    # base64 images from exec outputs, decoded and written once per content hash, shared by all sessions.
+    # the least recently used ones are deleted once the store is over `max_bytes`
+    def __init__(self, max_bytes=MAX_BYTES, max_width=MAX_WIDTH):
+        self.dir = tempfile.TemporaryDirectory()
+        atexit.register(self.dir.cleanup)
+        self.max_bytes = max_bytes
+        self.max_width = max_width
+        self.index = OrderedDict()  # sha256 of the base64 text -> [path, bytes on disk, {copies the ui made of it}]
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'writes': 0, 'evictions': 0}
+
+    def _shrink(self, data):
+        # downsizes wide images and recompresses, keeps the original if that doesn't make it smaller
+        if Image is None:
+            return data
+        try:
+            image = Image.open(io.BytesIO(data))
+            if image.format != 'PNG':
+                return data
+            if self.max_width and image.width > self.max_width:
+                image = image.resize((self.max_width, round(image.height * self.max_width / image.width)), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG', optimize=True)
+        except Exception:
+            return data
+        return buffer.getvalue() if buffer.tell() < len(data) else data
+
+    def path(self, b64):
+        key = hashlib.sha256(b64.encode('utf-8')).hexdigest()
+        with self.lock:
+            if key in self.index and os.path.exists(self.index[key][0]):
+                self.index.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.index[key][0]
+        data = self._shrink(base64.b64decode(b64))
+        path = os.path.join(self.dir.name, key + '.png')
+        with open(path + '.partial', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.partial', path)
+        with self.lock:
+            if key in self.index:
+                self._remove(key)
+            self.index[key] = [path, len(data), set()]
+            self.total_bytes += len(data)
+            self.stats['writes'] += 1
+            self._evict()
+        return path
+
+    def add_copy(self, path, copy):
+        # gradio serves a copy of each image from its own temp dir, which is counted here and deleted with the image
+        key = os.path.splitext(os.path.basename(path))[0]
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or entry[0] != path or copy in entry[2]:
+                return
+            entry[2].add(copy)
+            self.index.move_to_end(key)
+            self.total_bytes += entry[1]
+            self._evict()
+
+    def _remove(self, key):
+        path, size, copies = self.index.pop(key)
+        self.total_bytes -= size * (1 + len(copies))
+        for p in [path, *copies]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def _evict(self):
+        # `stats['evictions']` changing tells renderers that images they returned before may be gone
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            self._remove(next(iter(self.index)))
+            self.stats['evictions'] += 1
+
+
+image_store = ImageStore()
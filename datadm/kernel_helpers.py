@@ -0,0 +1,638 @@
+# This file is not imported by datadm itself, it is executed inside each jupyter kernel
+# (as the `_datadm` module, see `REPL._helper_code`) and operates on the user's namespace passed in as `ns`.
+import hashlib
+import importlib
+import json
+import os
+import pickle
+import select
+import signal
+import sys
+import time
+import traceback
+import types
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def _columnar(x):
+    # parquet / feather want a frame with string column names
+    x = x.to_frame() if isinstance(x, pd.Series) else x
+    if not all(isinstance(c, str) for c in x.columns):
+        x = x.rename(columns=str)
+    return x
+
+
+def _to_feather(x, path):
+    # feather can't store an index, so keep it as a column
+    _columnar(x).reset_index().to_feather(path)
+
+
+WRITERS = {
+    'csv': ('.csv', lambda x, path: x.to_csv(path)),
+    'csv.gz': ('.csv.gz', lambda x, path: x.to_csv(path, compression='gzip')),
+    'csv.zst': ('.csv.zst', lambda x, path: x.to_csv(path, compression='zstd')),
+    'parquet': ('.parquet', lambda x, path: _columnar(x).to_parquet(path)),
+    'feather': ('.feather', _to_feather),
+    'pickle': ('.pkl', lambda x, path: x.to_pickle(path)),  # replay artifacts, see `REPL.cache_artifact`
+}
+
+# writes happen off the kernel's main thread, so cells can keep running while a big frame is exported
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='datadm-export')
+
+# (name, format) -> {'fingerprint', 'path', 'future'} of the last export, so unchanged frames are not written again
+_exports = {}
+
+
+def _frames(ns):
+    for name, x in list(ns.items()):
+        if name.startswith('_'):
+            continue
+        if isinstance(x, pd.DataFrame) or isinstance(x, pd.Series):
+            yield name, x
+
+
+def _columns(x):
+    if isinstance(x, pd.Series):
+        return [str(x.name)]
+    return [str(c) for c in x.columns]
+
+
+def _layout(x):
+    # identity, shape, columns and dtypes: free to compute, and what most changes to a frame change
+    dtypes = [str(x.dtype)] if isinstance(x, pd.Series) else [str(d) for d in x.dtypes]
+    return [id(x), list(x.shape), _columns(x), dtypes]
+
+
+def fingerprint(x):
+    # `_layout` plus a content hash, a single vectorized pass over the data
+    try:
+        content = hashlib.sha256(pd.util.hash_pandas_object(x, index=True).values.tobytes()).hexdigest()
+    except TypeError:
+        content = None  # unhashable cells (eg. lists), always treat as changed
+    return _layout(x) + [content]
+
+
+# a cell that calls these, or code defined in the kernel, can change any value
+_INDIRECT = {'globals', 'vars', 'exec', 'eval', 'setattr', 'get_ipython'}
+
+
+# values a cell can't change in place
+_ATOMS = (type(None), bool, int, float, complex, str, bytes, range, types.ModuleType, types.FunctionType,
+          types.BuiltinFunctionType, type)
+
+
+def _arrays(x):
+    # the buffers a frame (or array) keeps its values in, None for values not backed by numpy
+    if isinstance(x, np.ndarray):
+        return [x]
+    columns = [x] if isinstance(x, pd.Series) else [x.iloc[:, i] for i in range(x.shape[1])]
+    arrays = [c.values for c in columns]
+    return arrays if all(isinstance(a, np.ndarray) for a in arrays) else None
+
+
+def _shares_memory(x, arrays):
+    # whether `x` may be a view of (or viewed by) one of `arrays`, bounds only, so it errs towards yes
+    own = _arrays(x)
+    return own is None or any(np.may_share_memory(a, b) for a in own for b in arrays)
+
+
+def _holds_arrays(value, budget=10000):
+    # whether a container may hold a frame or an array (and see changes made to it), giving up after `budget` items
+    todo = [value]
+    while todo:
+        budget -= 1
+        x = todo.pop()
+        if budget < 0 or isinstance(x, (pd.DataFrame, pd.Series, np.ndarray)):
+            return True
+        if isinstance(x, dict):
+            todo.extend(x.values())
+        elif isinstance(x, (list, tuple, set, frozenset)):
+            todo.extend(x)
+        elif not isinstance(x, _ATOMS):
+            return True
+    return False
+
+
+def touched(ns, names):
+    # the values `names` (what some cells referenced, see `REPL._touched_since`) may have changed, with every other
+    # name bound to the same object, frames (and arrays) viewing the same memory, and containers that may hold one of
+    # them. None means any value may have changed: a cell that touched some other mutable value (a dict of frames, a
+    # numpy array, ...) may have changed anything reachable from it
+    if names is None or _INDIRECT & set(names):
+        return None
+    values = [ns[name] for name in names if name in ns]
+    for value in values:
+        if isinstance(value, (types.FunctionType, type)) and getattr(value, '__module__', None) == '__main__':
+            return None
+        if not isinstance(value, _ATOMS + (pd.DataFrame, pd.Series)):
+            return None
+    ids = {id(value) for value in values}
+    frames = [value for value in values if isinstance(value, (pd.DataFrame, pd.Series))]
+    arrays = [_arrays(frame) for frame in frames]
+    arrays = None if any(a is None for a in arrays) else [a for own in arrays for a in own]
+    changed = set(names)
+    for name in _user_names(ns):
+        value = ns[name]
+        if id(value) in ids:
+            changed.add(name)
+        elif not frames or isinstance(value, _ATOMS):
+            continue
+        elif isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+            if arrays is None or _shares_memory(value, arrays):
+                changed.add(name)
+        elif _holds_arrays(value):
+            changed.add(name)
+    return changed
+
+
+def describe(name, x):
+    return {
+        'name': name,
+        'columns': _columns(x),
+        'rows': len(x),
+        'type': 'DataFrame' if isinstance(x, pd.DataFrame) else 'Series',
+    }
+
+
+def list_frames(ns):
+    return [describe(name, x) for name, x in _frames(ns)]
+
+
+class StaleExport(Exception):
+    pass
+
+
+def _write(writer, x, path, fp):
+    # write next to the target and rename, so a download never sees a half written file. the frame is not copied,
+    # if a cell changed it while it was written the file may be torn and is dropped, the next export writes it again
+    writer(x, path + '.partial')
+    if fingerprint(x) != fp:
+        os.remove(path + '.partial')
+        raise StaleExport("changed while it was written")
+    os.replace(path + '.partial', path)
+
+
+def export_status(ns, name, format='csv'):
+    export = _exports[(name, format)]
+    status = {**describe(name, ns[name]), 'path': export['path'], 'format': format, 'status': 'pending', 'error': None}
+    if export['future'].done():
+        error = export['future'].exception()
+        status['status'] = 'stale' if isinstance(error, StaleExport) else 'error' if error else 'done'
+        status['error'] = repr(error) if error else None
+    return status
+
+
+def export_frame(ns, name, work_dir, format='csv', wait=True, keyed=False):
+    x = ns[name]
+    extension, writer = WRITERS[format]
+    fp = fingerprint(x)
+    # keyed exports get a file per content, so they don't overwrite one written for an earlier value of `name`
+    path = os.path.join(work_dir, f"{name}-{(fp[-1] or str(fp[0]))[:16]}{extension}" if keyed else name + extension)
+    previous = _exports.get((name, format))
+    reusable = (
+        previous is not None and previous['path'] == path and previous['fingerprint'] == fp and fp[-1] is not None
+        and (not previous['future'].done() or (previous['future'].exception() is None and os.path.exists(path)))
+    )
+    if not reusable:
+        _exports[(name, format)] = {'fingerprint': fp, 'path': path, 'future': _executor.submit(_write, writer, x, path, fp)}
+    if wait:
+        _exports[(name, format)]['future'].exception()  # blocks until written
+    return export_status(ns, name, format)
+
+
+def export_frames(ns, work_dir):
+    output = []
+    for name, x in _frames(ns):
+        status = export_frame(ns, name, work_dir)
+        if status['status'] == 'done':
+            output.append({**describe(name, x), 'csv': status['path']})
+    return output
+
+
+def _memory(x):
+    return int(x.memory_usage(deep=True).sum() if isinstance(x, pd.DataFrame) else x.memory_usage(deep=True))
+
+
+def memory_usage(ns):
+    return [{**describe(name, x), 'bytes': _memory(x)} for name, x in _frames(ns)]
+
+
+# name -> (fingerprint, profile) as of the last `profile_frames`, only frames that changed since are profiled again
+_profiles = {}
+
+
+def _unique(column):
+    try:
+        return int(column.nunique())
+    except TypeError:
+        return None  # unhashable cells (eg. lists)
+
+
+def profile(name, x, max_rows=10000):
+    # null counts are exact (cheap), cardinality of a frame longer than `max_rows` comes from a sample of it
+    frame = x.to_frame() if isinstance(x, pd.Series) else x
+    sample = frame.sample(max_rows, random_state=0) if len(frame) > max_rows else frame
+    nulls = frame.isna().sum()
+    columns = [{'name': str(frame.columns[i]), 'dtype': str(frame.dtypes.iloc[i]), 'nulls': int(nulls.iloc[i]),
+                'unique': _unique(sample.iloc[:, i])} for i in range(frame.shape[1])]
+    return {**describe(name, x), 'columns': columns, 'sampled': sample is not frame}
+
+
+def profile_frames(ns, max_rows=10000, names=None):
+    # `names`: what the cells since the last call referenced (None if unknown), only those (and what `touched` finds
+    # they may have changed through a view or a container) are hashed, the others just have their layout checked
+    changed = touched(ns, names)
+    profiles = []
+    for name, x in _frames(ns):
+        cached = _profiles.get(name)
+        if (cached is not None and changed is not None and name not in changed and cached[0][-1] is not None
+                and cached[0][:-1] == _layout(x)):
+            profiles.append(cached[1])
+            continue
+        fp = fingerprint(x)
+        if cached is None or cached[0] != fp or fp[-1] is None:
+            cached = _profiles[name] = (fp, profile(name, x, max_rows))
+        profiles.append(cached[1])
+    for name in set(_profiles) - {p['name'] for p in profiles}:
+        del _profiles[name]
+    return profiles
+
+
+def _optimize_column(column, max_ratio=0.5):
+    # returns the same values in a smaller dtype, or None if there is nothing to gain. not equivalent for what comes
+    # next: arithmetic on a downcast integer can overflow, and a categorical only accepts its existing categories
+    if pd.api.types.is_bool_dtype(column):
+        return None
+    if pd.api.types.is_integer_dtype(column):
+        smaller = pd.to_numeric(column, downcast='integer')
+    elif pd.api.types.is_float_dtype(column):
+        smaller = pd.to_numeric(column, downcast='float')
+        if not ((smaller.astype(column.dtype) == column) | column.isna()).all():
+            return None  # would lose precision
+    elif column.dtype == object and len(column) >= 100 and column.nunique() <= max_ratio * len(column):
+        smaller = column.astype('category')
+    else:
+        return None
+    return smaller if smaller.dtype != column.dtype else None
+
+
+# name -> (id, shape, dtypes) after the last optimization, so unchanged frames are skipped
+_optimized = {}
+
+
+def optimize_memory(ns, names=None):
+    reports = []
+    for name, x in _frames(ns):
+        if names is not None and name not in names:
+            continue
+        dtypes = [str(x.dtype)] if isinstance(x, pd.Series) else [str(d) for d in x.dtypes]
+        if _optimized.get(name) == (id(x), x.shape, dtypes):
+            continue
+        before = _memory(x)
+        changes = {}
+        if isinstance(x, pd.Series):
+            smaller = _optimize_column(x)
+            if smaller is not None:
+                changes[str(x.name)] = f"{x.dtype} -> {smaller.dtype}"
+                ns[name] = x = smaller
+        else:
+            for column in x.columns:
+                smaller = _optimize_column(x[column])
+                if smaller is not None:
+                    changes[str(column)] = f"{x[column].dtype} -> {smaller.dtype}"
+                    x[column] = smaller
+        dtypes = [str(x.dtype)] if isinstance(x, pd.Series) else [str(d) for d in x.dtypes]
+        _optimized[name] = (id(x), x.shape, dtypes)
+        reports.append({**describe(name, x), 'before': before, 'after': _memory(x), 'changes': changes})
+    return reports
+
+
+def _user_names(ns):
+    # skips what IPython itself puts in the namespace (In, Out, exit, ...), it is recreated by a new kernel
+    hidden = ns['get_ipython']().user_ns_hidden if 'get_ipython' in ns else {}
+    return [name for name in list(ns) if not name.startswith('_') and name not in hidden]
+
+
+def _dump_value(f, value):
+    # length prefixed, so a value that fails to load is skipped. a value that fails to pickle leaves nothing behind
+    start = f.tell()
+    f.write(bytes(8))
+    try:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        f.seek(start)
+        f.truncate()
+        raise
+    end = f.tell()
+    f.seek(start)
+    f.write((end - start - 8).to_bytes(8, 'little'))
+    f.seek(end)
+
+
+def checkpoint(ns, path):
+    # pickles everything picklable in the user namespace straight into the file one variable at a time, so it needs
+    # little memory besides the variables themselves. modules are stored by name and re-imported on restore
+    spill_snapshots()
+    saved, skipped = 0, []
+    with open(path + '.partial', 'wb') as f:
+        for name in _user_names(ns):
+            value = ns[name]
+            module = isinstance(value, types.ModuleType)
+            position = f.tell()
+            pickle.dump((name, 'module' if module else 'value'), f, protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                _dump_value(f, value.__name__ if module else value)
+                saved += 1
+            except Exception:
+                f.seek(position)
+                f.truncate()
+                skipped.append(name)
+    os.replace(path + '.partial', path)
+    return {'path': path, 'bytes': os.path.getsize(path), 'saved': saved, 'skipped': skipped}
+
+
+def restore_checkpoint(ns, path):
+    restored, failed = 0, []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                name, kind = pickle.load(f)
+            except EOFError:
+                break
+            end = int.from_bytes(f.read(8), 'little') + f.tell()
+            try:
+                value = pickle.load(f)
+                ns[name] = importlib.import_module(value) if kind == 'module' else value
+                restored += 1
+            except Exception:
+                failed.append(name)
+            f.seek(end)
+    return {'restored': restored, 'failed': failed}
+
+
+# snapshot id -> {name: entry} for the most recent snapshots, older ones are spilled to `_spill_dir`.
+# an entry holds a private copy of the value, unchanged values share the entry of the previous snapshot. copies above
+# the memory budget are offloaded to their own file (oldest first), the entry then has its 'path' instead of 'value'
+_snapshots = OrderedDict()
+_latest = {}  # name -> entry matching the live value, as of the last snapshot / restore
+_spilled = []  # snapshot ids on disk, oldest first
+_spilled_paths = {}  # snapshot id on disk -> offloaded copies it refers to
+_spill_dir = None
+_entries = 0  # entries created, for offloading the oldest first
+
+
+def _new_entry(kind, value, nbytes, **fields):
+    global _entries
+    _entries += 1
+    return {'kind': kind, 'value': value, 'bytes': nbytes, 'seq': _entries, **fields}
+
+
+def _offload(entry, value=None):
+    # writes the copy (or `value` itself, so a frame bigger than the budget is never copied in memory) to its own file
+    path = os.path.join(_spill_dir, f"entry-{entry['seq']}-{os.getpid()}.pkl")
+    os.makedirs(_spill_dir, exist_ok=True)
+    with open(path + '.partial', 'wb') as f:
+        pickle.dump(entry['value'] if value is None else value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.partial', path)
+    entry['path'], entry['value'] = path, None
+
+
+def _entry_value(entry):
+    if entry['value'] is not None or 'path' not in entry:
+        return entry['value']
+    with open(entry['path'], 'rb') as f:
+        return pickle.load(f)
+
+
+def _snapshot_entry(value, previous=None, changed=True, max_bytes=None):
+    # `changed=False`: the cells since the last snapshot didn't reference it, unless its layout changed it is the same
+    if isinstance(value, types.ModuleType):
+        return {'kind': 'module', 'value': value.__name__}
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        same = previous is not None and previous['kind'] == 'frame' and previous['fingerprint'][-1] is not None
+        if same and not changed and previous['fingerprint'][:-1] == _layout(value):
+            return previous
+        fp = fingerprint(value)
+        if same and previous['fingerprint'] == fp:
+            return previous
+        nbytes = _memory(value)
+        if max_bytes is not None and nbytes > max_bytes:
+            entry = _new_entry('frame', None, nbytes, fingerprint=fp)
+            _offload(entry, value)
+            return entry
+        return _new_entry('frame', value.copy(deep=True), nbytes, fingerprint=fp)
+    if not changed and previous is not None and previous['kind'] == 'pickle' and previous.get('id') == id(value):
+        return previous
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    digest = hashlib.sha256(data).hexdigest()
+    if previous is not None and previous['kind'] == 'pickle' and previous['digest'] == digest:
+        previous['id'] = id(value)
+        return previous
+    return _new_entry('pickle', data, len(data), digest=digest, id=id(value))
+
+
+def _in_memory():
+    entries = {id(e): e for entries in list(_snapshots.values()) + [_latest] for e in entries.values()}
+    return [e for e in entries.values() if e['kind'] != 'module' and e['value'] is not None]
+
+
+def offload_snapshots(max_bytes):
+    entries = sorted(_in_memory(), key=lambda e: e['seq'])
+    total = sum(e['bytes'] for e in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        _offload(entry)
+        total -= entry['bytes']
+
+
+def _snapshot_path(snapshot_id):
+    return os.path.join(_spill_dir, f'{snapshot_id}.pkl')
+
+
+def _spill(snapshot_id, entries):
+    os.makedirs(_spill_dir, exist_ok=True)
+    with open(_snapshot_path(snapshot_id), 'wb') as f:
+        pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+    _spilled.append(snapshot_id)
+    _spilled_paths[snapshot_id] = {e['path'] for e in entries.values() if e.get('value') is None and 'path' in e}
+
+
+def spill_snapshots(max_in_memory=0, max_on_disk=100):
+    while len(_snapshots) > max_in_memory:
+        _spill(*_snapshots.popitem(last=False))
+    while len(_spilled) > max_on_disk:
+        snapshot_id = _spilled.pop(0)
+        paths = _spilled_paths.pop(snapshot_id, set())
+        # offloaded copies nothing else refers to go with it
+        paths -= set().union(*_spilled_paths.values(), *[{e.get('path') for e in entries.values()}
+                                                           for entries in list(_snapshots.values()) + [_latest]])
+        for path in [_snapshot_path(snapshot_id)] + sorted(paths):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def snapshot(ns, snapshot_id, spill_dir, max_in_memory=8, max_on_disk=100, max_bytes=None, names=None):
+    # only values that changed since the last snapshot are copied. `names`: what the cells since then referenced (None
+    # if unknown), only those are hashed, the others just have their layout checked. the copies kept in memory take up
+    # to `max_bytes`, the oldest beyond that are offloaded to disk
+    global _spill_dir
+    _spill_dir = spill_dir
+    start = time.time()
+    changed = touched(ns, names)
+    entries, skipped, copied = {}, [], 0
+    for name in _user_names(ns):
+        try:
+            entries[name] = _snapshot_entry(ns[name], _latest.get(name), changed is None or name in changed, max_bytes)
+        except Exception:
+            skipped.append(name)
+            continue
+        copied += entries[name] is not _latest.get(name)
+    _snapshots[snapshot_id] = entries
+    _latest.clear()
+    _latest.update(entries)
+    if max_bytes is not None:
+        offload_snapshots(max_bytes)
+    spill_snapshots(max_in_memory, max_on_disk)
+    return {'id': snapshot_id, 'names': len(entries), 'copied': copied, 'skipped': skipped, 'seconds': time.time() - start}
+
+
+def _unchanged(value, entry):
+    if entry['kind'] == 'module':
+        return isinstance(value, types.ModuleType) and value.__name__ == entry['value']
+    if entry['kind'] == 'frame':
+        return isinstance(value, (pd.DataFrame, pd.Series)) and entry['fingerprint'][-1] is not None and fingerprint(value) == entry['fingerprint']
+    try:
+        return hashlib.sha256(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest() == entry['digest']
+    except Exception:
+        return False
+
+
+def restore_snapshot(ns, snapshot_id, spill_dir):
+    # puts back only the names that differ from the snapshot, and removes the ones created after it
+    start = time.time()
+    if snapshot_id in _snapshots:
+        entries = _snapshots[snapshot_id]
+        _snapshots.move_to_end(snapshot_id)
+    else:
+        with open(os.path.join(spill_dir, f'{snapshot_id}.pkl'), 'rb') as f:
+            entries = pickle.load(f)
+    removed = [name for name in _user_names(ns) if name not in entries]
+    for name in removed:
+        del ns[name]
+    restored = []
+    _latest.clear()
+    for name, entry in entries.items():
+        if name in ns and _unchanged(ns[name], entry):
+            if entry['kind'] == 'pickle':
+                entry['id'] = id(ns[name])
+            _latest[name] = entry
+            continue
+        if entry['kind'] == 'module':
+            ns[name] = importlib.import_module(entry['value'])
+            _latest[name] = entry
+        elif entry['kind'] == 'frame':
+            # the snapshot keeps its own copy, the restored value matches it except for its id
+            ns[name] = entry['value'].copy(deep=True) if entry['value'] is not None else _entry_value(entry)
+            entry['fingerprint'] = [id(ns[name])] + entry['fingerprint'][1:]
+            _latest[name] = entry
+        else:
+            ns[name] = pickle.loads(_entry_value(entry))
+            entry['id'] = id(ns[name])
+            _latest[name] = entry
+        restored.append(name)
+    return {'id': snapshot_id, 'restored': restored, 'removed': removed, 'seconds': time.time() - start}
+
+
+_trials = {}  # trial id -> {'pid', 'fd', 'data', 'started'}
+
+
+def _run_trial(ns, code):
+    # in the forked child: the zmq sockets and threads of the kernel are not usable here, output is captured instead
+    import io
+    out = io.StringIO()
+    sys.stdout = sys.stderr = out
+    if 'matplotlib' in sys.modules:
+        sys.modules['matplotlib'].use('Agg', force=True)
+    shell = ns['get_ipython']() if 'get_ipython' in ns else None
+    try:
+        if shell is not None:
+            shell.display_pub.publish = lambda *args, **kwargs: None
+            code = shell.transform_cell(code)
+        exec(compile(code, '<candidate>', 'exec'), ns)
+        return {'ok': True, 'stdout': out.getvalue(), 'tracebacks': ''}
+    except BaseException:
+        return {'ok': False, 'stdout': out.getvalue(), 'tracebacks': traceback.format_exc()}
+
+
+def start_trial(ns, trial_id, code):
+    # runs `code` in a fork of the kernel, on a copy-on-write copy of the namespace that is thrown away afterwards.
+    # the kernel is multithreaded (zmq io, iopub, heartbeat, the export executor, blas/openmp pools) and the child only
+    # gets the forking thread: a lock another thread held at the fork stays held in the child forever, so code that
+    # needs one (eg. logging, a threaded blas call, `export_frame`) can hang there. the child never touches zmq and
+    # leaves with os._exit (no atexit or thread joins), a hung trial is killed after `trial_results`' timeout
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            data = json.dumps(_run_trial(ns, code), default=str).encode()
+            while data:
+                data = data[os.write(write_fd, data):]
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    _trials[trial_id] = {'pid': pid, 'fd': read_fd, 'data': b'', 'started': time.time()}
+    return {'id': trial_id, 'pid': pid}
+
+
+def _finish_trial(trial_id):
+    trial = _trials.pop(trial_id)
+    os.close(trial['fd'])
+    try:
+        os.kill(trial['pid'], signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    os.waitpid(trial['pid'], 0)
+    return trial
+
+
+def trial_results(wait=0.0, timeout=None):
+    # {trial id: result} of the trials that finished within `wait` seconds, trials running longer than `timeout` fail
+    results = {}
+    deadline = time.time() + wait
+    while _trials and not results:
+        by_fd = {trial['fd']: trial_id for trial_id, trial in _trials.items()}
+        ready, _, _ = select.select(list(by_fd), [], [], max(0.0, deadline - time.time()))
+        for fd in ready:
+            chunk = os.read(fd, 1 << 16)
+            _trials[by_fd[fd]]['data'] += chunk
+            if not chunk:
+                trial = _finish_trial(by_fd[fd])
+                try:
+                    results[by_fd[fd]] = json.loads(trial['data'])
+                except ValueError:  # killed, e.g. by the kernel's memory limit
+                    results[by_fd[fd]] = {'ok': False, 'stdout': '', 'tracebacks': 'The candidate crashed'}
+        for trial_id in [t for t, trial in _trials.items() if timeout and time.time() - trial['started'] > timeout]:
+            _finish_trial(trial_id)
+            results[trial_id] = {'ok': False, 'stdout': '', 'tracebacks': f'The candidate took longer than {timeout}s'}
+        if time.time() >= deadline:
+            break
+    return results
+
+
+def cancel_trials():
+    cancelled = list(_trials)
+    for trial_id in cancelled:
+        _finish_trial(trial_id)
+    return cancelled
+
+
+def emit(obj):
+    print("FROMHERE:" + json.dumps(obj) + ":TOHERE")
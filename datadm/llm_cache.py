@@ -0,0 +1,123 @@
+import contextvars
+import os
+import threading
+from collections import OrderedDict
+
+import diskcache
+import platformdirs
+from guidance.llms.caches import Cache
+
+CACHE_DIR = os.environ.get("DATADM_LLM_CACHE_DIR") or os.path.join(platformdirs.user_cache_dir("datadm"), "llm")
+MAX_BYTES = int(float(os.environ.get("DATADM_LLM_CACHE_MB", "1024")) * 1024 * 1024)
+# sampled responses guidance may still read back right after storing them
+MAX_SAMPLED = 64
+
+# keys looked up or stored while generating one agent turn, see `recording`
+_keys = contextvars.ContextVar('datadm_llm_cache_keys', default=None)
+# the key this task or thread last found in the cache, see `ResponseCache.__contains__`
+_found = contextvars.ContextVar('datadm_llm_cache_found', default=None)
+
+
+class ResponseCache(Cache):
+    # llm responses on disk, kept across restarts and shared by all llms (the key has the model, the rendered prompt and
+    # the generation parameters). the least recently used go above `max_bytes`. sampled (temperature > 0) responses
+    # are never served again, they are only held until guidance reads them back
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._cache = None  # opened on first use, importing this module doesn't create the directory
+        self._sampled = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0  # responses generated and stored
+
+    @property
+    def _diskcache(self):
+        with self.lock:
+            if self._cache is None:
+                self._cache = diskcache.Cache(self.directory, size_limit=self.max_bytes, eviction_policy='least-recently-used')
+            return self._cache
+
+    def create_key(self, llm, **kwargs):
+        key = super().create_key(llm, **kwargs)
+        return 'sampled-' + key if kwargs.get('temperature') else key
+
+    def _record(self, key):
+        keys = _keys.get()
+        if keys is not None and key not in keys:
+            keys.append(key)
+
+    def __contains__(self, key):
+        if key.startswith('sampled-'):
+            return False
+        found = key in self._diskcache
+        self._record(key)
+        # guidance may ask more than once within one call, so a hit is counted once per lookup: the first time this
+        # task or thread finds the key since it last read a response
+        if found and _found.get() != key:
+            with self.lock:
+                self.hits += 1
+        _found.set(key if found else None)
+        return found
+
+    def __getitem__(self, key):
+        if key.startswith('sampled-'):
+            return self._sampled[key]
+        value = self._diskcache[key]
+        _found.set(None)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key.startswith('sampled-'):
+                self._sampled[key] = value
+                while len(self._sampled) > MAX_SAMPLED:
+                    self._sampled.popitem(last=False)
+                return
+            self.misses += 1
+        self._diskcache[key] = value
+        self._record(key)
+
+    def discard(self, keys):
+        for key in keys:
+            self._diskcache.delete(key)
+
+    def clear(self):
+        self._diskcache.clear()
+        self._sampled.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        opened = self._cache is not None
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes': self._cache.volume() if opened else 0, 'entries': len(self._cache) if opened else 0}
+
+
+def recording(keys, iterator):
+    # runs `iterator` with the cache keys it uses appended to `keys`. the variable is set around every step, guidance
+    # starts its program task in whichever step first runs it and the task keeps that context
+    while True:
+        token = _keys.set(keys)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _keys.reset(token)
+        yield item
+
+
+async def arecording(keys, iterator):
+    # same as `recording`, for async iterators
+    while True:
+        token = _keys.set(keys)
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            _keys.reset(token)
+        yield item
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,118 @@
+import bz2
+import codecs
+import csv
+import gzip
+import importlib.util
+import lzma
+import os
+
+import pandas as pd
+
+# files above this get the faster (pyarrow, categorical) path, files above PREVIEW_BYTES are only partially loaded
+FAST_PATH_BYTES = int(os.environ.get("DATADM_FAST_LOAD_MB", "50")) * 1024 * 1024
+PREVIEW_BYTES = int(os.environ.get("DATADM_PREVIEW_LOAD_MB", "2048")) * 1024 * 1024
+PREVIEW_ROWS = 1_000_000
+SAMPLE_ROWS = 10_000
+
+COMPRESSIONS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open, '.zip': None, '.zst': None}
+READERS = {
+    '.parquet': 'read_parquet',
+    '.pq': 'read_parquet',
+    '.feather': 'read_feather',
+    '.arrow': 'read_feather',
+    '.jsonl': 'read_json',
+    '.ndjson': 'read_json',
+    '.json': 'read_json',
+}
+
+
+def _encoding(raw):
+    # a bom, else utf-8 if the sample decodes as such (its last character may be cut off), else latin-1 (never fails)
+    if raw.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(raw, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+
+def sniff(filename, local_path=None):
+    # looks at the name (and the file itself, when it is available locally) to decide how to read it
+    name = filename.lower()
+    info = {'size': None, 'compression': None, 'format': 'csv', 'delimiter': ',', 'encoding': 'utf-8'}
+    extension = os.path.splitext(name)[1]
+    if extension in COMPRESSIONS:
+        info['compression'] = extension[1:]
+        name = name[:-len(extension)]
+        extension = os.path.splitext(name)[1]
+    if extension in READERS:
+        info['format'] = extension[1:]
+    elif extension == '.tsv':
+        info['delimiter'] = '\t'
+    if local_path is None or not os.path.exists(local_path):
+        return info
+    info['size'] = os.path.getsize(local_path)
+    opener = open if info['compression'] is None else COMPRESSIONS['.' + info['compression']]
+    if info['format'] != 'csv' or opener is None:
+        return info
+    try:
+        with opener(local_path, 'rb') as f:
+            raw = f.read(64 * 1024)
+    except (OSError, EOFError):
+        return info
+    info['encoding'] = _encoding(raw)
+    if extension != '.tsv':
+        try:
+            sample = raw.decode(info['encoding'], errors='ignore')
+            info['delimiter'] = csv.Sniffer().sniff(sample, delimiters=',;\t|').delimiter
+        except csv.Error:
+            pass  # eg. a single column
+    return info
+
+
+def categorical_columns(local_path, delimiter, max_ratio=0.5, encoding='utf-8'):
+    # string columns that repeat a lot in a sample are cheaper as categoricals
+    sample = pd.read_csv(local_path, sep=delimiter, nrows=SAMPLE_ROWS, encoding=encoding)
+    columns = []
+    for column in sample.select_dtypes(include='object').columns:
+        if sample[column].nunique() <= max_ratio * len(sample):
+            columns.append(column)
+    return columns
+
+
+def load_code(filename, varname, local_path=None):
+    # returns (code to run in the kernel, short description of the chosen strategy)
+    info = sniff(filename, local_path)
+    if info['format'] != 'csv':
+        reader = READERS['.' + info['format']]
+        lines = ", lines=True" if info['format'] in ('jsonl', 'ndjson') else ""
+        return f"{varname} = pd.{reader}('{filename}'{lines})\nprint({varname}.head())", f"{reader}{lines and ' (lines)'}"
+
+    args = [f"'{filename}'"]
+    if info['delimiter'] != ',':
+        args.append(f"sep={info['delimiter']!r}")
+    if info['encoding'] != 'utf-8':
+        args.append(f"encoding={info['encoding']!r}")
+    strategy = 'csv reader' + (f" (delimiter {info['delimiter']!r})" if info['delimiter'] != ',' else '')
+    strategy += f", {info['encoding']} text" if info['encoding'] != 'utf-8' else ''
+    if info['size'] is None or info['size'] < FAST_PATH_BYTES:
+        return f"{varname} = pd.read_csv({', '.join(args)})\nprint({varname}.head())", strategy
+
+    try:
+        categoricals = categorical_columns(local_path, info['delimiter'], encoding=info['encoding'])
+    except Exception:
+        categoricals = []
+    if categoricals:
+        args.append(f"dtype={ {c: 'category' for c in categoricals} !r}")
+        strategy += f", {len(categoricals)} categorical columns"
+    if info['size'] >= PREVIEW_BYTES:
+        # the pyarrow engine can't stop early, so previews use the default engine
+        args.append(f"nrows={PREVIEW_ROWS}")
+        strategy += f", preview of the first {PREVIEW_ROWS:,} rows of a {info['size'] / 1024 ** 3:.1f}GB file"
+    elif importlib.util.find_spec('pyarrow') is not None:
+        args.append("engine='pyarrow'")
+        strategy += ", pyarrow engine"
+    return f"{varname} = pd.read_csv({', '.join(args)})\nprint({varname}.head())", strategy
@@ -0,0 +1,70 @@
+import functools
+import threading
+
+import guidance
+
+try:
+    from guidance import _program_executor
+except ImportError:  # a guidance without the module-level grammar patched below
+    _program_executor = None
+
+
+class _CachedGrammar:
+    # guidance parses a program's template again every time it runs (~75ms for the agent prompts). the parse tree only
+    # depends on the template text and is not changed while executing, so it is kept per text. only for the templates
+    # of datadm's own programs (see `ProgramCache`), any other use of guidance in the process parses as it did
+    def __init__(self, grammar, maxsize=256):
+        self.grammar = grammar
+        self.texts = set()
+        self.cached_parse = functools.lru_cache(maxsize=maxsize)(grammar.parse_string)
+
+    def register(self, text):
+        self.texts.add(text)
+
+    def parse_string(self, text):
+        return self.cached_parse(text) if text in self.texts else self.grammar.parse_string(text)
+
+    def __getattr__(self, name):
+        return getattr(self.grammar, name)
+
+
+# only for the guidance version pinned in pyproject.toml, other versions may use (or mutate) their grammar differently
+if (guidance.__version__ == '0.0.64' and _program_executor is not None
+        and hasattr(getattr(_program_executor, 'grammar', None), 'parse_string')
+        and not isinstance(_program_executor.grammar, _CachedGrammar)):
+    _program_executor.grammar = _CachedGrammar(_program_executor.grammar)
+
+
+def _register(program):
+    grammar = getattr(_program_executor, 'grammar', None)
+    if isinstance(grammar, _CachedGrammar):
+        grammar.register(program.marked_text)
+
+
+class ProgramCache:
+    # one guidance program per (template, llm, async_mode). calling a program runs a copy of it, so they can be shared
+    def __init__(self):
+        # llm -> {(template, async_mode): program}. the programs reference their llm, so a weak key would never die:
+        # entries are dropped explicitly with `discard` when the llm is unloaded
+        self.programs = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, template, llm, async_mode=False):
+        with self.lock:
+            programs = self.programs.setdefault(llm, {})
+            key = (template, async_mode)
+            if key in programs:
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+                programs[key] = guidance(template, llm=llm, async_mode=async_mode)
+                _register(programs[key])
+            return programs[key]
+
+    def discard(self, llm):
+        with self.lock:
+            self.programs.pop(llm, None)
+
+
+program_cache = ProgramCache()
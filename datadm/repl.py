@@ -1,15 +1,45 @@
+import asyncio
 import atexit
+import functools
+import inspect
 import json
 import os
+import shutil
 import signal
 import subprocess
 import tempfile
+import threading
 import time
 import uuid
-from queue import Empty
+from queue import Empty, Queue
 
+from jupyter_client import AsyncKernelClient
 from jupyter_client.blocking import BlockingKernelClient
 
+from datadm import replay, resources
+from datadm.history import History
+
+HELPERS_PATH = os.path.join(os.path.dirname(__file__), 'kernel_helpers.py')
+EXPORT_FORMATS = ['csv', 'csv.gz', 'csv.zst', 'parquet', 'feather']
+SNAPSHOTS_IN_MEMORY = int(os.environ.get('DATADM_SNAPSHOTS_IN_MEMORY', '8'))
+# copies of changed values the snapshots keep in the kernel's memory, beyond that the oldest go to disk
+SNAPSHOTS_MEMORY_BYTES = int(float(os.environ.get('DATADM_SNAPSHOTS_MEMORY_MB', '256')) * 1024 * 1024)
+REPLAY_TIMEOUT = 3600  # replayed cells may be slow loads that print nothing for a while
+CHECKPOINT_TIMEOUT = 600  # pickling a big namespace prints nothing either
+LIVENESS_CHECK_SECONDS = 2  # an exec without a timeout checks the kernel is alive this often while the cell is silent
+TRIAL_TIMEOUT = float(os.environ.get('DATADM_TRIAL_TIMEOUT', '60'))  # seconds a speculative candidate may run in its fork
+PROFILE_SAMPLE_ROWS = int(os.environ.get('DATADM_PROFILE_SAMPLE_ROWS', '10000'))  # longer frames sample their cardinality
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+KERNEL_DIED = "The kernel died while running this cell (out of memory?), it was restarted and rebuilt from history without it\n"
+
+
+class KernelDied(Exception):
+    def __init__(self, output):
+        super().__init__(output['tracebacks'])
+        self.output = output
+
 
 class REPL:
     # TODO: add a "save as ipynb file" as serialization option 
@@ -18,14 +48,40 @@ class REPL:
     #   -> For any uploaded files, call them out in the header that the notebook expects those files ("system was run with {x} {y}")
     #   -> "Add secret" -> doesn't show up in the conversation, shows up in notebooks as an env-var
     #   "download conversation as webpage" -> {ipynb} -> {html}
-    def __init__(self):
-        self.history = []
+    def __init__(self, export_format='csv', limits=None):
+        self.export_format = export_format
+        # memory_mb, cpu_seconds, cpu_percent (cgroups v2 only) and wall_seconds (per exec), see `resources.limits_from_env`
+        self.limits = limits or {}
+        self.last_upload = None
         self.uid = str(uuid.uuid4())
-        self.conn_file = tempfile.NamedTemporaryFile(suffix='.json')
         self.runtime_dir = tempfile.TemporaryDirectory()
         self.work_dir = self.runtime_dir.name
+        self.history = History(os.path.join(self.work_dir, '.datadm_history'))
+        self.cgroup = resources.create_cgroup(f'datadm-{self.uid}', self.limits)
+        # lifecycle, see `datadm.session.SessionManager`
+        self.setup = None  # re-run on a revived kernel, set by `KernelPool`
+        self.evicted = False
+        self.evicting = None  # an Event while `evict` runs, execs wait for it
+        self.state_lock = threading.Lock()
+        self.busy = 0
+        self.revivals = 0
+        self.snapshot_history = {}  # snapshot id -> len(history) when it was taken
+        self.snapshot_mark = None  # len(history) as of the kernel's last snapshot / restore, None if unknown
+        self.profile_mark = None  # len(history) as of the kernel's last `profile_dataframes`, None if unknown
+        self.executions = 0  # recorded execs sent to the kernel, counted when sent (the cell may not have output yet)
+        self.last_activity = time.time()
+        atexit.register(self.shutdown)
+        atexit.register(self.runtime_dir.cleanup)
+        atexit.register(lambda: resources.remove_cgroup(self.cgroup))
+        self._start_kernel()
+        self.kc = self.connect()
+
+    def _start_kernel(self):
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.conn_file = tempfile.NamedTemporaryFile(suffix='.json')
         kernel_process = subprocess.Popen(
-            ['jupyter-kernel', '--KernelManager.connection_file', self.conn_file.name],
+            resources.limited(['jupyter-kernel', '--KernelManager.connection_file', self.conn_file.name],
+                              self.limits, self.cgroup),
             stdin=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.STDOUT,
@@ -36,55 +92,149 @@ class REPL:
                 'SHELL': '/bin/bash',
                 'PWD': self.work_dir,
                 'PATH': os.environ.get('PATH', ''),
-            }
+            },
         )
+        self.kernel_process = kernel_process
         self.kernel_pid = kernel_process.pid
-        atexit.register(lambda: os.kill(self.kernel_pid, signal.SIGKILL))
-        atexit.register(self.runtime_dir.cleanup)
-        self.kc = self.connect()
-    
-    def read_all(self):
-        while True:
-            try:
-                yield self.kc.iopub_channel.get_msg(timeout=0.01)
-            except Empty:
-                break
 
-    def snapshot(self):
-        self.kc.stop_channels()
-        os.makedirs(f"/tmp/{self.uid}", exist_ok=True)
-        subprocess.run(
-            [
-                'sudo', 'criu', 'dump',
-                '-t', str(self.kernel_pid),
-                '-D', f'/tmp/{self.uid}',
-                '--tcp-established',
-                '--ext-unix-sk',
-                '--shell-job',
-                '--track-mem',
-                # '--leave-running'
-            ],
-            check=True
-        )
-        self.restore()
-        # okay, should be back up, now reconnect the kernel client
-        # self.connect()
-
-    def restore(self):
-        self.kc.stop_channels()
-        # TODO: fix this?
-        os.kill(self.kernel_pid, signal.SIGTERM)
-        time.sleep(10)
-        subprocess.run(
-            ['sudo', 'criu', 'restore',
-            '-d',
-            '-D', f'/tmp/{self.uid}',
-            '--pidfile', str(self.kernel_pid),
-            '-x',
-            '--tcp-established'],
-            check=True
-        )
+    def shutdown(self):
+        # kills the whole process group, the `jupyter-kernel` launcher and the kernel it started
+        try:
+            self.kc.stop_channels()
+        except Exception:
+            pass
+        try:
+            os.killpg(self.kernel_pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    @property
+    def snapshot_dir(self):
+        return os.path.join(self.work_dir, '.datadm_snapshots')
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.work_dir, '.datadm_checkpoint.pkl')
+
+    def checkpoint(self):
+        return self._exec_json(self._helper_code(f"_datadm.checkpoint(globals(), {self.checkpoint_path!r})"))
+
+    def evict(self):
+        # frees the kernel but keeps the variables on disk, the next exec brings it back (see `revive`).
+        # returns None without evicting if the kernel is in use, an exec that starts meanwhile waits for it
+        with self.state_lock:
+            if self.evicted or self.busy or self.evicting is not None:
+                return None
+            self.evicting = threading.Event()
+        try:
+            info = self._internal_json(self._helper_code(f"_datadm.checkpoint(globals(), {self.checkpoint_path!r})"), CHECKPOINT_TIMEOUT)
+            if info is not None:
+                self.shutdown()
+                self.evicted = True
+            return info
+        finally:
+            with self.state_lock:
+                evicting, self.evicting = self.evicting, None
+            evicting.set()
+
+    def revive(self):
+        self.evicted = False
+        self.revivals += 1
+        self.last_activity = time.time()
+        self._start_kernel()
+        self.connect()
+        if self.setup is not None:
+            n, marks = len(self.history), dict(self.snapshot_history)
+            self.setup(self)
+            del self.history[n:]  # already recorded when the kernel was first set up
+            self._set_up_again(n, marks)
+        self.snapshot_mark = self.profile_mark = None  # the checkpoint brings values back without a cell
+        info = self._exec_json(self._helper_code(f"_datadm.restore_checkpoint(globals(), {self.checkpoint_path!r})"))
+        return info if info is not None else self.replay()
+
+    def _set_up_again(self, n, marks):
+        # snapshots the setup takes again (with the history it recorded again trimmed to `n`) keep the mark they were
+        # first taken at, new ones can't be past the end
+        self.snapshot_history = {i: marks.get(i, min(mark, n)) for i, mark in self.snapshot_history.items()}
+
+    def _touched_since(self, mark):
+        # names the cells recorded since history[mark] referenced, so only those can have changed. None when unknown:
+        # no mark, or a cell that can't be analyzed or runs magics / shell commands
+        if mark is None:
+            return None
+        names = set()
+        for cell in self.history[mark:]:
+            analysis = replay.analyze(cell['code'])
+            if analysis is None or any(line.lstrip().startswith(('%', '!')) for line in cell['code'].split('\n')):
+                return None
+            names |= analysis[0] | analysis[1]
+        return sorted(names)
+
+    def _snapshot_code(self, snapshot_id):
+        return self._helper_code(
+            f"_datadm.snapshot(globals(), {snapshot_id!r}, {self.snapshot_dir!r}, max_in_memory={SNAPSHOTS_IN_MEMORY}, "
+            f"max_bytes={SNAPSHOTS_MEMORY_BYTES}, names={self._touched_since(self.snapshot_mark)!r})")
+
+    def _snapshot_taken(self, snapshot_id, info):
+        if info is None:
+            return None
+        self.snapshot_history[snapshot_id] = self.snapshot_mark = len(self.history)
+        return info['id']
+
+    def snapshot(self, snapshot_id=None):
+        # copies the variables that changed since the last snapshot inside the kernel, returns the id to `restore` it
+        snapshot_id = snapshot_id or uuid.uuid4().hex
+        return self._snapshot_taken(snapshot_id, self._exec_json(self._snapshot_code(snapshot_id)))
+
+    def restore(self, snapshot_id):
+        # falls back to a new kernel rebuilt from `history` when the snapshot is gone
+        info = self._exec_json(self._helper_code(f"_datadm.restore_snapshot(globals(), {snapshot_id!r}, {self.snapshot_dir!r})"))
+        upto = self.snapshot_history.get(snapshot_id)
+        if info is None and upto is not None:
+            info = self.recover(upto=upto)
+        if info is not None and upto is not None:
+            del self.history[upto:]
+        self.snapshot_mark = upto if info is not None else None
+        self.profile_mark = None  # values changed without a cell, and history may be shorter than the mark
+        return info
+
+    @property
+    def artifact_dir(self):
+        return os.path.join(self.work_dir, '.datadm_artifacts')
+
+    def cache_artifact(self, name):
+        # keeps a pickle of `name` so `replay` can load it instead of re-running the (slow) cell that made it
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        status = self._exec_json(self._helper_code(f"_datadm.export_frame(globals(), {name!r}, {self.artifact_dir!r}, 'pickle', keyed=True)"))
+        return self._record_artifact(name, status)
+
+    def _record_artifact(self, name, status):
+        if status is None or status['status'] != 'done':
+            return None
+        for cell in reversed(self.history):
+            analysis = replay.analyze(cell['code'])
+            if analysis is not None and name in analysis[1]:
+                cell.setdefault('artifacts', {})[name] = status['path']
+                return status['path']
+        return None
+
+    def _replay_code(self, names=None, upto=None, use_artifacts=True):
+        return [code for _, code in replay.plan(self.history[:upto], names, use_artifacts)]
+
+    def replay(self, names=None, upto=None, use_artifacts=True):
+        # re-runs only the cells of history[:upto] needed to rebuild `names` (default: all variables)
+        start = time.time()
+        codes = self._replay_code(names, upto, use_artifacts)
+        for code in codes:
+            self.exec(code, timeout=REPLAY_TIMEOUT, record=False)
+        return {'cells': len(codes), 'history': len(self.history[:upto]), 'seconds': time.time() - start}
+
+    def recover(self, names=None, upto=None):
+        # a new kernel, rebuilt from history. used when the kernel died or its state can't be restored otherwise
+        self.shutdown()
+        self._start_kernel()
         self.connect()
+        return self.replay(names, upto)
 
     def connect(self, n_retries=100):
         tries = 0
@@ -100,64 +250,176 @@ class REPL:
         else:
             raise RuntimeError('Kernel did not start')
         self.kc = kc
-        self.kc.wait_for_ready(timeout=5)
+        for attempt in range(3):
+            try:
+                self.kc.wait_for_ready(timeout=5)
+                break
+            except RuntimeError:
+                # the first heartbeat can be missed while the kernel is still importing (eg. several starting at once)
+                if attempt == 2:
+                    raise
         return kc
 
-    def exec(self, code, timeout=10):
-        list(self.read_all())  # flush
-        self.kc.execute(code)
-        self.kc.get_shell_msg(timeout=timeout)
+    def exec(self, code, timeout=10, record=True):
+        for output in self.exec_stream(code, timeout=timeout, record=record):
+            pass
+        return output
+
+    def exec_stream(self, code, timeout=10, record=True):
+        # yields partial output snapshots as they arrive, the last one yielded is the final output.
+        # record=False keeps internal calls out of `history`, which is what `replay` rebuilds the kernel from.
+        # `timeout`: seconds to wait for the cell's next message, None waits for as long as it runs
+        while True:
+            with self.state_lock:
+                evicting = self.evicting
+                if evicting is None:
+                    self.busy += 1
+                    break
+            evicting.wait()
+        try:
+            if self.evicted:
+                self.revive()
+            elif not self.kernel_alive():
+                print(f"Kernel {self.uid} died, rebuilding it from history")
+                self.recover()
+            try:
+                yield from self._exec_stream(code, timeout, record)
+            except KernelDied as e:
+                print(f"Kernel {self.uid} died, rebuilding it from history")
+                self.recover()
+                yield e.output
+        finally:
+            self.busy -= 1
+            self.last_activity = time.time()
+
+    def _exec_stream(self, code, timeout, record):
+        msg_id = self.kc.execute(code)
+        self.executions += record
         output = {
             'stdout': '',
             'tracebacks': '',
             'data': [],
         }
         results = []
-        for result in self.read_all():
-            results.append(result)
-            if result['msg_type'] == 'status':
-                if result['content']['execution_state'] == 'idle':
-                    continue  # done in theory
-                elif result['content']['execution_state'] == 'busy':
-                    continue  # beginning execution
-                elif result['content']['execution_state'] == 'starting':
-                    continue
-                elif result['content']['execution_state'] == 'restarting':
+        deadline = time.time() + self.limits['wall_seconds'] if self.limits.get('wall_seconds') else None
+        while True:
+            try:
+                result = self.kc.get_iopub_msg(timeout=self._wait_time(timeout, deadline))
+            except Empty:
+                self._check_alive(output)
+                if deadline is not None and time.time() >= deadline:
+                    self._stop_for_wall_clock(output)
+                    deadline = None
                     continue
-                else:
-                    raise RuntimeError(f'Unknown execution state: {result["content"]["execution_state"]}')
-            elif result['msg_type'] == 'execute_input':
-                continue  # ignore
+                if timeout is None:
+                    continue  # silent, but alive
+                raise
+            if result['parent_header'].get('msg_id') != msg_id:
+                continue  # left over from an earlier request
+            results.append(result)
+            if self._handle_msg(result, output):
+                break
+            if result['msg_type'] not in ('status', 'execute_input'):
+                yield {**output, 'data': list(output['data'])}
+        while self.kc.get_shell_msg(timeout=timeout)['parent_header'].get('msg_id') != msg_id:
+            continue
+        if record:
+            self.history.append({
+                'code': code,
+                'output': output,
+                'results': results,
+            })
+        yield output
+
+    def kernel_alive(self):
+        return self.kernel_process.poll() is None and resources.kernel_alive(self.kernel_pid)
+
+    def _check_alive(self, output):
+        # a killed kernel just goes quiet (and its heartbeat lags), so silence is checked against the process itself
+        if not self.kernel_alive():
+            output['tracebacks'] += KERNEL_DIED
+            raise KernelDied(output)
+
+    def _wait_time(self, timeout, deadline):
+        # timeout=None waits for as long as the cell runs
+        if timeout is None:
+            timeout = LIVENESS_CHECK_SECONDS
+        if deadline is None:
+            return timeout
+        return max(min(timeout, deadline - time.time()), 0)
+
+    def _stop_for_wall_clock(self, output):
+        # the kernel answers the interrupt with a KeyboardInterrupt error and goes idle, which ends the exec
+        self.interrupt()
+        output['tracebacks'] += f"Execution stopped after {self.limits['wall_seconds']:g}s (wall clock limit)\n"
+
+    def interrupt(self):
+        resources.interrupt(self.kernel_pid)
+
+    def resource_usage(self):
+        return resources.usage(self.kernel_pid)
+
+    def history_size(self):
+        return self.history.size()
+
+    def _handle_msg(self, result, output):
+        # updates output in place, returns True once the kernel is done with the request
+        if result['msg_type'] == 'status':
+            if result['content']['execution_state'] == 'idle':
+                return True
+            elif result['content']['execution_state'] == 'busy':
+                return False  # beginning execution
+            elif result['content']['execution_state'] == 'starting':
+                return False
+            elif result['content']['execution_state'] == 'restarting':
+                return False
             else:
-                content = result['content']
-                if result['msg_type'] == 'stream':
-                    output['stdout'] += content['text']
-                elif result['msg_type'] == 'error':
-                    output['tracebacks'] += "\n".join(content['traceback'])
-                elif result['msg_type'] == 'display_data':
-                    output['data'].append(content['data'])
-                elif result['msg_type'] == 'execute_result':
-                    output['data'].append(content['data'])
-                else:
-                    raise RuntimeError(f'Unknown message type {result["msg_type"]}')
-        self.history.append({
-            'code': code,
-            'output': output,
-            'results': results,
-        })
-        return output
+                raise RuntimeError(f'Unknown execution state: {result["content"]["execution_state"]}')
+        elif result['msg_type'] == 'execute_input':
+            return False  # ignore
+        content = result['content']
+        if result['msg_type'] == 'stream':
+            output['stdout'] += content['text']
+        elif result['msg_type'] == 'error':
+            output['tracebacks'] += "\n".join(content['traceback'])
+        elif result['msg_type'] == 'display_data':
+            output['data'].append(content['data'])
+        elif result['msg_type'] == 'execute_result':
+            output['data'].append(content['data'])
+        else:
+            raise RuntimeError(f'Unknown message type {result["msg_type"]}')
+        return False
 
     def whos(self, type=None):
         if type:
-            return self.exec(f'%whos {type}')['stdout']
+            return self.exec(f'%whos {type}', record=False)['stdout']
         # assume it always responds w/ no error
-        return self.exec('%whos')['stdout']
+        return self.exec('%whos', record=False)['stdout']
 
-    def upload_file(self, filepath):
+    def upload_file(self, filepath, chunk_size=UPLOAD_CHUNK_SIZE):
+        # hard link when on the same filesystem, otherwise copy in fixed size chunks, never holding the file in memory
         filename = os.path.basename(filepath)
-        with open(filepath, 'rb') as f:
-            filebytes = f.read()
-        return self.upload_bytes(filebytes, filename=filename)
+        target = os.path.join(self.work_dir, filename)
+        start = time.time()
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(filepath, target)
+            method = 'link'
+        except OSError:
+            with open(filepath, 'rb') as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, chunk_size)
+            method = 'copy'
+        seconds = time.time() - start
+        size = os.path.getsize(target)
+        self.last_upload = {
+            'filename': filename,
+            'bytes': size,
+            'seconds': seconds,
+            'method': method,
+            'mb_per_s': size / 1e6 / seconds if seconds > 0 else None,
+        }
+        return filename
 
     def upload_bytes(self, filebytes, filename=None):
         if filename is None:
@@ -169,32 +431,349 @@ class REPL:
                 f.write(filebytes)
         return filename
 
-    def dataframes_as_csvs(self):
-        # find all dataframes or series
-        code_to_extract = f"""
-import json
-output = []
-for name, x in list(globals().items()):
-    if isinstance(x, pd.DataFrame) or isinstance(x, pd.Series):
-        try:
-            x.to_csv(name + '.csv')
-            output.append({{
-                'name': name,
-                'columns': list(x.columns),
-                'rows': len(x),
-                'type': 'DataFrame' if isinstance(x, pd.DataFrame) else 'Series',
-                'csv': '{self.work_dir}' + '/' + name + '.csv',
-            }})
-        except Exception as e:
-            pass
-print("FROMHERE:"+json.dumps(output)+":TOHERE")
+    def _helper_code(self, call):
+        # loads datadm/kernel_helpers.py into the kernel once (as `_datadm`), then prints `call` as json
+        return f"""
+if '_datadm' not in globals():
+    import types as _types
+    _datadm = _types.ModuleType('_datadm')
+    exec(compile(open({HELPERS_PATH!r}).read(), {HELPERS_PATH!r}, 'exec'), _datadm.__dict__)
+_datadm.emit({call})
 """
-        result = self.exec(code_to_extract)
-        frames = []
+
+    def start_trial(self, code, trial_id=None):
+        # runs `code` in a fork of the kernel without touching its namespace, `trial_results` collects the outcome
+        trial_id = trial_id or uuid.uuid4().hex
+        return self._exec_json(self._helper_code(f"_datadm.start_trial(globals(), {trial_id!r}, {code!r})"))
+
+    def trial_results(self, wait=0.5, timeout=TRIAL_TIMEOUT):
+        return self._exec_json(self._helper_code(f"_datadm.trial_results({wait!r}, {timeout!r})"), default={})
+
+    def cancel_trials(self):
+        return self._exec_json(self._helper_code("_datadm.cancel_trials()"), default=[])
+
+    def list_dataframes(self):
+        # cheap: names and shapes only, nothing is written to disk
+        return self._exec_json(self._helper_code("_datadm.list_frames(globals())"), default=[])
+
+    def _profile_code(self):
+        return self._helper_code(
+            f"_datadm.profile_frames(globals(), {PROFILE_SAMPLE_ROWS!r}, names={self._touched_since(self.profile_mark)!r})")
+
+    def _profiled(self, mark, profiles):
+        if profiles is None:
+            return []
+        self.profile_mark = mark
+        return profiles
+
+    def profile_dataframes(self):
+        # columns, dtypes, null counts and cardinality of every frame, only frames changed since the last call are profiled
+        mark = len(self.history)
+        return self._profiled(mark, self._exec_json(self._profile_code()))
+
+    def export_dataframe(self, name, format=None, wait=True):
+        # writes `name` to the work dir in a background thread of the kernel, unless it is unchanged since its last
+        # export. with wait=False this returns right away with status 'pending', poll it with `export_status`
+        format = format or self.export_format
+        return self._exec_json(self._helper_code(f"_datadm.export_frame(globals(), {name!r}, {self.work_dir!r}, {format!r}, wait={wait!r})"))
+
+    def export_status(self, name, format=None):
+        format = format or self.export_format
+        return self._exec_json(self._helper_code(f"_datadm.export_status(globals(), {name!r}, {format!r})"))
+
+    def memory_usage(self):
+        return self._exec_json(self._helper_code("_datadm.memory_usage(globals())"), default=[])
+
+    def optimize_memory(self, names=None):
+        # downcasts numerics (losslessly) and turns repetitive strings into categoricals, in place
+        return self._exec_json(self._helper_code(f"_datadm.optimize_memory(globals(), {names!r})"), default=[])
+
+    def dataframes_as_csvs(self):
+        return self._exec_json(self._helper_code(f"_datadm.export_frames(globals(), {self.work_dir!r})"), default=[])
+
+    def _parse_json_output(self, result, default=None):
         if result['stdout']:
             try:
                 jsonstring = result['stdout'].split('FROMHERE:')[1].split(':TOHERE')[0]
-                frames = json.loads(jsonstring)
+                return json.loads(jsonstring)
             except Exception as e:
                 print(e, result['stdout'])
-        return frames
+        return default
+
+    def _exec_json(self, code, default=None):
+        return self._parse_json_output(self.exec(code, record=False), default=default)
+
+    def _internal_json(self, code, timeout):
+        # `_exec_json` on the kernel as it is, for `evict` (other execs wait for it)
+        for output in self._exec_stream(code, timeout, False):
+            pass
+        return self._parse_json_output(output)
+
+
+class AsyncREPL(REPL):
+    # same surface as REPL, but every kernel call is awaitable so many sessions can share one event loop
+    def connect(self, n_retries=100):
+        # wait for the kernel with a blocking client, channels of the async client are started lazily
+        # on whichever event loop first uses this REPL (see `_ensure_channels`)
+        super().connect(n_retries=n_retries).stop_channels()
+        self.kc = AsyncKernelClient(connection_file=self.conn_file.name)
+        self.kc.load_connection_file()
+        self.loop = None
+        return self.kc
+
+    async def _ensure_channels(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        if self.loop is not None:
+            # zmq sockets are bound to the loop they were started on, so use a fresh client on this one
+            self.kc.stop_channels()
+            self.kc = AsyncKernelClient(connection_file=self.conn_file.name)
+            self.kc.load_connection_file()
+        self.kc.start_channels()
+        await self.kc.wait_for_ready(timeout=5)
+        self.loop = loop
+
+    async def exec(self, code, timeout=10, record=True):
+        async for output in self.exec_stream(code, timeout=timeout, record=record):
+            pass
+        return output
+
+    async def exec_stream(self, code, timeout=10, record=True):
+        # everything runs on one loop, so checking `evicting` and counting this exec in `busy` can't interleave with `evict`
+        while self.evicting is not None:
+            await self.evicting.wait()
+        self.busy += 1
+        try:
+            if self.evicted:
+                await self.revive()
+            elif not self.kernel_alive():
+                print(f"Kernel {self.uid} died, rebuilding it from history")
+                await self.recover()
+            try:
+                async for output in self._exec_stream(code, timeout, record):
+                    yield output
+            except KernelDied as e:
+                print(f"Kernel {self.uid} died, rebuilding it from history")
+                await self.recover()
+                yield e.output
+        finally:
+            self.busy -= 1
+            self.last_activity = time.time()
+
+    async def _exec_stream(self, code, timeout, record):
+        await self._ensure_channels()
+        msg_id = self.kc.execute(code)
+        self.executions += record
+        output = {
+            'stdout': '',
+            'tracebacks': '',
+            'data': [],
+        }
+        results = []
+        deadline = time.time() + self.limits['wall_seconds'] if self.limits.get('wall_seconds') else None
+        while True:
+            try:
+                result = await self.kc.get_iopub_msg(timeout=self._wait_time(timeout, deadline))
+            except Empty:
+                self._check_alive(output)
+                if deadline is not None and time.time() >= deadline:
+                    self._stop_for_wall_clock(output)
+                    deadline = None
+                    continue
+                if timeout is None:
+                    continue  # silent, but alive
+                raise
+            if result['parent_header'].get('msg_id') != msg_id:
+                continue  # left over from an earlier request
+            results.append(result)
+            if self._handle_msg(result, output):
+                break
+            if result['msg_type'] not in ('status', 'execute_input'):
+                yield {**output, 'data': list(output['data'])}
+        while (await self.kc.get_shell_msg(timeout=timeout))['parent_header'].get('msg_id') != msg_id:
+            continue
+        if record:
+            self.history.append({
+                'code': code,
+                'output': output,
+                'results': results,
+            })
+        yield output
+
+    async def evict(self):
+        if self.evicted or self.busy or self.evicting is not None:
+            return None
+        self.evicting = asyncio.Event()
+        try:
+            info = await self._internal_json(self._helper_code(f"_datadm.checkpoint(globals(), {self.checkpoint_path!r})"), CHECKPOINT_TIMEOUT)
+            if info is not None:
+                self.shutdown()
+                self.evicted = True
+            return info
+        finally:
+            evicting, self.evicting = self.evicting, None
+            evicting.set()
+
+    async def revive(self):
+        self.evicted = False
+        self.revivals += 1
+        self.last_activity = time.time()
+        await asyncio.get_running_loop().run_in_executor(None, lambda: (self._start_kernel(), self.connect()))
+        if self.setup is not None:
+            n, marks = len(self.history), dict(self.snapshot_history)
+            await self.setup(self)
+            del self.history[n:]
+            self._set_up_again(n, marks)
+        self.snapshot_mark = self.profile_mark = None
+        info = await self._exec_json(self._helper_code(f"_datadm.restore_checkpoint(globals(), {self.checkpoint_path!r})"))
+        return info if info is not None else await self.replay()
+
+    async def snapshot(self, snapshot_id=None):
+        snapshot_id = snapshot_id or uuid.uuid4().hex
+        return self._snapshot_taken(snapshot_id, await self._exec_json(self._snapshot_code(snapshot_id)))
+
+    async def restore(self, snapshot_id):
+        info = await self._exec_json(self._helper_code(f"_datadm.restore_snapshot(globals(), {snapshot_id!r}, {self.snapshot_dir!r})"))
+        upto = self.snapshot_history.get(snapshot_id)
+        if info is None and upto is not None:
+            info = await self.recover(upto=upto)
+        if info is not None and upto is not None:
+            del self.history[upto:]
+        self.snapshot_mark = upto if info is not None else None
+        self.profile_mark = None  # values changed without a cell, and history may be shorter than the mark
+        return info
+
+    async def profile_dataframes(self):
+        mark = len(self.history)
+        return self._profiled(mark, await self._exec_json(self._profile_code()))
+
+    async def cache_artifact(self, name):
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        status = await self._exec_json(self._helper_code(f"_datadm.export_frame(globals(), {name!r}, {self.artifact_dir!r}, 'pickle', keyed=True)"))
+        return self._record_artifact(name, status)
+
+    async def replay(self, names=None, upto=None, use_artifacts=True):
+        start = time.time()
+        codes = self._replay_code(names, upto, use_artifacts)
+        for code in codes:
+            await self.exec(code, timeout=REPLAY_TIMEOUT, record=False)
+        return {'cells': len(codes), 'history': len(self.history[:upto]), 'seconds': time.time() - start}
+
+    async def recover(self, names=None, upto=None):
+        self.shutdown()
+        await asyncio.get_running_loop().run_in_executor(None, lambda: (self._start_kernel(), self.connect()))
+        return await self.replay(names, upto)
+
+    async def whos(self, type=None):
+        if type:
+            return (await self.exec(f'%whos {type}', record=False))['stdout']
+        return (await self.exec('%whos', record=False))['stdout']
+
+    async def upload_file(self, filepath, chunk_size=UPLOAD_CHUNK_SIZE):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(REPL.upload_file, self, filepath, chunk_size=chunk_size))
+
+    async def upload_bytes(self, filebytes, filename=None):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(REPL.upload_bytes, self, filebytes, filename=filename))
+
+    async def _exec_json(self, code, default=None):
+        return self._parse_json_output(await self.exec(code, record=False), default=default)
+
+    async def _internal_json(self, code, timeout):
+        async for output in self._exec_stream(code, timeout, False):
+            pass
+        return self._parse_json_output(output)
+
+
+async def _done(value):
+    return value
+
+
+async def _aiter(iterator):
+    for item in iterator:
+        yield item
+
+
+class AwaitableREPL:
+    # the AsyncREPL surface over a blocking REPL, so sync callers can run async agent code (see `Agent.bot`).
+    # every call blocks the event loop it is awaited on, which is fine for a loop that only runs one turn
+    def __init__(self, repl):
+        self.repl = repl
+
+    def __getattr__(self, name):
+        attr = getattr(self.repl, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return _aiter(result) if inspect.isgenerator(result) else _done(result)
+        return call
+
+
+class KernelPool:
+    # keeps `size` kernels spawned (and set up) ahead of time, so a new session doesn't pay kernel startup
+    def __init__(self, size=2, setup=None, repl_class=REPL, **repl_kwargs):
+        self.size = size
+        self.setup = setup
+        self.repl_class = repl_class
+        self.repl_kwargs = repl_kwargs
+        self.ready = Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+        self.refill_latencies = []
+
+    def start(self):
+        with self.lock:
+            n_missing = self.size - self.ready.qsize() - self.pending
+            self.pending += max(n_missing, 0)
+        for _ in range(n_missing):
+            threading.Thread(target=self._refill, daemon=True).start()
+
+    def _spawn(self):
+        repl = self.repl_class(**self.repl_kwargs)
+        if self.setup is not None:
+            result = self.setup(repl)
+            if inspect.isawaitable(result):
+                asyncio.run(result)
+            repl.setup = self.setup
+        return repl
+
+    def _refill(self):
+        start = time.time()
+        try:
+            self.ready.put(self._spawn())
+            with self.lock:
+                self.refill_latencies = (self.refill_latencies + [time.time() - start])[-100:]
+        except Exception as e:
+            print(f"Error pre-warming kernel: {e}")
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def get(self):
+        try:
+            repl = self.ready.get_nowait()
+            with self.lock:
+                self.hits += 1
+        except Empty:
+            with self.lock:
+                self.misses += 1
+            repl = self._spawn()
+        self.start()
+        return repl
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.refill_latencies)
+            return {
+                'size': self.size,
+                'available': self.ready.qsize(),
+                'pending': self.pending,
+                'hits': self.hits,
+                'misses': self.misses,
+                'last_refill_seconds': latencies[-1] if latencies else None,
+                'avg_refill_seconds': sum(latencies) / len(latencies) if latencies else None,
+            }
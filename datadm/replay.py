@@ -0,0 +1,105 @@
+import ast
+import functools
+import os
+
+
+class _Names(ast.NodeVisitor):
+    # names a top level statement reads from / writes to the kernel namespace, erring on the side of too many
+    def __init__(self):
+        self.reads, self.writes = set(), set()
+
+    def visit_Name(self, node):
+        (self.writes if isinstance(node.ctx, (ast.Store, ast.Del)) else self.reads).add(node.id)
+
+    def _target(self, node):
+        # `df['a'] = ...`, `df.x = ...` and `del df['a']` change `df` in place
+        while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+            node = node.value
+        if isinstance(node, ast.Name):
+            self.reads.add(node.id)
+            self.writes.add(node.id)
+
+    def _visit_targets(self, targets):
+        for target in targets:
+            if isinstance(target, (ast.Attribute, ast.Subscript)):
+                self._target(target)
+            elif isinstance(target, (ast.Tuple, ast.List)):
+                self._visit_targets(target.elts)
+
+    def visit_Assign(self, node):
+        self._visit_targets(node.targets)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        self._target(node.target)
+        if isinstance(node.target, ast.Name):
+            self.reads.add(node.target.id)
+        self.generic_visit(node)
+
+    def visit_Delete(self, node):
+        self._visit_targets(node.targets)
+        self.generic_visit(node)
+
+    def visit_Expr(self, node):
+        # a call whose result is thrown away is probably there for its side effect, eg. `df.dropna(inplace=True)`
+        if isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Attribute):
+            self._target(node.value.func.value)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.writes.add((alias.asname or alias.name).split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def _visit_def(self, node):
+        self.writes.add(node.name)
+        self.generic_visit(node)
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_ClassDef = _visit_def
+
+
+def _strip_magics(code):
+    # ipython syntax (%magic, !shell) can't be parsed, those lines are ignored
+    return '\n'.join(line for line in code.split('\n') if not line.lstrip().startswith(('%', '!')))
+
+
+@functools.lru_cache(maxsize=4096)
+def analyze(code):
+    # returns (names read before the cell writes them, names written), or None if the code can't be parsed
+    try:
+        tree = ast.parse(_strip_magics(code))
+    except SyntaxError:
+        return None
+    reads, writes = set(), set()
+    for statement in tree.body:
+        names = _Names()
+        names.visit(statement)
+        reads |= names.reads - writes
+        writes |= names.writes
+    return frozenset(reads), frozenset(writes)
+
+
+def plan(cells, names=None, use_artifacts=True):
+    # [(index, code)] of the cells needed to rebuild `names` (default: everything the cells define), walking backwards
+    # from the last cell and following what each selected cell reads. cells with cached artifacts are loaded from those
+    analyses = [analyze(cell['code']) for cell in cells]
+    needed = set(names) if names is not None else set().union(*[a[1] for a in analyses if a is not None])
+    selected = []
+    for i in reversed(range(len(cells))):
+        if analyses[i] is None:
+            continue
+        reads, writes = analyses[i]
+        if writes & needed:
+            code = artifact_code(cells[i], writes) if use_artifacts else None
+            selected.append((i, code or cells[i]['code']))
+            needed = (needed - writes) | (set() if code else reads)
+    return selected[::-1]
+
+
+def artifact_code(cell, writes):
+    # loads the cached copies of what `cell` wrote instead of running it, or None if they are missing
+    artifacts = cell.get('artifacts') or {}
+    if not artifacts or not set(writes) <= set(artifacts) or not all(os.path.exists(p) for p in artifacts.values()):
+        return None
+    return '\n'.join(f"{name} = __import__('pandas').read_pickle({path!r})" for name, path in artifacts.items())
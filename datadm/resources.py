@@ -0,0 +1,293 @@
+import os
+import signal
+import sys
+import threading
+import time
+import weakref
+
+try:
+    import resource
+except ImportError:  # not on posix
+    resource = None
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def limits_from_env():
+    # per kernel limits, unset means unlimited
+    limits = {}
+    for key, env in [
+        ('memory_mb', 'DATADM_KERNEL_MEMORY_MB'),
+        ('cpu_seconds', 'DATADM_KERNEL_CPU_SECONDS'),
+        ('cpu_percent', 'DATADM_KERNEL_CPU_PERCENT'),
+        ('wall_seconds', 'DATADM_KERNEL_WALL_SECONDS'),
+    ]:
+        if os.environ.get(env):
+            limits[key] = float(os.environ[env])
+    return limits
+
+
+def _own_cgroup():
+    # only cgroups v2 (the unified "0::" hierarchy) is supported
+    if not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+        return None
+    with open('/proc/self/cgroup') as f:
+        for line in f:
+            if line.startswith('0::'):
+                return os.path.join(CGROUP_ROOT, line.strip()[3:].lstrip('/'))
+    return None
+
+
+_lock = threading.Lock()
+_parent = None  # (cgroup the kernels' cgroups are created in, or None, why not), set up once
+_warned = set()
+
+
+def _warn(message):
+    if message not in _warned:
+        _warned.add(message)
+        print(message)
+
+
+def _setup_parent():
+    # a cgroup with processes of its own can't hand controllers to its children (cgroups v2 "no internal processes"
+    # rule, the root cgroup is exempt). DATADM_CGROUP names one the server isn't in (eg. a systemd slice with
+    # Delegate=yes). Otherwise the server's own cgroup is used if it can be, and with DATADM_CGROUP_MOVE_SERVER=1 the
+    # server moves out of it into a leaf `datadm-server`, next to where the kernels go
+    parent = os.environ.get('DATADM_CGROUP')
+    if parent:
+        parent = os.path.join(CGROUP_ROOT, parent.lstrip('/')) if not parent.startswith(CGROUP_ROOT) else parent
+    else:
+        parent = _own_cgroup()
+        if parent is None:
+            return None, "cgroups v2 is not available"
+    try:
+        _enable_controllers(parent)
+    except OSError as e:
+        if parent != _own_cgroup():
+            return None, f"{parent} can't be used ({e}), set DATADM_CGROUP to a delegated cgroup"
+        if os.environ.get('DATADM_CGROUP_MOVE_SERVER') != '1':
+            return None, (f"the server's own cgroup {parent} can't be used ({e}), set DATADM_CGROUP to a delegated "
+                          f"cgroup, or DATADM_CGROUP_MOVE_SERVER=1 to move the server into {parent}/datadm-server")
+        try:
+            leaf = os.path.join(parent, 'datadm-server')
+            os.makedirs(leaf, exist_ok=True)
+            with open(os.path.join(leaf, 'cgroup.procs'), 'w') as f:
+                f.write(str(os.getpid()))
+            print(f"Moved the server (pid {os.getpid()}) into {leaf}, kernels get cgroups next to it")
+            _enable_controllers(parent)
+        except OSError as e:
+            return None, f"{parent} can't be used ({e}), other processes may share it: set DATADM_CGROUP to a delegated cgroup"
+    return parent, None
+
+
+def _enable_controllers(parent):
+    with open(os.path.join(parent, 'cgroup.subtree_control'), 'w') as f:
+        f.write('+memory +cpu')
+
+
+def create_cgroup(name, limits):
+    # returns the path of a cgroup enforcing memory_mb / cpu_percent, or None (with a warning) if we can't manage
+    # cgroups here. memory_mb then falls back to an address space rlimit, cpu_percent is not enforced
+    if not (limits.get('memory_mb') or limits.get('cpu_percent')):
+        return None
+    global _parent
+    with _lock:
+        if _parent is None:
+            _parent = _setup_parent()
+    parent, error = _parent
+    if parent is None:
+        _warn(f"Kernel memory / cpu% limits need a cgroup: {error}")
+        return None
+    try:
+        path = os.path.join(parent, name)
+        os.makedirs(path, exist_ok=True)
+        if limits.get('memory_mb'):
+            with open(os.path.join(path, 'memory.max'), 'w') as f:
+                f.write(str(int(limits['memory_mb'] * 1024 * 1024)))
+        if limits.get('cpu_percent'):
+            period = 100000
+            with open(os.path.join(path, 'cpu.max'), 'w') as f:
+                f.write(f"{int(period * limits['cpu_percent'] / 100)} {period}")
+        return path
+    except OSError as e:
+        _warn(f"Kernel memory / cpu% limits need a cgroup: can't create one in {parent} ({e})")
+        return None
+
+
+def remove_cgroup(path):
+    if path is not None:
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+
+# runs in place of the kernel command and execs it, a fresh single threaded process (unlike the server, where a
+# `preexec_fn` could deadlock on a lock another thread held at fork): joins the cgroup, or falls back to capping address
+# space per process (larger than what it actually uses), then sets the cpu time rlimit. Everything it spawns inherits them
+_LIMIT_SHIM = """
+import os, sys
+cgroup, memory, cpu = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+in_cgroup = False
+if cgroup:
+    try:
+        with open(os.path.join(cgroup, 'cgroup.procs'), 'w') as f:
+            f.write(str(os.getpid()))
+        in_cgroup = True
+    except OSError:
+        pass
+try:
+    import resource
+except ImportError:
+    resource = None
+if resource is not None and memory and not in_cgroup:
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+if resource is not None and cpu:
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+os.execvp(sys.argv[4], sys.argv[4:])
+"""
+
+
+def limited(command, limits, cgroup=None):
+    # `command` wrapped to run under `limits` (memory_mb, cpu_seconds) and in `cgroup`
+    memory = int(limits.get('memory_mb', 0) * 1024 * 1024)
+    cpu = int(limits.get('cpu_seconds', 0))
+    if cgroup is None and not memory and not cpu:
+        return command
+    return [sys.executable, '-c', _LIMIT_SHIM, cgroup or '', str(memory), str(cpu)] + list(command)
+
+
+def _stat(pid):
+    # (parent pid, cpu ticks, rss pages) from /proc/<pid>/stat
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21])
+
+
+# /proc/<pid>/task/<tid>/children (CONFIG_PROC_CHILDREN) lists a process' children without scanning all of /proc
+PROC_CHILDREN = os.path.exists(f'/proc/self/task/{os.getpid()}/children')
+
+
+def _children(pid):
+    children = []
+    try:
+        for tid in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{tid}/children') as f:
+                children += [int(c) for c in f.read().split()]
+    except OSError:
+        pass  # gone (or one of its threads is)
+    return children
+
+
+def process_tree(pid):
+    if PROC_CHILDREN:
+        children = _children
+    else:
+        parents = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    parents.setdefault(_stat(int(entry))[0], []).append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    continue
+        children = lambda p: parents.get(p, [])
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children(p))
+    return tree
+
+
+def _state(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        return f.read().rsplit(')', 1)[1].split()[0]
+
+
+def kernel_alive(pid):
+    # `pid` is the `jupyter-kernel` launcher, which outlives the kernel it started when that is killed (eg. for memory,
+    # or by an rlimit) and keeps it around as a zombie, so the kernel is alive while the launcher has a live child
+    for p in process_tree(pid)[1:]:
+        try:
+            if _state(p) not in ('Z', 'X'):
+                return True
+        except (OSError, IndexError):
+            continue  # exited meanwhile
+    return False
+
+
+def interrupt(pid):
+    # `pid` is the `jupyter-kernel` launcher, the actual kernel is its child, which handles SIGINT as KeyboardInterrupt
+    for p in process_tree(pid)[1:]:
+        try:
+            os.kill(p, signal.SIGINT)
+        except OSError:
+            pass
+
+
+def usage(pid):
+    # total rss (bytes) and cpu time (seconds) of the kernel process tree, None if it can't be read
+    if not os.path.exists(f'/proc/{pid}'):
+        return None
+    rss, cpu = 0, 0
+    try:
+        for p in process_tree(pid):
+            try:
+                _, ticks, pages = _stat(p)
+            except OSError:
+                continue
+            rss += pages * os.sysconf('SC_PAGE_SIZE')
+            cpu += ticks / CLOCK_TICKS
+    except OSError:
+        return None
+    return {'rss_bytes': rss, 'cpu_seconds': cpu}
+
+
+class ResourceMonitor:
+    # samples rss and cpu% of every registered REPL's kernel in a background thread
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.repls = weakref.WeakSet()
+        self.samples = weakref.WeakKeyDictionary()
+        self.thread = None
+
+    def register(self, repl):
+        self.repls.add(repl)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def sample(self, repl):
+        now = time.time()
+        current = usage(repl.kernel_pid)
+        if current is None:
+            return None
+        previous = self.samples.get(repl)
+        current['time'] = now
+        current['cpu_percent'] = None
+        if previous is not None and now > previous['time']:
+            current['cpu_percent'] = 100 * (current['cpu_seconds'] - previous['cpu_seconds']) / (now - previous['time'])
+        self.samples[repl] = current
+        return current
+
+    def _run(self):
+        while True:
+            for repl in list(self.repls):
+                self.sample(repl)
+            time.sleep(self.interval)
+
+    def latest(self, repl):
+        return self.samples.get(repl)
+
+    def totals(self):
+        samples = [s for s in list(self.samples.values()) if s is not None]
+        return {
+            'kernels': len(samples),
+            'rss_bytes': sum(s['rss_bytes'] for s in samples),
+            'cpu_percent': sum(s['cpu_percent'] or 0 for s in samples),
+        }
+
+
+monitor = ResourceMonitor()
@@ -0,0 +1,116 @@
+import asyncio
+import inspect
+import os
+import threading
+import time
+import weakref
+
+from datadm import resources
+
+
+def _env_float(name, default):
+    return float(os.environ[name]) if os.environ.get(name) else default
+
+
+class SessionManager:
+    # evicts idle kernels to a checkpoint on disk (they come back on the next exec) and expires abandoned sessions
+    def __init__(self, idle_seconds=None, expire_seconds=None, memory_budget_mb=None, interval=30):
+        self.idle_seconds = idle_seconds if idle_seconds is not None else _env_float('DATADM_KERNEL_IDLE_SECONDS', 15 * 60)
+        self.expire_seconds = expire_seconds if expire_seconds is not None else _env_float('DATADM_SESSION_EXPIRE_SECONDS', 24 * 60 * 60)
+        # total rss of all live kernels, the least recently used ones are evicted above it
+        self.memory_budget_mb = memory_budget_mb if memory_budget_mb is not None else _env_float('DATADM_KERNEL_MEMORY_BUDGET_MB', None)
+        self.interval = interval
+        self.repls = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counts = {'evicted': 0, 'expired': 0}
+
+    def track(self, repl):
+        self.repls.add(repl)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _call(self, repl, method):
+        # AsyncREPL methods have to run on the loop its kernel client belongs to
+        result = method()
+        if not inspect.isawaitable(result):
+            return result
+        if getattr(repl, 'loop', None) is not None and repl.loop.is_running():
+            return asyncio.run_coroutine_threadsafe(result, repl.loop).result()
+        return asyncio.run(result)
+
+    def evict(self, repl):
+        # `repl.evict` itself checks the kernel is idle, on its loop for an AsyncREPL, an exec can start until then
+        with self.lock:
+            if repl.evicted:
+                return None
+            try:
+                info = self._call(repl, repl.evict)
+            except Exception as e:
+                print(f"Failed to evict kernel {repl.uid}: {e}")
+                return None
+            self.counts['evicted'] += info is not None
+            return info
+
+    def expire(self, repl):
+        # drops the checkpoint, history and uploads too, if the session comes back after all it gets an empty kernel
+        with self.lock:
+            repl.shutdown()
+            repl.evicted = True
+            repl.runtime_dir.cleanup()
+            del repl.history[:]
+            repl.snapshot_history.clear()
+            repl.profile_mark = None
+            resources.remove_cgroup(repl.cgroup)
+            self.repls.discard(repl)
+            self.counts['expired'] += 1
+
+    def candidates(self, now=None):
+        # (repls to evict, repls to expire), least recently active first
+        now = now or time.time()
+        repls = sorted(list(self.repls), key=lambda r: r.last_activity)
+        expire = [r for r in repls if now - r.last_activity > self.expire_seconds]
+        live = [r for r in repls if not r.evicted and not r.busy and r not in expire]
+        evict = [r for r in live if now - r.last_activity > self.idle_seconds]
+        if self.memory_budget_mb:
+            usage = {r: resources.usage(r.kernel_pid) or {'rss_bytes': 0} for r in repls if not r.evicted}
+            total = sum(u['rss_bytes'] for u in usage.values())
+            for r in evict:
+                total -= usage[r]['rss_bytes']
+            for r in live:
+                if total <= self.memory_budget_mb * 1024 * 1024:
+                    break
+                if r not in evict:
+                    evict.append(r)
+                    total -= usage[r]['rss_bytes']
+        return evict, expire
+
+    def reap(self):
+        evict, expire = self.candidates()
+        for repl in expire:
+            self.expire(repl)
+        for repl in evict:
+            self.evict(repl)
+
+    def _run(self):
+        while True:
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Session reaper failed: {e}")
+            time.sleep(self.interval)
+
+    def stats(self):
+        repls = list(self.repls)
+        return {
+            'live': sum(not r.evicted for r in repls),
+            'idle': sum(r.evicted for r in repls),
+            'revived': sum(r.revivals for r in repls),
+            **self.counts,
+        }
+
+
+session_manager = SessionManager()
@@ -0,0 +1,97 @@
+import asyncio
+import contextlib
+import time
+from queue import Empty
+
+import pytest
+
+import datadm.agent
+from datadm.agent import Agent
+from datadm.agents.speculative import Speculative
+from datadm.repl import REPL, AwaitableREPL
+
+
+class FakeManager:
+    @contextlib.contextmanager
+    def use(self, model_selection):
+        yield object()
+
+
+class SilentCell(Agent):
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    async def _abot(self, repl, conversation, llm):
+        async for output in repl.exec_stream("runs.append(1)\ntime.sleep(1.5)\nprint('done')", timeout=self.timeout):
+            yield conversation + [{'role': 'assistant', 'content': output}]
+
+
+def run(agent, repl):
+    async def turn():
+        async for _, conversation in agent.abot(AwaitableREPL(repl), [{'role': 'user', 'content': 'hi'}], 'fake'):
+            pass
+        return conversation
+    return asyncio.run(turn())
+
+
+def test_silent_cell_runs_once(monkeypatch):
+    monkeypatch.setattr(datadm.agent, 'llm_manager', FakeManager())
+    monkeypatch.setattr('datadm.repl.LIVENESS_CHECK_SECONDS', 0.2)
+    repl = REPL()
+    repl.exec("import time\nruns = []")
+    # agent execs wait for as long as a silent cell runs
+    assert run(SilentCell(timeout=None), repl)[-1]['content']['stdout'] == 'done\n'
+    # a cell that was sent is never run again, even when it fails before any output arrives
+    with pytest.raises(Empty):
+        run(SilentCell(timeout=0.5), repl)
+    time.sleep(1.5)
+    assert repl.exec("print(len(runs))")['stdout'] == '2\n'
+
+
+class Scripted:
+    # stands in for the guidance program: each call streams the next response, the later ones a little later
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def __call__(self, **kwargs):
+        delay, response = 0.3 * (3 - len(self.responses)), self.responses.pop(0)
+
+        async def stream():
+            await asyncio.sleep(delay)
+            yield {'response': response}
+        return stream()
+
+
+def speculate(monkeypatch, repl, responses):
+    monkeypatch.setattr(datadm.agent, 'llm_manager', FakeManager())
+    monkeypatch.setattr('datadm.agents.speculative.CANDIDATES', len(responses))
+    agent = Speculative()
+    program = Scripted(responses)
+    monkeypatch.setattr(agent, 'program', lambda *args, **kwargs: program)
+    return run(agent, repl)
+
+
+def code(text):
+    return f"Let's see\n```python\n{text}\n```"
+
+
+def test_speculative_runs_each_cell_once(monkeypatch):
+    repl = REPL()
+    repl.exec("runs = []")
+    # the first response runs in the kernel itself, once (a fork would have written the file too)
+    first = code("runs.append('a')\nopen('runs.log', 'a').write('a')\nprint('a')")
+    conversation = speculate(monkeypatch, repl, [first, code("runs.append('b')"), code("runs.append('c')")])
+    assert conversation[-1]['content']['stdout'] == 'a\n' and conversation[-2]['content'] == first
+    assert repl.exec("print(runs, open('runs.log').read())")['stdout'] == "['a'] a\n"
+    # one that fails is undone, the others race in forks and the winner runs for real
+    conversation = speculate(monkeypatch, repl, [code("runs.append('d')\n1/0"), code("runs.append('e')\nprint('e')"), code("undefined")])
+    assert conversation[-1]['content']['stdout'] == 'e\n'
+    assert repl.exec("print(runs)")['stdout'] == "['a', 'e']\n"
+    # every one failing shows the first, the kernel as it was before it
+    conversation = speculate(monkeypatch, repl, [code("runs.append('f')\n1/0"), code("undefined")])
+    assert 'ZeroDivisionError' in conversation[-1]['content']['tracebacks']
+    assert repl.exec("print(runs)")['stdout'] == "['a', 'e']\n"
+    # a response without code is an answer
+    conversation = speculate(monkeypatch, repl, ["No code needed, the answer is 42", code("runs.append('g')")])
+    assert conversation[-1]['content'] == "No code needed, the answer is 42"
+    assert repl.exec("print(runs)")['stdout'] == "['a', 'e']\n"
@@ -0,0 +1,123 @@
+import time
+
+import torch
+from transformers import GPTBigCodeConfig, GPTBigCodeForCausalLM
+
+from datadm.backend import BackendLLMManager, PrefixKVCache, QuantizedStarChat, _packed_bytes
+from datadm.batching import BatchScheduler, GenerationRequest
+
+
+class FakeLLM:
+    def __init__(self, size):
+        self.size = size
+        self.closed = False
+
+    def footprint(self):
+        return self.size
+
+    def close(self):
+        self.closed = True
+
+
+class FakeManager(BackendLLMManager):
+    def _create(self, llm_name):
+        time.sleep(0.1)
+        return FakeLLM(60)
+
+
+def wait_ready(manager, llm_name):
+    for _ in range(100):
+        if manager.llms[llm_name]['state'] == 'ready':
+            return manager.llms[llm_name]['llm']
+        time.sleep(0.05)
+    raise AssertionError(manager.model_status(llm_name))
+
+
+def test_model_residency():
+    manager = FakeManager(budget_bytes=100)
+    manager.llms = {name: dict(state='unloaded', llm=None, mode='cuda', footprint_bytes=50, users=0, last_used=0, started=None, error=None)
+                    for name in ['a', 'b']}
+    assert manager.load('a')[0][1] in ['queued', 'loading']
+    a = wait_ready(manager, 'a')
+    # 'a' is generating, so it stays even though both don't fit
+    with manager.use('a'):
+        manager.load('b')
+        wait_ready(manager, 'b')
+        assert manager.llms['a']['state'] == 'ready'
+    # now it is idle, so it goes to make room
+    manager.unload('b')
+    manager.load('b')
+    wait_ready(manager, 'b')
+    assert manager.llms['a']['state'] == 'unloaded' and a.closed
+    assert manager.model_status('b') == [('b (0.0GB)', 'ready')]
+    # cpu models have a budget of their own
+    manager.llms['c'] = dict(state='unloaded', llm=None, mode='cpu', footprint_bytes=50, users=0, last_used=0, started=None, error=None)
+    manager.load('c')
+    wait_ready(manager, 'c')
+    assert manager.llms['b']['state'] == 'ready'
+
+
+def test_prefix_cache_matches_generate():
+    torch.manual_seed(0)
+    model = GPTBigCodeForCausalLM(GPTBigCodeConfig(vocab_size=64, n_positions=256, n_embd=32, n_layer=2, n_head=2,
+                                                   eos_token_id=None)).eval()
+    cache = PrefixKVCache()
+    scheduler = BatchScheduler(model, max_batch=4, prefix_cache=cache)
+    system = [1 + (7 * j) % 60 for j in range(20)]
+
+    def generate(prompt):
+        request = scheduler.submit(GenerationRequest(prompt, 10))
+        request.result(timeout=60)
+        expected = model.generate(torch.tensor([prompt]), max_new_tokens=10, do_sample=False, pad_token_id=0)
+        assert request.tokens == expected[0, len(prompt):].tolist()
+        return request.tokens
+
+    first = generate(system + [5, 6])
+    assert cache.last == {'prompt_tokens': 22, 'reused_tokens': 0}
+    # the next turn of a chat starts after its previous prompt and answer (but the answer's last token, which has no
+    # key / value yet), a new chat after the system prompt
+    generate(system + [5, 6] + first + [9, 10, 11])
+    assert cache.last == {'prompt_tokens': 35, 'reused_tokens': 31}
+    generate(system + [30, 31])
+    assert cache.last == {'prompt_tokens': 22, 'reused_tokens': 20}
+    assert cache.stats == {'requests': 3, 'reused_tokens': 51, 'prompt_tokens': 79}
+
+
+def test_prefix_cache_eviction():
+    def past(n):  # 64 bytes per token
+        return ((torch.zeros(1, 2, n, 4), torch.zeros(1, 2, n, 4)),)
+    cache = PrefixKVCache(max_bytes=64 * 25)
+    cache.store(list(range(10)), past(10))
+    cache.store(list(range(20, 30)), past(10))
+    cache.store(list(range(15)), past(15))  # covers the first entry
+    assert len(cache.entries) == 2 and cache.total_bytes == 64 * 25
+    cache.store(list(range(40, 50)), past(10))  # over the budget, the least recently used goes
+    assert cache.lookup([20, 21]) == ([], None)
+    assert cache.total_bytes == 64 * 25
+    tokens, trimmed = cache.lookup([0, 1, 2, 99])
+    assert tokens == [0, 1, 2] and trimmed[0][0].shape == (1, 2, 3, 4)
+    cache.store(list(range(60, 70)), past(10))  # the lookup made the entry recently used
+    assert [tokens[0] for tokens, _, _ in cache.entries.values()] == [0, 60]
+    cache.clear()
+    assert cache.total_bytes == 0 and cache.lookup([0]) == ([], None)
+
+
+def test_quantized_load(tmp_path):
+    torch.manual_seed(0)
+    model = GPTBigCodeForCausalLM(GPTBigCodeConfig(vocab_size=256, n_positions=128, n_embd=128, n_layer=2, n_head=4,
+                                                   eos_token_id=None)).eval()
+    model.save_pretrained(tmp_path)
+    quantized = QuantizedStarChat.load_model(str(tmp_path))
+    linears = [m for m in model.modules() if isinstance(m, torch.nn.Linear)]
+    assert not any(type(m) is torch.nn.Linear for m in quantized.modules())
+    # an int8 per weight, plus the fp32 bias and per channel scale (fp64) and zero point (int64) of each output
+    expected = sum(m.weight.numel() + (4 if m.bias is not None else 0) * m.out_features + 16 * m.out_features for m in linears)
+    assert _packed_bytes(quantized) == expected
+    assert quantized.get_memory_footprint() + _packed_bytes(quantized) < model.get_memory_footprint() / 2
+    prompt = torch.tensor([[1, 2, 3, 4, 5, 6, 7, 8]])
+    with torch.no_grad():
+        logits, quantized_logits = model(prompt).logits, quantized(prompt).logits
+    assert (logits - quantized_logits).abs().max() < 0.2 * logits.std()
+    assert (logits.argmax(-1) == quantized_logits.argmax(-1)).float().mean() >= 0.9
+    greedy = [m.generate(prompt, max_new_tokens=10, do_sample=False, pad_token_id=0)[0, 8:].tolist() for m in [model, quantized]]
+    assert greedy[0] == greedy[1]
@@ -0,0 +1,37 @@
+import torch
+from transformers import GPTBigCodeConfig, GPTBigCodeForCausalLM
+
+from datadm.batching import BatchScheduler, GenerationRequest
+
+
+def test_batched_generation_matches_generate():
+    torch.manual_seed(0)
+    model = GPTBigCodeForCausalLM(GPTBigCodeConfig(vocab_size=64, n_positions=256, n_embd=32, n_layer=2, n_head=2,
+                                                   eos_token_id=None)).eval()
+    scheduler = BatchScheduler(model, max_batch=4)
+    prompts = [[1 + (i * j) % 60 for j in range(5 + 7 * i)] for i in range(6)]
+    requests = [scheduler.submit(GenerationRequest(p, 10 + i)) for i, p in enumerate(prompts)]
+    cancelled = scheduler.submit(GenerationRequest(prompts[0], 200))
+    cancelled.cancel()
+    for request, prompt in zip(requests, prompts):
+        request.result(timeout=60)
+        expected = model.generate(torch.tensor([prompt]), max_new_tokens=len(request.tokens), do_sample=False, pad_token_id=0)
+        assert request.tokens == expected[0, len(prompt):].tolist()
+    cancelled.result(timeout=60)
+    assert cancelled.finish_reason == 'cancelled' and len(cancelled.tokens) < 200
+
+
+def test_sampling_options():
+    torch.manual_seed(0)
+    model = GPTBigCodeForCausalLM(GPTBigCodeConfig(vocab_size=64, n_positions=256, n_embd=32, n_layer=2, n_head=2,
+                                                   eos_token_id=None)).eval()
+    scheduler = BatchScheduler(model, max_batch=4)
+    prompt = [1, 2, 3, 4]
+    greedy = scheduler.submit(GenerationRequest(prompt, 8))
+    # a top_p below any single token's probability always picks the most likely one
+    nucleus = scheduler.submit(GenerationRequest(prompt, 8, temperature=1.0, top_p=1e-6))
+    forced = scheduler.submit(GenerationRequest(prompt, 3, processor=lambda tokens, logits: logits + 1e4 * (torch.arange(64) == len(tokens))))
+    for request in [greedy, nucleus, forced]:
+        request.result(timeout=60)
+    assert nucleus.tokens == greedy.tokens
+    assert forced.tokens == [0, 1, 2]
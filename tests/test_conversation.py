@@ -0,0 +1,83 @@
+import datadm.conversation
+from datadm.conversation import OLD_OUTPUT_CHARS, ConversationRenderer, clean_conversation_list
+
+
+def output(text):
+    return {'stdout': text, 'tracebacks': '', 'data': []}
+
+
+def fresh(convo):
+    return ConversationRenderer()._render(convo)[0]
+
+
+def test_render_matches_a_fresh_render():
+    renderer = ConversationRenderer()
+    convo = [{'role': 'user', 'content': 'load the data'}]
+    assert renderer.render(convo) == fresh(convo) == [['load the data', None]]
+    # a streamed response grows a new list each time, with the same messages in front
+    for i, message in enumerate([
+        {'role': 'assistant', 'content': 'Loading'},
+        {'role': 'assistant', 'content': output('   a\n0  1\n')},
+        {'role': 'user', 'content': 'plot it'},
+        {'role': 'user', 'content': 'as bars'},
+        {'role': 'assistant', 'content': output('done')},
+        {'role': 'assistant', 'content': 'Here it is'},
+    ]):
+        convo = convo + [message]
+        assert renderer.render(convo) == fresh(convo), i
+    assert len(renderer.streams) == 1
+
+
+def test_render_after_edits():
+    renderer = ConversationRenderer()
+    convo = [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': output('1')},
+             {'role': 'user', 'content': 'again'}, {'role': 'assistant', 'content': output('2')},
+             {'role': 'user', 'content': 'once more'}]
+    renderer.render(convo)
+    convo[1] = {'role': 'assistant', 'content': output('one')}
+    assert renderer.render(convo) == fresh(convo)
+    convo[2]['content'] = 'edited'
+    assert renderer.render(convo) == fresh(convo)
+    del convo[3:]
+    assert renderer.render(convo) == fresh(convo)
+
+
+def test_streams_are_bounded():
+    renderer = ConversationRenderer(max_entries=4, max_streams=3)
+    convos = [[{'role': 'user', 'content': f'{i}'}, {'role': 'assistant', 'content': output(f'{i}')}] for i in range(10)]
+    for convo in convos:
+        assert renderer.render(convo) == fresh(convo)
+    assert len(renderer.streams) == 3 and len(renderer.cache) == 4
+    assert list(renderer.streams) == [id(convo[0]) for convo in convos[-3:]]
+
+
+class WordLLM:
+    # a token per word
+    def encode(self, text):
+        return text.split()
+
+
+def test_clean_conversation_fits_the_window(monkeypatch):
+    monkeypatch.setattr(datadm.conversation, 'RESERVED_TOKENS', 0)
+    llm = WordLLM()
+    convo = []
+    for i in range(3):
+        convo += [{'role': 'user', 'content': ' '.join(['ask'] * 100)},
+                  {'role': 'assistant', 'content': output(' '.join(['out'] * 1000))}]
+    cleaned, context = clean_conversation_list(convo, llm, window=100000)
+    assert context == {'tokens': sum(len(c['content'].split()) for c in cleaned), 'window': 100000, 'messages': 6, 'dropped': 0}
+    # outputs before the last two user turns are shortened more
+    assert len(cleaned[1]['content']) < OLD_OUTPUT_CHARS + 100 < len(cleaned[3]['content'])
+    assert all('context' not in message for message in convo)  # the caller's messages are left alone
+    # the oldest messages go first, the last one always stays
+    cleaned, context = clean_conversation_list(convo, llm, window=context['tokens'] - 1)
+    assert cleaned[0]['content'].startswith('EXECUTION') and (context['messages'], context['dropped']) == (5, 1)
+    cleaned, context = clean_conversation_list(convo, llm, window=1)
+    assert cleaned == [{'role': 'assistant', 'content': cleaned[-1]['content']}] and context['dropped'] == 5
+    # with profiles the last message stays too
+    profiles = [{'name': 'df', 'type': 'DataFrame', 'rows': 3, 'sampled': False,
+                 'columns': [{'name': 'a', 'dtype': 'int64', 'nulls': 0, 'unique': 3}]}]
+    cleaned, context = clean_conversation_list(convo, llm, window=1, profiles=profiles)
+    assert [m['role'] for m in cleaned] == ['assistant', 'user'] and cleaned[-1]['content'].startswith('DATAFRAMES')
+    assert context['messages'] == 2 and context['dropped'] == 5
+    assert clean_conversation_list(convo)[1] is None
@@ -0,0 +1,53 @@
+import base64
+import os
+
+import datadm.conversation
+from datadm.conversation import ConversationRenderer
+from datadm.images import ImageStore
+
+
+def image(i, size=1000):
+    # not a png, so it is stored as it comes
+    return base64.b64encode(bytes([i]) * size).decode()
+
+
+def test_dedupe_and_eviction(tmp_path):
+    store = ImageStore(max_bytes=2500)
+    first = store.path(image(1))
+    assert store.path(image(1)) == first and store.stats == {'hits': 1, 'writes': 1, 'evictions': 0}
+    copy = tmp_path / 'copy.png'
+    copy.write_bytes(open(first, 'rb').read())
+    store.add_copy(first, str(copy))
+    store.add_copy(first, str(copy))  # counted once
+    assert store.total_bytes == 2000
+    second = store.path(image(2))  # over the budget, the least recently used image goes, with its copy
+    assert not os.path.exists(first) and not copy.exists() and os.path.exists(second)
+    assert store.total_bytes == 1000 and store.stats['evictions'] == 1
+    store.path(image(3))
+    store.path(image(2))
+    store.path(image(4))
+    assert sorted(open(p, 'rb').read(1) for p, _, _ in store.index.values()) == [b'\x02', b'\x04']
+    # an image bigger than the budget is still kept, as the only one
+    store.path(image(5, 5000))
+    assert len(store.index) == 1 and store.total_bytes == 5000
+
+
+def test_render_after_eviction(monkeypatch):
+    store = ImageStore(max_bytes=2500)
+    monkeypatch.setattr(datadm.conversation, 'image_store', store)
+    renderer = ConversationRenderer(max_entries=2)
+    plot = {'stdout': '', 'tracebacks': '', 'data': [{'image/png': image(1)}]}
+    convo = [{'role': 'user', 'content': 'plot'}, {'role': 'assistant', 'content': plot}]
+    rows = renderer.render(convo)
+    path = rows[-1][1][0]
+    assert os.path.exists(path)
+    store.path(image(2))
+    store.path(image(3))
+    assert not os.path.exists(path)
+    # the image is written again instead of the rows pointing at a deleted file
+    assert renderer.render(convo) == renderer._render(convo)[0] == rows
+    assert os.path.exists(path)
+    # the output cache is bounded too
+    for i in range(5):
+        renderer.render_output({'stdout': str(i), 'tracebacks': '', 'data': []})
+    assert len(renderer.cache) == 2
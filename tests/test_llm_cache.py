@@ -0,0 +1,34 @@
+from datadm.llm_cache import ResponseCache, recording
+
+
+def test_response_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'llm'))
+    assert not (tmp_path / 'llm').exists()  # created on first use
+    keys = []
+
+    def turn(temperature):
+        key = cache.create_key('transformers', prompt='hi', temperature=temperature)
+        if key not in cache:
+            cache[key] = {'choices': [{'text': 'hello'}]}
+        yield cache[key]
+
+    assert list(recording(keys, turn(0.0))) == [{'choices': [{'text': 'hello'}]}]
+    list(turn(0.0))
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1 and cache.stats()['bytes'] > 0
+    # asking twice before reading is one lookup, each lookup is a hit
+    for _ in range(2):
+        key = cache.create_key('transformers', prompt='hi', temperature=0.0)
+        assert key in cache and key in cache
+        cache[key]
+    assert cache.stats()['hits'] == 3
+    # sampled responses are generated every time
+    list(turn(0.5))
+    list(turn(0.5))
+    assert cache.stats()['misses'] == 1
+    # the cache outlives the process, retry drops only the keys of the turn it removes
+    other = cache.create_key('transformers', prompt='other', temperature=0.0)
+    cache[other] = 'x'
+    cache = ResponseCache(str(tmp_path / 'llm'))
+    assert len(keys) == 1 and keys[0] in cache
+    cache.discard(keys)
+    assert keys[0] not in cache and other in cache
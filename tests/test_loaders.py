@@ -0,0 +1,90 @@
+import gzip
+
+import pandas as pd
+import pytest
+
+import datadm.loaders
+from datadm.loaders import load_code, sniff
+
+
+def write(path, text, encoding='utf-8'):
+    path.write_bytes(text.encode(encoding))
+    return str(path)
+
+
+def test_sniff_delimiter(tmp_path):
+    assert sniff('a.csv', write(tmp_path / 'a.csv', 'a;b;c\n1;2;3\n4;5;6\n'))['delimiter'] == ';'
+    # a .tsv is tab separated without looking
+    assert sniff('a.tsv', write(tmp_path / 'a.tsv', 'a,b\n1,2\n'))['delimiter'] == '\t'
+    with gzip.open(tmp_path / 'a.csv.gz', 'wt') as f:
+        f.write('a|b\n1|2\n3|4\n')
+    info = sniff('a.csv.gz', str(tmp_path / 'a.csv.gz'))
+    assert (info['compression'], info['format'], info['delimiter']) == ('gz', 'csv', '|')
+    # without the file only the name is used
+    assert sniff('a.csv.bz2') == {'size': None, 'compression': 'bz2', 'format': 'csv', 'delimiter': ',', 'encoding': 'utf-8'}
+
+
+def test_sniff_encoding(tmp_path):
+    assert sniff('a.csv', write(tmp_path / 'a.csv', 'name,city\nJosé,Zürich\n'))['encoding'] == 'utf-8'
+    assert sniff('b.csv', write(tmp_path / 'b.csv', 'name,city\nJosé,Zürich\n', 'latin-1'))['encoding'] == 'latin-1'
+    assert sniff('c.csv', write(tmp_path / 'c.csv', 'a;b\n1;2\n', 'utf-8-sig'))['encoding'] == 'utf-8-sig'
+    # a multi-byte character cut off by the end of the sample is still utf-8
+    path = write(tmp_path / 'd.csv', 'ab,c\n' + 'é,1\n' * 40000)
+    assert open(path, 'rb').read(64 * 1024)[-1:] == b'\xc3'
+    assert sniff('d.csv', path)['encoding'] == 'utf-8'
+
+
+def test_sniff_edge_cases(tmp_path, monkeypatch):
+    info = sniff('a.csv', write(tmp_path / 'a.csv', 'a,b,c\n'))
+    assert (info['size'], info['delimiter']) == (6, ',')
+    # csv.Sniffer gives up on a single column
+    assert sniff('b.csv', write(tmp_path / 'b.csv', 'value\n1\n2\n3\n'))['delimiter'] == ','
+    assert sniff('c.csv', write(tmp_path / 'c.csv', ''))['delimiter'] == ','
+    bz2_path = tmp_path / 'd.csv.bz2'
+    bz2_path.write_bytes(b'not bzip2 at all')
+    assert sniff('d.csv.bz2', str(bz2_path))['delimiter'] == ','
+
+    def fail(*args, **kwargs):
+        raise datadm.loaders.csv.Error('could not determine delimiter')
+    monkeypatch.setattr(datadm.loaders.csv.Sniffer, 'sniff', fail)
+    assert sniff('e.csv', write(tmp_path / 'e.csv', 'a;b\n1;2\n'))['delimiter'] == ','
+
+
+def run(code):
+    ns = {'pd': pd}
+    exec(code, ns)
+    return ns['df']
+
+
+@pytest.mark.parametrize('name', ['a.parquet', 'a.feather', 'a.json', 'a.jsonl'])
+def test_load_code_formats(tmp_path, name):
+    frame = pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']})
+    path = tmp_path / name
+    {'a.parquet': frame.to_parquet, 'a.feather': frame.to_feather, 'a.json': frame.to_json,
+     'a.jsonl': lambda p: frame.to_json(p, orient='records', lines=True)}[name](path)
+    code, strategy = load_code(str(path), 'df', local_path=str(path))
+    assert ('lines=True' in code) == (name == 'a.jsonl')
+    assert code.endswith('print(df.head())')
+    pd.testing.assert_frame_equal(run(code), frame)
+
+
+def test_load_code_csv(tmp_path, monkeypatch):
+    path = write(tmp_path / 'a.csv', 'name;city\nJosé;Zürich\nAna;Zürich\n', 'latin-1')
+    code, strategy = load_code(path, 'df', local_path=path)
+    assert "sep=';'" in code and "encoding='latin-1'" in code
+    assert run(code)['name'].tolist() == ['José', 'Ana']
+    path = write(tmp_path / 'b.csv', 'a,b\n1,2\n')
+    code, strategy = load_code(path, 'df', local_path=path)
+    assert code == f"df = pd.read_csv('{path}')\nprint(df.head())"
+
+    # big files get categoricals and the fast engine, bigger ones only a preview
+    path = write(tmp_path / 'c.csv', 'id;kind\n' + ''.join(f'{i};{"ab"[i % 2]}\n' for i in range(200)))
+    monkeypatch.setattr(datadm.loaders, 'FAST_PATH_BYTES', 100)
+    code, strategy = load_code(path, 'df', local_path=path)
+    assert "engine='pyarrow'" in code and "'kind': 'category'" in code
+    df = run(code)
+    assert len(df) == 200 and df['kind'].dtype == 'category'
+    monkeypatch.setattr(datadm.loaders, 'PREVIEW_BYTES', 100)
+    code, strategy = load_code(path, 'df', local_path=path)
+    assert f'nrows={datadm.loaders.PREVIEW_ROWS}' in code
+    assert len(run(code)) == min(200, datadm.loaders.PREVIEW_ROWS)
@@ -0,0 +1,24 @@
+import guidance
+from guidance import _program_executor
+
+from datadm.programs import ProgramCache, _CachedGrammar
+
+
+def test_parse_cache_is_confined_to_datadm_programs():
+    # the cache sits in place of the module level grammar of the pinned guidance, which must still exist
+    grammar = _program_executor.grammar
+    assert isinstance(grammar, _CachedGrammar) and hasattr(grammar.grammar, 'parse_string')
+    llm = guidance.llms.Mock("hello")
+    template = "{{#user~}}hi{{~/user}}{{#assistant~}}{{gen 'response'}}{{~/assistant}}"
+    cache = ProgramCache()
+    program = cache.get(template, llm)
+    assert cache.get(template, llm) is program and cache.stats == {'hits': 1, 'misses': 1}
+    before = grammar.cached_parse.cache_info()
+    assert program()['response'] == 'hello' and program()['response'] == 'hello'
+    after = grammar.cached_parse.cache_info()
+    assert (after.misses - before.misses, after.hits - before.hits) == (1, 1)  # parsed once, for the first run
+    # programs datadm didn't build are parsed as guidance does it
+    other = guidance("{{gen 'x'}} elsewhere", llm=llm)
+    assert other()['x'] == 'hello'
+    assert grammar.cached_parse.cache_info() == after and other.marked_text not in grammar.texts
+
@@ -1,7 +1,328 @@
-from datadm.repl import REPL
+import asyncio
+import os
+import signal
+import time
+from queue import Empty
+
+import pytest
+
+from datadm import resources
+from datadm.history import Blob
+from datadm.repl import AsyncREPL, KERNEL_DIED, REPL, KernelPool
+from datadm.session import SessionManager
 
 
 def test_exec():
     repl = REPL()
     out = repl.exec("print('hi')")
     assert 'hi' in out['stdout']
+
+
+def test_exec_matches_its_own_messages():
+    repl = REPL()
+    # output after a pause is part of the cell, output of an abandoned cell never leaks into the next one
+    assert repl.exec("import time\nprint('a')\ntime.sleep(0.5)\nprint('b')")['stdout'] == 'a\nb\n'
+    with pytest.raises(Empty):
+        repl.exec("time.sleep(1.5)\nprint('late')", timeout=0.5)
+    assert repl.exec("print('next')")['stdout'] == 'next\n'
+    # completion is the request's idle status, not a quiet period on iopub
+    start = time.time()
+    for i in range(20):
+        assert repl.exec(f"print({i})")['stdout'] == f'{i}\n'
+    assert (time.time() - start) / 20 < 0.1
+
+
+def test_kernel_pool():
+    pool = KernelPool(size=1, setup=lambda repl: repl.exec("x = 42"))
+    repl = pool.get()
+    assert '42' in repl.exec("print(x)")['stdout']
+    assert pool.stats()['misses'] == 1
+
+
+def test_exec_stream():
+    repl = REPL()
+    outputs = list(repl.exec_stream("import time\nprint('a', flush=True)\ntime.sleep(0.2)\nprint('b')"))
+    assert outputs[0]['stdout'] == 'a\n'
+    assert outputs[-1]['stdout'] == 'a\nb\n'
+
+
+@pytest.mark.asyncio
+async def test_async_exec():
+    repl = AsyncREPL()
+    out = await repl.exec("print('hi')")
+    assert 'hi' in out['stdout']
+
+
+def test_dataframe_export_skips_unchanged():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': [1, 2]})")
+    assert [f['name'] for f in repl.list_dataframes()] == ['df']
+    path = repl.export_dataframe('df')['path']
+    mtime = os.stat(path).st_mtime_ns
+    assert repl.export_dataframe('df')['path'] == path
+    assert os.stat(path).st_mtime_ns == mtime
+    repl.exec("df.loc[0, 'a'] = 5")
+    repl.export_dataframe('df')
+    assert os.stat(path).st_mtime_ns != mtime
+
+
+def test_dataframe_export_formats():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': [1, 2]})")
+    status = repl.export_dataframe('df', format='csv.gz', wait=False)
+    while status['status'] == 'pending':
+        status = repl.export_status('df', format='csv.gz')
+    assert status['status'] == 'done'
+    assert status['path'].endswith('df.csv.gz')
+    assert repl.exec(f"print(pd.read_csv({status['path']!r}, index_col=0).equals(df))")['stdout'].strip() == 'True'
+
+
+def test_dataframe_changed_during_export():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': [1, 2]})")
+    repl.list_dataframes()  # loads the helpers
+    # a writer racing with the next cell: the frame changes while it is written
+    repl.exec("_datadm.WRITERS['csv'] = ('.csv', lambda x, path: (x.to_csv(path), x.loc.__setitem__((0, 'a'), 5)))", record=False)
+    status = repl.export_dataframe('df')
+    assert status['status'] == 'stale' and not os.path.exists(status['path'])
+    repl.exec("_datadm.WRITERS['csv'] = ('.csv', lambda x, path: x.to_csv(path))", record=False)
+    assert repl.export_dataframe('df')['status'] == 'done'
+
+
+def test_upload_file(tmp_path):
+    source = tmp_path / 'data.csv'
+    source.write_text('a,b\n1,2\n')
+    repl = REPL()
+    assert repl.upload_file(str(source)) == 'data.csv'
+    assert repl.last_upload['bytes'] == 8
+    assert 'a,b' in repl.exec("print(open('data.csv').read())")['stdout']
+
+
+def test_optimize_memory():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'n': range(200), 'f': [0.5] * 200, 's': ['a', 'b'] * 100})")
+    report, = repl.optimize_memory()
+    assert report['after'] < report['before']
+    assert set(report['changes']) == {'n', 'f', 's'}
+    assert repl.optimize_memory() == []  # unchanged since last time
+    assert repl.exec("print(df['f'].sum(), df['s'].dtype)")['stdout'] == '100.0 category\n'
+
+
+def test_wall_clock_limit():
+    repl = REPL(limits={'wall_seconds': 1})
+    out = repl.exec("import time\ntime.sleep(30)")
+    assert 'wall clock limit' in out['tracebacks']
+    assert 'KeyboardInterrupt' in out['tracebacks']
+    assert repl.resource_usage()['rss_bytes'] > 0
+    assert repl.exec("print('still alive')")['stdout'] == 'still alive\n'
+
+
+def test_killed_kernel_is_rebuilt():
+    repl = REPL()
+    repl.exec("x = 1")
+    # kill the kernel, not its `jupyter-kernel` launcher, which stays alive as it does when the kernel runs out of memory
+    os.kill(resources.process_tree(repl.kernel_pid)[1], signal.SIGKILL)
+    time.sleep(0.5)
+    assert repl.exec("print(x)")['stdout'] == '1\n'
+    out = repl.exec("import os, signal\nos.kill(os.getpid(), signal.SIGKILL)", timeout=1)
+    assert out['tracebacks'] == KERNEL_DIED
+    assert len(repl.history) == 2
+    assert repl.exec("print(x)")['stdout'] == '1\n'
+
+
+def test_idle_eviction():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': [1, 2]})\nx = 42")
+    manager = SessionManager(idle_seconds=0, expire_seconds=3600)
+    manager.track(repl)
+    manager.reap()
+    assert repl.evicted and manager.stats()['idle'] == 1
+    assert repl.exec("print(x, df['a'].sum(), pd.__name__)")['stdout'] == '42 3 pandas\n'
+    assert manager.stats() == {'live': 1, 'idle': 0, 'revived': 1, 'evicted': 1, 'expired': 0}
+
+
+
+def setup(repl):
+    repl.exec("a = 1")
+    repl.snapshot('initial')
+
+
+def test_restore_after_revive():
+    repl = REPL()
+    repl.setup = setup
+    setup(repl)
+    repl.exec("b = 2")
+    first = repl.snapshot()
+    repl.exec("c = 3")
+    repl.evict()
+    assert repl.exec("print(a, b, c)")['stdout'] == '1 2 3\n'
+    assert repl.revivals == 1 and repl.snapshot_history == {'initial': 1, first: 2}
+    repl.restore(first)
+    assert repl.exec("print('c' in globals())")['stdout'] == 'False\n'
+    repl.restore('initial')
+    assert [cell['code'] for cell in repl.history] == ["a = 1"]
+    assert repl.exec("print('b' in globals(), a)")['stdout'] == 'False 1\n'
+    repl.exec("a = 5")
+    second = repl.snapshot()
+    repl.exec("a = 7")
+    repl.restore(second)
+    assert repl.history[-1]['code'] == "a = 5" and repl.exec("print(a)")['stdout'] == '5\n'
+
+
+@pytest.mark.asyncio
+async def test_async_restore_after_revive():
+    async def setup(repl):
+        await repl.exec("a = 1")
+        await repl.snapshot('initial')
+    repl = AsyncREPL()
+    repl.setup = setup
+    await setup(repl)
+    await repl.exec("b = 2")
+    await repl.evict()
+    await repl.exec("c = 3")
+    assert repl.snapshot_history == {'initial': 1} and repl.snapshot_mark is None
+    await repl.restore('initial')
+    assert len(repl.history) == 1
+    assert (await repl.exec("print('b' in globals(), 'c' in globals())"))['stdout'] == 'False False\n'
+
+
+@pytest.mark.asyncio
+async def test_exec_waits_for_eviction():
+    repl = AsyncREPL()
+    await repl.exec("x = 42")
+    eviction = asyncio.ensure_future(repl.evict())
+    await asyncio.sleep(0)  # the checkpoint is running
+    assert (await repl.exec("print(x)"))['stdout'] == '42\n'
+    assert (await eviction)['saved'] == 1 and repl.revivals == 1
+    # a kernel in use is not evicted
+    running = asyncio.ensure_future(repl.exec("import time; time.sleep(1)"))
+    await asyncio.sleep(0.3)
+    assert await repl.evict() is None
+    await running
+
+
+def test_snapshot_restore():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': range(1000)})\nbig = pd.DataFrame({'b': range(1000)})")
+    first = repl.snapshot()
+    repl.exec("df['a'] = -1\nbig2 = big\nx = [1, 2]")
+    second = repl.snapshot()
+    restored = repl.restore(first)
+    assert (restored['restored'], restored['removed']) == (['df'], ['big2', 'x'])
+    assert repl.exec("print(df['a'].sum(), 'x' in globals())")['stdout'] == '499500 False\n'
+    repl.exec("df['a'] = 0")  # restored copies are private, the snapshot is unchanged
+    repl.restore(second)
+    repl.restore(first)
+    assert repl.exec("print(df['a'].sum(), big2 is big if 'big2' in globals() else None)")['stdout'] == '499500 None\n'
+
+
+
+def test_snapshot_checks_only_touched_values(monkeypatch):
+    monkeypatch.setattr('datadm.repl.SNAPSHOTS_MEMORY_BYTES', 10000)
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': range(1000)})\nsmall = pd.DataFrame({'b': [1]})\nalias = df")
+    first = repl.snapshot()
+    # df is bigger than the budget, its copy went straight to disk
+    assert repl.exec("print(_datadm._latest['df']['value'] is None, _datadm._latest['small']['value'] is None)")['stdout'] == 'True False\n'
+    repl.exec("_hashed = []\n_fingerprint = _datadm.fingerprint\n_datadm.fingerprint = lambda x: _hashed.append(len(x)) or _fingerprint(x)", record=False)
+    repl.exec("alias.loc[0, 'a'] = -1")  # changes df through another name
+    repl.snapshot()
+    assert repl.exec("print(1 in _hashed, 1000 in _hashed)")['stdout'] == 'False True\n'  # small was not hashed
+    repl.restore(first)
+    assert repl.exec("print(df['a'].sum(), small['b'].sum())")['stdout'] == '499500 1\n'
+
+
+def test_snapshot_sees_changes_through_views_and_containers():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': range(10)})\nframes = {'df': df}\nbox = [df]\n"
+              "t = pd.DataFrame({'c': range(10)})\ns = t['c']\nother = pd.DataFrame({'d': range(10)})")
+    snapshots = [repl.snapshot()]
+    repl.exec("_hashed = []\n_fingerprint = _datadm.fingerprint\n_datadm.fingerprint = lambda x: _hashed.append(id(x)) or _fingerprint(x)", record=False)
+    hashed = "print(sorted(n for n in ['df', 't', 's', 'other'] if id(globals()[n]) in _hashed))\n_hashed.clear()"
+    for cell, checked in [("frames['df'].loc[0, 'a'] = 100", ['df', 'other', 's', 't']), ("s[1] = 100", ['s', 't']),
+                          ("df.loc[2, 'a'] = 100", ['df'])]:
+        repl.exec(cell)
+        snapshots.append(repl.snapshot())
+        # a dict may hold anything, a frame only changes what views it
+        assert repl.exec(hashed, record=False)['stdout'] == f"{checked}\n"
+    check = "print(df['a'][0], t['c'][1], df['a'][2], box[0]['a'][2], frames['df']['a'][0])"
+    for snapshot, expected in zip(snapshots, ['0 1 2 2 0', '100 1 2 2 100', '100 100 2 2 100', '100 100 100 100 100']):
+        repl.restore(snapshot)
+        assert repl.exec(check)['stdout'] == expected + '\n'
+
+
+def test_replay():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': [1, 2]})")
+    repl.exec("print(df.head())")
+    repl.exec("df['b'] = df['a'] * 2")
+    repl.exec("unused = 1")
+    repl.cache_artifact('df')
+    assert len(repl.history) == 4  # internal calls are not recorded
+    assert repl.replay(names=['df'])['cells'] == 1  # df is loaded from the artifact
+    repl.exec("df = df.head(1)")
+    repl.cache_artifact('df')
+    assert len({p for cell in repl.history for p in cell.get('artifacts', {}).values()}) == 2  # one file per value
+    info = repl.recover(names=['df'], upto=1)
+    assert info['cells'] == 1
+    assert repl.exec("print(df.columns.tolist(), 'unused' in globals())")['stdout'] == "['a'] False\n"
+
+
+def test_history_is_compact():
+    repl = REPL()
+    for _ in range(3):
+        out = repl.exec("print('x' * 5000)")
+    assert 'results' not in repl.history[-1]
+    assert isinstance(repl.history[-1]['output']['stdout'], Blob)
+    assert repl.history.output(-1) == out
+    size = repl.history_size()
+    assert (size['cells'], size['blobs'], size['deduplicated']) == (3, 1, 2)
+    assert size['disk_bytes'] == 5001
+    out = repl.exec("from IPython.display import JSON, display\ndisplay(JSON({'blob': 1}))")
+    assert repl.history.output(-1) == out  # a dict output value isn't a blob
+    repl.history += [{'code': '', 'output': {**out, 'stdout': 'y' * 5000}, 'results': []}]
+    repl.history[0] = repl.history[-1]
+    assert 'results' not in repl.history[-1] and isinstance(repl.history[0]['output']['stdout'], Blob)
+    del repl.history[1:]
+    assert len(repl.history) == 1
+
+
+def test_forked_trials():
+    repl = REPL()
+    repl.exec("import matplotlib.pyplot as plt\nx = 1")
+    bad = repl.start_trial("x = 2\nraise ValueError('nope')")['id']
+    good = repl.start_trial("x = 3\nplt.plot([1, 2])\nplt.show()\nprint(x)")['id']
+    slow = repl.start_trial("import time\ntime.sleep(60)")['id']
+    results = {}
+    while len(results) < 2:
+        results.update(repl.trial_results(wait=1))
+    assert not results[bad]['ok'] and 'ValueError' in results[bad]['tracebacks']
+    assert results[good] == {'ok': True, 'stdout': '3\n', 'tracebacks': ''}
+    assert repl.cancel_trials() == [slow]
+    assert repl.exec("print(x)")['stdout'] == '1\n'  # the forks didn't touch the kernel
+
+
+def test_profile_dataframes():
+    repl = REPL()
+    repl.exec("import pandas as pd\ndf = pd.DataFrame({'a': [1, None, 3], 'b': ['x', 'x', 'y']})\ns = pd.Series(range(20000))")
+    profiles = {p['name']: p for p in repl.profile_dataframes()}
+    assert profiles['df']['columns'] == [{'name': 'a', 'dtype': 'float64', 'nulls': 1, 'unique': 2},
+                                         {'name': 'b', 'dtype': 'object', 'nulls': 0, 'unique': 2}]
+    assert profiles['s']['sampled'] and profiles['s']['columns'][0]['unique'] == 10000
+    # only the frame that changed is profiled again
+    repl.exec("_before = {name: p for name, (_, p) in _datadm._profiles.items()}\ndf['c'] = 1")
+    repl.profile_dataframes()
+    assert repl.exec("print(_datadm._profiles['s'][1] is _before['s'], _datadm._profiles['df'][1] is _before['df'])", record=False)['stdout'] == 'True False\n'
+    # frames the cells since didn't reference aren't hashed, a change that keeps the layout is still found
+    repl.exec("_hashed = []\n_fingerprint = _datadm.fingerprint\n_datadm.fingerprint = lambda x: _hashed.append(len(x)) or _fingerprint(x)", record=False)
+    repl.exec("df.loc[0, 'a'] = None")
+    profiles = {p['name']: p for p in repl.profile_dataframes()}
+    assert profiles['df']['columns'][0]['nulls'] == 2
+    assert repl.exec("print(_hashed)", record=False)['stdout'] == '[3]\n'
+    # changes made through a view or a container are found too
+    repl.exec("v = s[:10]\nholder = {'df': df}", record=False)
+    repl.profile_dataframes()
+    repl.exec("v[:] = 0")
+    assert {p['name']: p for p in repl.profile_dataframes()}['s']['columns'][0]['unique'] < 10000
+    repl.exec("holder['df'].loc[1, 'a'] = 5")
+    assert {p['name']: p for p in repl.profile_dataframes()}['df']['columns'][0]['nulls'] == 1
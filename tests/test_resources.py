@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+import datadm.resources as resources
+from datadm.repl import REPL
+
+LIMITS = "import resource; print(resource.getrlimit(resource.RLIMIT_AS)[0], resource.getrlimit(resource.RLIMIT_CPU)[0])"
+
+
+def run(command):
+    return subprocess.run(command, capture_output=True, text=True, check=True).stdout.split()
+
+
+def test_limited_command(tmp_path):
+    command = [sys.executable, '-c', LIMITS]
+    assert resources.limited(command, {}) == command
+    assert run(resources.limited(command, {'memory_mb': 4096, 'cpu_seconds': 100})) == [str(4096 * 1024 * 1024), '100']
+    # in a cgroup the memory limit is the cgroup's, not an rlimit
+    (tmp_path / 'cgroup.procs').write_text('')
+    as_limit, cpu = run(resources.limited(command, {'memory_mb': 4096}, str(tmp_path)))
+    assert int(as_limit) != 4096 * 1024 * 1024 and cpu == str(resources.resource.RLIM_INFINITY)
+    assert (tmp_path / 'cgroup.procs').read_text().isdigit()
+
+
+def test_kernel_runs_under_limits():
+    repl = REPL(limits={'cpu_seconds': 1000})
+    try:
+        assert repl.exec("import resource; print(resource.getrlimit(resource.RLIMIT_CPU)[0])")['stdout'] == '1000\n'
+    finally:
+        repl.shutdown()
+
+
+def test_server_moves_only_when_asked(tmp_path, monkeypatch):
+    # a cgroup with processes in it refuses controllers for its children, like a directory refuses being written to
+    (tmp_path / 'cgroup.subtree_control').mkdir()
+    monkeypatch.setattr(resources, '_own_cgroup', lambda: str(tmp_path))
+    monkeypatch.delenv('DATADM_CGROUP', raising=False)
+    monkeypatch.delenv('DATADM_CGROUP_MOVE_SERVER', raising=False)
+    parent, error = resources._setup_parent()
+    assert parent is None and 'DATADM_CGROUP_MOVE_SERVER=1' in error
+    assert not (tmp_path / 'datadm-server').exists()
+    monkeypatch.setenv('DATADM_CGROUP_MOVE_SERVER', '1')
+    resources._setup_parent()
+    assert (tmp_path / 'datadm-server' / 'cgroup.procs').read_text() == str(os.getpid())
+    # a usable cgroup is used as it is
+    (tmp_path / 'cgroup.subtree_control').rmdir()
+    (tmp_path / 'datadm-server' / 'cgroup.procs').unlink()
+    assert resources._setup_parent() == (str(tmp_path), None)
+    assert not (tmp_path / 'datadm-server' / 'cgroup.procs').exists()